@@ -27,6 +27,7 @@ parser.add_option('--certfile', metavar = '<file>', help = 'Enable SSL and use P
 parser.add_option('--keyfile', metavar = '<file>', help = 'Use private key from <file> to secure connection (requires --certfile)')
 parser.add_option('--no-output-redirection', dest = 'redirect_output', action = 'store_false', default = True, help = 'do not redirect stdout and stderr to debugger')
 parser.add_option('--wait', dest = 'wait', action = 'store_true', default = False, help = 'wait for a debugger to attach before executing')
+parser.add_option('--trace-only-when-attached', dest = 'trace_only_when_attached', action = 'store_true', default = False, help = 'do not trace the program while no debugger is attached')
 
 argv = sys.argv[1:]
 script_argv = []
@@ -42,7 +43,7 @@ if args:
 if opts.keyfile and not opts.certfile:
     parser.error('--keyfile requires --certfile')
 
-enable_attach(opts.secret, (opts.interface, opts.port), opts.certfile, opts.keyfile, opts.redirect_output)
+enable_attach(opts.secret, (opts.interface, opts.port), opts.certfile, opts.keyfile, opts.redirect_output, opts.trace_only_when_attached)
 if opts.wait:
     wait_for_attach()
 
@@ -12,7 +12,7 @@
  #
  # ###########################################################################
 
-__all__ = ['enable_attach', 'wait_for_attach', 'break_into_debugger', 'settrace', 'is_attached', 'AttachAlreadyEnabledError']
+__all__ = ['enable_attach', 'wait_for_attach', 'break_into_debugger', 'settrace', 'is_attached', 'enable_stats', 'get_stats', 'sample_to_file', 'AttachAlreadyEnabledError']
 
 import atexit
 import getpass
@@ -23,6 +23,7 @@ import socket
 import struct
 import sys
 import threading
+import time
 try:
     import thread
 except ImportError:
@@ -34,12 +35,14 @@ except ImportError:
 
 import ptvsd.visualstudio_py_debugger as vspd
 import ptvsd.visualstudio_py_repl as vspr
-from ptvsd.visualstudio_py_util import to_bytes, read_bytes, read_int, read_string, write_bytes, write_int, write_string
+from ptvsd.visualstudio_py_util import to_bytes, read_bytes, read_int, read_string, write_bytes, ConnectionReader, MessageWriter
 
 
 # The server (i.e. the Python app) waits on a TCP port provided. Whenever anything connects to that port,
 # it immediately sends the octet sequence 'PTVSDBG', followed by version number represented as int64,
-# and then waits for the client to respond with the same exact byte sequence. After signatures are thereby
+# and then waits for the client to respond with the same exact byte sequence. A client that supports a later
+# version of the protocol can respond with that version instead, up to PTVSDBG_MAX_VER, to opt into the
+# features it adds (older servers will close the connection in that case). After signatures are thereby
 # exchanged and found to match, the client is expected to provide a string secret (in the usual debugger
 # string format, None/ACII/Unicode prefix + length + data), which can be an empty string to designate the
 # lack of a specified secret.
@@ -63,23 +66,102 @@ from ptvsd.visualstudio_py_util import to_bytes, read_bytes, read_int, read_stri
 #   If attaching was not successful (which can happen if some other debugger is already attached), the server
 #   responds with 'RJCT' and closes the connection. 
 #
+#   If the client responded with version 6 or later, THRF does not carry frame variables; the client requests
+#   them for each frame on demand with 'frmv' (thread id, frame id, execution id, frame kind - all int64),
+#   to which the debugger replies with 'FRMV' (execution id, variable count, variables in the THRF format).
+#
+#   If the client responded with version 7 or later, the stacks of running threads are reported after each
+#   stop with 'THRD' instead of 'THRF', relative to the last THRF or THRD for that thread: thread id, count of
+#   innermost frames popped, count of frames pushed followed by those frames in the THRF format, and count of
+#   retained frames that changed, each as its index in the new stack, current line (and source line for
+#   Django frames), count of updated variables followed by those variables, and count of removed variable
+#   names followed by those names. Threads whose stacks did not change are not reported at all.
+#
+#   If the client responded with version 8 or later, it can request the children of an expression a page at
+#   a time with 'chlp' (the 'chld' arguments followed by offset and count, both int64), to which the debugger
+#   replies with 'CHLP' (execution id, total item count or -1 if unknown, and the children in the CHLD format).
+#   Only the first page, at offset 0, includes the attributes of the object.
+#
+#   If the client responded with version 9 or later, it can turn a breakpoint into a logpoint with 'brkl'
+#   (breakpoint id as int64, and the message as string). When a logpoint is hit, its message is sent as 'OUTP'
+#   for the thread that hit it, with each {expression} replaced by the repr of its value in the current frame,
+#   and the thread keeps running. Setting an empty message turns the logpoint back into a regular breakpoint.
+#
+#   If the client responded with version 10 or later, it can evaluate several expressions in the same frame
+#   with 'exem' (thread id, frame id, frame kind, expression count, and then the text, execution id and
+#   repr kind of each expression, as for 'exec'). The expressions are evaluated one after another by the
+#   thread in one go, and the 'EXCR' or 'EXCE' of each of them are sent together. Evaluations requested while
+#   the thread is still busy with a previous one are queued, rather than failing.
+#
+#   If the client responded with version 11 or later, it can set the time budgets for evaluations with 'evto'
+#   (the budget for the repr of each value shown in the variables windows, and the budget for each
+#   expression evaluated with 'exec' or 'exem', both in milliseconds as int64; 0 means no budget). Values
+#   that run out of time are reported with '<timed out>' as their repr, and expressions with an 'EXCE'
+#   carrying '<timed out>'.
+#
+#   If the client responded with version 12 or later, the threads and modules that exist when the debugger
+#   attaches are reported with a single 'INVT' rather than a 'NEWT' per thread and a 'MODL' per module: flags
+#   (int64, 1 if the payload is zlib-compressed), payload length (int64), and the payload, which holds the
+#   thread count followed by the thread ids, and the module count followed by the id and filename of each
+#   module, in the usual int64 and string formats.
+#
+#   If the client responded with version 13 or later, it can ask for the counters and timers of the overhead
+#   of the debugger (see get_stats) with 'stat' (int64 action: 0 to only report them, 1 to also start
+#   collecting them from zero, 2 to also stop collecting them), to which the debugger replies with 'STAT'
+#   (count of values, and then the name and value of each, both as strings) before carrying out the action.
+#   Times are in seconds.
+#
 # 'REPL'
 #   Attach REPL to the process. If successful, the server responds with 'ACPT', and from there on the socket
 #   is assumed to be using the normal PTVS REPL protocol. If not successful (which can happen if there is
 #   no debugger attached), the server responds with 'RJCT' and closes the connection. 
+#
+# 'PROF'
+#   Sample the stacks of all threads of the process, without attaching the debugger or installing a trace
+#   function. The client follows the command with the sampling interval, the duration (0 to sample until the
+#   client closes the connection) and the snapshot period, all in milliseconds as int64. If sampling is not
+#   supported, the client responded with a version earlier than 14, or the interval or period is not
+#   positive, the server responds with 'RJCT' and closes the connection. Otherwise, it responds with 'ACPT',
+#   and then sends a 'SMPL' after each snapshot period, and once more when the duration has passed, after
+#   which it closes the connection. Each 'SMPL' carries the stacks sampled since the previous one: count of
+#   samples taken (int64), count of stacks dropped because too many distinct stacks were seen (int64), and
+#   count of distinct stacks (int64) followed by each stack in the folded format (the functions from the
+#   outermost to the innermost, as 'name (filename:first line)' separated by ';', as a string) and the number of
+#   times it was seen (int64). The frames of the debugger are left out of the stacks, and the threads of the
+#   debugger are not sampled.
 
 PTVS_VER = '2.2'
 DEFAULT_PORT = 5678
 PTVSDBG_VER = 5 # must be kept in sync with DebuggerProtocolVersion in PythonRemoteProcess.cs
+PTVSDBG_LAZY_FRAMES_VER = 6
+PTVSDBG_STACK_DELTAS_VER = 7
+PTVSDBG_PAGED_CHILDREN_VER = 8
+PTVSDBG_LOGPOINTS_VER = 9
+PTVSDBG_BATCH_EVAL_VER = 10
+PTVSDBG_EVAL_TIMEOUTS_VER = 11
+PTVSDBG_INVENTORY_VER = 12
+PTVSDBG_STATS_VER = 13
+PTVSDBG_SAMPLING_VER = 14
+PTVSDBG_MAX_VER = PTVSDBG_SAMPLING_VER
 PTVSDBG = to_bytes('PTVSDBG')
 ACPT = to_bytes('ACPT')
 RJCT = to_bytes('RJCT')
 INFO = to_bytes('INFO')
 ATCH = to_bytes('ATCH')
 REPL = to_bytes('REPL')
+PROF = to_bytes('PROF')
+SMPL = to_bytes('SMPL')
+
+# Bounds on the memory used by the sampler: the number of distinct stacks kept between snapshots (samples of
+# any other stack are only counted as dropped), the number of innermost frames kept of each stack, and the
+# number of functions whose names are cached between snapshots.
+SAMPLER_MAX_STACKS = 10000
+SAMPLER_MAX_DEPTH = 128
+SAMPLER_MAX_NAMES = 10000
 
 _attach_enabled = False
 _attached = threading.Event()
+_server_thread_id = None
 vspd.DONT_DEBUG.append(os.path.normcase(__file__))
 
 
@@ -87,7 +169,7 @@ class AttachAlreadyEnabledError(Exception):
     """`ptvsd.enable_attach` has already been called in this process."""
 
 
-def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None, keyfile = None, redirect_output = True):
+def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None, keyfile = None, redirect_output = True, trace_only_when_attached = False):
     """Enables Python Tools for Visual Studio to attach to this process remotely
     to debug Python code.
 
@@ -118,6 +200,13 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
     redirect_output : bool, optional
         Specifies whether any output (on both `stdout` and `stderr`) produced
         by this program should be sent to the debugger. Default is ``True``.
+    trace_only_when_attached : bool, optional
+        Specifies whether tracing should only be enabled while a debugger is
+        attached. If ``True``, no trace function is installed until a debugger
+        attaches, at which point all running threads start being traced; the
+        trace functions are removed again when the debugger detaches. This
+        makes the process run at full speed while no debugger is attached.
+        Requires CPython 3.12 or later. Default is ``False``.
 
     Notes
     -----
@@ -135,12 +224,17 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
     Only the thread on which this function is called, and any threads that are
     created after it returns, will be visible in the debugger once it is
     attached. Any threads that are already running before this function is
-    called will not be visible.
+    called will not be visible, unless `trace_only_when_attached` is ``True``,
+    in which case all threads that are running when the debugger attaches will
+    be visible.
     """
 
     if not ssl and (certfile or keyfile):
         raise ValueError('could not import the ssl module - SSL is not supported on this version of Python')
 
+    if trace_only_when_attached and not vspd.can_trace_all_threads():
+        raise ValueError('trace_only_when_attached is not supported on this version of Python')
+
     if sys.platform == 'cli':
         # Check that IronPython was launched with -X:Frames and -X:Tracing, since we can't register our trace
         # func on the thread that calls enable_attach otherwise
@@ -159,12 +253,15 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
         vspd.enable_output_redirection()
 
     atexit.register(vspd.detach_process_and_notify_debugger)
+    vspd.TRACE_ONLY_WHEN_ATTACHED = trace_only_when_attached
 
     server = socket.socket()
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(address)
     server.listen(1)
     def server_thread_func():
+        global _server_thread_id
+        _server_thread_id = thread.get_ident()
         while True:
             client = None
             raw_client = None
@@ -172,40 +269,43 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
                 client, addr = server.accept()
                 if certfile:
                     client = ssl.wrap_socket(client, server_side = True, ssl_version = ssl.PROTOCOL_TLSv1, certfile = certfile, keyfile = keyfile)
-                write_bytes(client, PTVSDBG)
-                write_int(client, PTVSDBG_VER)
+                msg = MessageWriter()
+                msg.write_bytes(PTVSDBG)
+                msg.write_int(PTVSDBG_VER)
+                msg.send(client)
 
-                response = read_bytes(client, 7)
+                reader = ConnectionReader(client)
+                response = read_bytes(reader, 7)
                 if response != PTVSDBG:
                     continue
-                dbg_ver = read_int(client)
-                if dbg_ver != PTVSDBG_VER:
+                dbg_ver = read_int(reader)
+                if dbg_ver < PTVSDBG_VER or dbg_ver > PTVSDBG_MAX_VER:
                     continue
 
-                client_secret = read_string(client)
+                client_secret = read_string(reader)
                 if secret is None or secret == client_secret:
                     write_bytes(client, ACPT)
                 else:
                     write_bytes(client, RJCT)
                     continue
 
-                response = read_bytes(client, 4)
+                response = read_bytes(reader, 4)
 
                 if response == INFO:
                     try:
                         pid = os.getpid()
                     except AttributeError:
                         pid = 0
-                    write_int(client, pid)
+                    msg.write_int(pid)
 
                     exe = sys.executable or ''
-                    write_string(client, exe)
+                    msg.write_string(exe)
 
                     try:
                         username = getpass.getuser()
                     except AttributeError:
                         username = ''
-                    write_string(client, username)
+                    msg.write_string(username)
 
                     try:
                         impl = platform.python_implementation()
@@ -229,26 +329,33 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
                         pass
 
                     version = '%s %s.%s.%s (%s)' % (impl, major, minor, micro, os_and_arch)
-                    write_string(client, version)
+                    msg.write_string(version)
+                    msg.send(client)
 
                     # Don't just drop the connection - let the debugger close it after it finishes reading.
                     client.recv(1)
 
                 elif response == ATCH:
                     if vspd.DETACHED:
-                        write_bytes(client, ACPT)
+                        msg.write_bytes(ACPT)
                         try:
                             pid = os.getpid()
                         except AttributeError:
                             pid = 0
-                        write_int(client, pid)
+                        msg.write_int(pid)
 
                         major, minor, micro, release_level, serial = sys.version_info
-                        write_int(client, major)
-                        write_int(client, minor)
-                        write_int(client, micro)
-
-                        vspd.attach_process_from_socket(client, report = True)
+                        msg.write_int(major)
+                        msg.write_int(minor)
+                        msg.write_int(micro)
+                        msg.send(client)
+
+                        vspd.LAZY_FRAME_VARIABLES = dbg_ver >= PTVSDBG_LAZY_FRAMES_VER
+                        vspd.STACK_DELTAS = dbg_ver >= PTVSDBG_STACK_DELTAS_VER
+                        vspd.BULK_INVENTORY = dbg_ver >= PTVSDBG_INVENTORY_VER
+                        vspd.attach_process_from_socket(client, report = True, reader = reader)
+                        if trace_only_when_attached:
+                            vspd.trace_all_threads()
                         vspd.mark_all_threads_for_break(vspd.STEPPING_ATTACH_BREAK)
                         _attached.set()
                         client = None
@@ -258,12 +365,24 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
                 elif response == REPL:
                     if not vspd.DETACHED:
                         write_bytes(client, ACPT)
-                        vspd.connect_repl_using_socket(client)
+                        vspd.connect_repl_using_socket(client, reader)
+                        client = None
+                    else:
+                        write_bytes(client, RJCT)
+
+                elif response == PROF:
+                    interval = read_int(reader)
+                    duration = read_int(reader)
+                    period = read_int(reader)
+                    if dbg_ver >= PTVSDBG_SAMPLING_VER and can_sample() and interval > 0 and period > 0:
+                        write_bytes(client, ACPT)
+                        sampler = Sampler(interval / 1000.0)
+                        vspd._start_new_thread(sample_to_client, (sampler, client, duration / 1000.0, period / 1000.0))
                         client = None
                     else:
                         write_bytes(client, RJCT)
 
-            except (socket.error, OSError):
+            except (socket.error, OSError, EOFError):
                 pass
             finally:
                 if client is not None:
@@ -273,6 +392,10 @@ def enable_attach(secret, address = ('0.0.0.0', DEFAULT_PORT), certfile = None,
     server_thread.daemon = True
     server_thread.start()
 
+    if trace_only_when_attached:
+        vspd.intercept_threads(for_attach = True)
+        return
+
     frames = []
     f = sys._getframe()
     while True:
@@ -322,3 +445,205 @@ def break_into_debugger():
 def is_attached():
     """Returns ``True`` if debugger is attached, ``False`` otherwise."""
     return not vspd.DETACHED
+
+
+def enable_stats(enabled = True):
+    """Starts collecting counters and timers for the overhead of the debugger
+    from zero, or stops collecting them. They can also be started and stopped
+    by an attached debugger.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether to collect the counters and timers reported by get_stats.
+    """
+    vspd.collect_stats(enabled)
+
+
+def get_stats():
+    """Returns the counters and timers for the overhead of the debugger as a
+    flat ``dict``, with all times in seconds:
+
+        - ``collecting``: whether they are being collected
+        - ``seconds``: how long they were collected for
+        - ``trace_events``, ``trace_events.<event>``: the count of trace
+          events handled by the debugger, in total and by kind
+        - ``trace_time``: the time spent handling them, not counting the time
+          threads were stopped in the debugger
+        - ``should_debug_code_calls``: how many times the debugger checked
+          whether code should be debugged
+        - ``messages_sent``, ``messages_sent.<type>``, ``bytes_sent``,
+          ``bytes_sent.<type>``: the messages and bytes sent to the debugger,
+          in total and by message type
+        - ``sends``: the count of writes to the debugger connection
+        - ``send_lock_acquires``, ``send_lock_time``: how many times the lock
+          serializing them was taken, and the time spent waiting for it
+        - ``evaluations``, ``evaluation_timeouts``, ``evaluation_time``,
+          ``max_evaluation_time``: the evaluations of expressions, reprs and
+          attributes for the debugger, how many ran out of time, and their
+          total and longest duration
+
+    Nothing is collected until enable_stats is called, or an attached
+    debugger asks for it.
+    """
+    return vspd.STATS.get()
+
+
+def can_sample():
+    return hasattr(sys, '_current_frames')
+
+
+class Sampler(object):
+    """collects the stacks of all threads at a fixed interval using sys._current_frames, and counts how
+    many times each was seen in folded form"""
+
+    def __init__(self, interval, max_stacks = SAMPLER_MAX_STACKS, max_depth = SAMPLER_MAX_DEPTH, max_names = SAMPLER_MAX_NAMES):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.max_names = max_names
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.samples = 0
+        self.dropped = 0
+        # maps each code object seen to its name in folded stacks, or None if it is code of the debugger
+        self.names = {}
+
+    def get_name(self, code):
+        if vspd.is_debugger_file(code.co_filename):
+            name = None
+        else:
+            name = '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+        self.names[code] = name
+        return name
+
+    def sample(self):
+        names = self.names
+        if len(names) >= self.max_names:
+            # the names of the code in the stacks kept so far are computed again when they are needed
+            names.clear()
+        counts = self.counts
+        max_depth = self.max_depth
+        skip = (thread.get_ident(), _server_thread_id)
+        for ident, frame in sys._current_frames().items():
+            if ident in skip:
+                continue
+            stack = []
+            while frame is not None and len(stack) < max_depth:
+                code = frame.f_code
+                name = names.get(code, '')
+                if name == '':
+                    name = self.get_name(code)
+                if name is not None:
+                    stack.append(code)
+                frame = frame.f_back
+            # the threads started by the debugger have nothing left
+            if stack:
+                key = tuple(stack)
+                if key in counts:
+                    counts[key] += 1
+                elif len(counts) < self.max_stacks:
+                    counts[key] = 1
+                else:
+                    self.dropped += 1
+        self.samples += 1
+
+    def snapshot(self):
+        """returns the count of samples, the count of dropped stacks, and a list of the folded stacks and
+        their counts since the last snapshot, and starts over"""
+        names = self.names
+        get_name = self.get_name
+        stacks = [(';'.join([names.get(code) or get_name(code) for code in reversed(key)]), count) for key, count in self.counts.items()]
+        samples, dropped = self.samples, self.dropped
+        self.reset()
+        return samples, dropped, stacks
+
+    def run(self, duration, period, report):
+        """samples for duration seconds (or forever if it is zero), passing a snapshot to report every period
+        seconds (if given) and once more at the end"""
+        interval = self.interval
+        start = time.time()
+        end = duration and start + duration
+        next_report = period and start + period
+        ticks = 0
+        while True:
+            self.sample()
+            now = time.time()
+            if end and now >= end:
+                break
+            if next_report and now >= next_report:
+                report(self.snapshot())
+                next_report = now + period
+                now = time.time()
+            # skip the ticks that were missed rather than sampling in a burst to catch up
+            ticks = max(ticks + 1, int((now - start) / interval))
+            delay = start + ticks * interval - now
+            if delay > 0:
+                time.sleep(delay)
+        report(self.snapshot())
+
+
+def sample_to_client(sampler, client, duration, period):
+    def report(snapshot):
+        samples, dropped, stacks = snapshot
+        msg = MessageWriter()
+        msg.write_bytes(SMPL)
+        msg.write_int(samples)
+        msg.write_int(dropped)
+        msg.write_int(len(stacks))
+        for stack, count in stacks:
+            msg.write_string(stack)
+            msg.write_int(count)
+        msg.send(client)
+
+    try:
+        sampler.run(duration, period, report)
+    except (socket.error, OSError):
+        # the client went away
+        pass
+    finally:
+        client.close()
+
+
+def sample_to_file(filename, interval = 0.01, duration = 10.0, wait = False):
+    """Samples the stacks of all threads, and writes how many times each was
+    seen to a file, without needing a debugger to connect or installing a trace
+    function.
+
+    Parameters
+    ----------
+    filename : str
+        The file to write the stacks to once sampling is done, one per line in
+        the folded format understood by flame graph tools: the functions from
+        the outermost to the innermost separated by ``';'``, followed by a
+        space and the number of times the stack was seen.
+    interval : float, optional
+        The time between samples in seconds, which must be positive. Default
+        is ``0.01``.
+    duration : float, optional
+        How long to sample for in seconds, which must be positive. Default is
+        ``10.0``.
+    wait : bool, optional
+        Specifies whether to sample on the calling thread, and only return once
+        the file is written. Otherwise, sampling is done on a new thread, and
+        this function returns immediately. Default is ``False``.
+    """
+    if not can_sample():
+        raise ValueError('sampling is not supported on this version of Python')
+    if interval <= 0 or duration <= 0:
+        raise ValueError('interval and duration must be positive')
+
+    def report(snapshot):
+        samples, dropped, stacks = snapshot
+        stacks.sort(key = lambda stack: -stack[1])
+        with open(filename, 'w') as f:
+            for stack, count in stacks:
+                f.write('%s %d\n' % (stack, count))
+
+    sampler = Sampler(interval)
+    if wait:
+        sampler.run(duration, None, report)
+    else:
+        vspd._start_new_thread(sampler.run, (duration, None, report))
@@ -24,7 +24,12 @@ import struct
 import weakref
 import traceback
 import types
+import ast
 import bisect
+import dis
+import time
+from collections import deque
+from itertools import islice
 from os import path
 import ntpath
 import runpy
@@ -49,6 +54,7 @@ read_string = _vspu.read_string
 write_bytes = _vspu.write_bytes
 write_int = _vspu.write_int
 write_string = _vspu.write_string
+ConnectionReader = _vspu.ConnectionReader
 safe_repr = _vspu.SafeRepr()
 
 try:
@@ -66,6 +72,11 @@ try:
 except ImportError:
     stackless = None
 
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
 try:
     xrange
 except:
@@ -105,6 +116,45 @@ BREAK_ON_SYSTEMEXIT_ZERO = False
 DEBUG_STDLIB = False
 DJANGO_DEBUG = False
 
+# When set, threads are only traced while a debugger is attached - see trace_all_threads.
+TRACE_ONLY_WHEN_ATTACHED = False
+
+# When set, THRF carries no variables, and the debugger requests them for each frame with 'frmv' instead.
+# Set by the attach server if the client negotiated a protocol version that supports it.
+LAZY_FRAME_VARIABLES = False
+
+# When set, update_all_thread_stacks reports only what changed in each thread's stack since it was last
+# reported, with THRD. Set by the attach server if the client negotiated a protocol version that supports it.
+STACK_DELTAS = False
+
+# When set, the threads and modules that exist when the debugger attaches are reported with a single INVT
+# instead of a NEWT per thread and a MODL per module. Set by the attach server if the client negotiated a
+# protocol version that supports it.
+BULK_INVENTORY = False
+
+# The INVT payload is compressed with zlib (where available) if it is larger than this.
+INVENTORY_COMPRESS_SIZE = 16384
+INVENTORY_COMPRESSED = 1
+
+# When set, the counters and timers of STATS are updated - see collect_stats.
+COLLECT_STATS = False
+
+# actions of the 'stat' command
+STATS_REPORT = 0
+STATS_START = 1
+STATS_STOP = 2
+
+try:
+    stats_timer = time.perf_counter
+except AttributeError:
+    # time.clock is the precise one on Windows, but only measures CPU time elsewhere
+    stats_timer = time.clock if sys.platform == 'win32' else time.time
+
+# Code objects for the expressions evaluated by the debugger (e.g. watches, which are evaluated again on
+# every stop), by their text.
+COMPILED_EXPRESSIONS = {}
+MAX_COMPILED_EXPRESSIONS = 1000
+
 # Py3k compat - alias unicode to str
 try:
     unicode
@@ -126,25 +176,112 @@ class SynthesizedValue(object):
 DONT_DEBUG = [path.normcase(__file__), path.normcase(_vspu.__file__)]
 if sys.version_info >= (3, 3):
     DONT_DEBUG.append(path.normcase('<frozen importlib._bootstrap>'))
-# Contains information about all breakpoints in the process. Keys are line numbers on which
-# there are breakpoints in any file, and values are dicts. For every line number, the
-# corresponding dict contains all the breakpoints that fall on that line. The keys in that
-# dict are tuples of the form (filename, breakpoint_id), each entry representing a single
-# breakpoint, and values are BreakpointInfo objects.
-#
-# For example, given the following breakpoints:
-#
-#   1. In 'main.py' at line 10.
-#   2. In 'main.py' at line 20.
-#   3. In 'module.py' at line 10.
-#
-# the contents of BREAKPOINTS would be:
-# {10: {('main.py', 1): ..., ('module.py', 3): ...}, 20: {('main.py', 2): ... }}
-BREAKPOINTS = {}
-
-# Contains information about all pending (i.e. not yet bound) breakpoints in the process.
-# Elements are BreakpointInfo objects.
-PENDING_BREAKPOINTS = set()
+class BreakpointRegistry(object):
+    """Contains information about all breakpoints in the process, indexed by breakpoint ID, and by the
+    location at which they can be hit.
+
+    When a breakpoint is bound to a loaded module, its filename is updated to match co_filename of that
+    module, and only code with that exact co_filename can hit it. Bound breakpoints are indexed by
+    filename and then by line number:
+
+        {'/app/main.py': {10: {1: <BreakpointInfo>}, 20: {2: <BreakpointInfo>}}}
+
+    Pending (i.e. not yet bound) breakpoints keep the filename that VS gave them, which may be a path on
+    another machine, and are matched against co_filename using the relaxed breakpoint_path_match. They
+    are indexed by the lowercased file name without the directory, which must match for either binding
+    or relaxed matching to succeed:
+
+        {'module.py': {3: <BreakpointInfo>}}
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.bound = {}
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, breakpoint_id):
+        return self.by_id.get(breakpoint_id)
+
+    def add(self, bp):
+        old_bp = self.by_id.get(bp.breakpoint_id)
+        if old_bp is not None:
+            self.unindex(old_bp)
+        self.by_id[bp.breakpoint_id] = bp
+        if bp.is_bound:
+            lines = self.bound.setdefault(bp.filename, {})
+            lines.setdefault(bp.lineno, {})[bp.breakpoint_id] = bp
+        else:
+            self.pending.setdefault(ntpath.basename(bp.filename).lower(), {})[bp.breakpoint_id] = bp
+        breakpoints_changed()
+
+    def bind(self, bp, filename):
+        """binds the breakpoint to the module with the given co_filename"""
+        if self.by_id.get(bp.breakpoint_id) is bp:
+            self.unindex(bp)
+        bp.filename = filename
+        bp.is_bound = True
+        self.add(bp)
+
+    def remove(self, breakpoint_id):
+        bp = self.by_id.pop(breakpoint_id, None)
+        if bp is not None:
+            self.unindex(bp)
+            breakpoints_changed()
+        return bp
+
+    def unindex(self, bp):
+        if bp.is_bound:
+            lines = self.bound.get(bp.filename)
+            if lines is not None:
+                bps = lines.get(bp.lineno)
+                if bps is not None:
+                    bps.pop(bp.breakpoint_id, None)
+                    if not bps:
+                        del lines[bp.lineno]
+                if not lines:
+                    del self.bound[bp.filename]
+        else:
+            key = ntpath.basename(bp.filename).lower()
+            bps = self.pending.get(key)
+            if bps is not None:
+                bps.pop(bp.breakpoint_id, None)
+                if not bps:
+                    del self.pending[key]
+
+    def clear(self):
+        self.by_id.clear()
+        self.bound.clear()
+        self.pending.clear()
+        breakpoints_changed()
+
+    def get_pending(self, filename):
+        """returns the pending breakpoints that could be bound to, or hit in, the given file"""
+        bps = self.pending.get(path.basename(filename).lower())
+        if not bps:
+            return []
+        return list(bps.values())
+
+    def get_lines(self, filename):
+        """returns the set of lines that have breakpoints in code from the given co_filename"""
+        lines = set(self.bound.get(filename, ()))
+        for bp in self.get_pending(filename):
+            if bp.filename == filename or breakpoint_path_match(bp.filename, filename):
+                lines.add(bp.lineno)
+        return lines
+
+    def get_breakpoints(self, filename, lineno):
+        """returns the breakpoints on the given line of code from the given co_filename"""
+        bps = self.bound.get(filename, {}).get(lineno)
+        res = bps and list(bps.values()) or []
+        for bp in self.get_pending(filename):
+            if bp.lineno == lineno and (bp.filename == filename or breakpoint_path_match(bp.filename, filename)):
+                res.append(bp)
+        return res
+
+BREAKPOINTS = BreakpointRegistry()
 
 # Must be in sync with enum PythonBreakpointConditionKind in PythonBreakpoint.cs
 BREAKPOINT_CONDITION_ALWAYS = 0
@@ -160,8 +297,8 @@ BREAKPOINT_PASS_COUNT_WHEN_EQUAL_OR_GREATER = 3
 class BreakpointInfo(object):
     __slots__ = [
         'breakpoint_id', 'filename', 'lineno', 'condition_kind', 'condition',
-        'pass_count_kind', 'pass_count', 'is_bound', 'last_condition_value',
-        'hit_count'
+        'condition_code', 'condition_error', 'condition_error_reported', 'pass_count_kind', 'pass_count',
+        'is_bound', 'last_condition_value', 'hit_count', 'log_message', 'log_parts'
     ]
 
     # For "when changed" breakpoints, this is used as the initial value of last_condition_value,
@@ -172,21 +309,114 @@ class BreakpointInfo(object):
         self.breakpoint_id = breakpoint_id
         self.filename = filename
         self.lineno = lineno
-        self.condition_kind = condition_kind
-        self.condition = condition
+        self.set_condition(condition_kind, condition)
         self.pass_count_kind = pass_count_kind
         self.pass_count = pass_count
         self.is_bound = False
-        self.last_condition_value = BreakpointInfo._DUMMY_LAST_VALUE
         self.hit_count = 0
+        self.set_log_message(None)
+
+    def set_condition(self, condition_kind, condition):
+        """sets the condition, and compiles it once so that it doesn't need to be compiled on every hit"""
+        self.condition_kind = condition_kind
+        self.condition = condition
+        self.condition_code = None
+        self.condition_error = None
+        self.condition_error_reported = False
+        self.last_condition_value = BreakpointInfo._DUMMY_LAST_VALUE
+        if condition_kind != BREAKPOINT_CONDITION_ALWAYS:
+            try:
+                # eval() ignores leading whitespace in a string, but compile() does not
+                self.condition_code = compile(condition.lstrip(' \t'), '<breakpoint condition>', 'eval')
+            except:
+                self.condition_error = traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip()
+
+    def is_condition_met(self, frame):
+        """evaluates the compiled condition in the given frame, and returns whether the breakpoint is hit"""
+        if self.condition_kind == BREAKPOINT_CONDITION_ALWAYS:
+            return True
+        try:
+            res = eval(self.condition_code, frame.f_globals, frame.f_locals)
+            if self.condition_kind == BREAKPOINT_CONDITION_WHEN_CHANGED:
+                last_val = self.last_condition_value
+                self.last_condition_value = res
+                return not (last_val == res)
+            return bool(res)
+        except:
+            # If anything goes wrong while evaluating condition, breakpoint is hit.
+            return True
+
+    def set_log_message(self, message):
+        """makes this a logpoint, which logs the message as output of the thread that hit it instead of
+        breaking, or a regular breakpoint again if message is empty.  The {expr} placeholders in the
+        message are compiled once, like the condition."""
+        self.log_message = message or None
+        self.log_parts = None
+        if message:
+            self.log_parts = compile_log_message(message)
+
+    def format_log_message(self, frame):
+        """returns the log message with its placeholders replaced by the values they evaluate to in frame"""
+        parts = []
+        for text, code in self.log_parts:
+            if code is None:
+                parts.append(text)
+                continue
+            try:
+                parts.append(safe_repr(eval(code, frame.f_globals, frame.f_locals)))
+            except:
+                parts.append('<error: ' + traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip() + '>')
+        parts.append('\n')
+        return parts
 
     @staticmethod
     def find_by_id(breakpoint_id):
-        for line, bp_dict in BREAKPOINTS.items():
-            for (filename, bp_id), bp in bp_dict.items():
-                if bp_id == breakpoint_id:
-                    return bp
-        return None
+        return BREAKPOINTS.get(breakpoint_id)
+
+def compile_log_message(message):
+    """splits a logpoint message into (text, None) and (expression, code) parts.  {{ and }} stand for
+    literal braces, and braces can be nested in an expression.  An expression that doesn't compile is
+    replaced with the error."""
+    parts = []
+    text = []
+    i = 0
+    while i < len(message):
+        c = message[i]
+        if c in '{}' and message[i + 1:i + 2] == c:
+            text.append(c)
+            i += 2
+            continue
+        if c != '{':
+            text.append(c)
+            i += 1
+            continue
+
+        depth = 1
+        end = i + 1
+        while end < len(message) and depth:
+            if message[end] == '{':
+                depth += 1
+            elif message[end] == '}':
+                depth -= 1
+            end += 1
+        if depth:
+            # unmatched brace, the rest of the message is plain text
+            text.append(message[i:])
+            break
+
+        if text:
+            parts.append((''.join(text), None))
+            text = []
+        expr = message[i + 1:end - 1].strip()
+        try:
+            parts.append((expr, compile(expr, '<logpoint>', 'eval')))
+        except:
+            parts.append(('<error: ' + traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip() + '>', None))
+        i = end
+
+    if text:
+        parts.append((''.join(text), None))
+    return parts
 
 # lock for calling .send on the socket
 send_lock = thread.allocate_lock()
@@ -203,7 +433,13 @@ class _SendLockContextManager(object):
         if cur_thread is not None:
             cur_thread.is_sending = True
 
-        send_lock.acquire()
+        if COLLECT_STATS:
+            start = stats_timer()
+            send_lock.acquire()
+            STATS.send_lock_time += stats_timer() - start
+            STATS.send_lock_acquires += 1
+        else:
+            send_lock.acquire()
 
     def __exit__(self, exc_type, exc_value, tb):
         send_lock.release()
@@ -257,6 +493,12 @@ METHOD_TYPES = (
     type("".__repr__), # method-wrapper
 )
 
+# Items of these types can be retrieved by position in constant time, so a page of their children can be
+# reported without enumerating the items before it.
+SEQUENCE_TYPES = (list, tuple, type(xrange(0)), str, unicode)
+if sys.version[0] == '3':
+    SEQUENCE_TYPES += (bytes,)
+
 # repr() for these types can be used as input for eval() to get the original value.
 # float is intentionally not included because it is not always round-trippable (e.g inf, nan).
 TYPES_WITH_ROUND_TRIPPING_REPR = set((type(None), int, bool, str, unicode))
@@ -329,9 +571,36 @@ LOAD = to_bytes('LOAD')
 EXCE = to_bytes('EXCE')
 EXCR = to_bytes('EXCR')
 CHLD = to_bytes('CHLD')
+CHLP = to_bytes('CHLP')
 OUTP = to_bytes('OUTP')
 REQH = to_bytes('REQH')
 LAST = to_bytes('LAST')
+FRMV = to_bytes('FRMV')
+THRD = to_bytes('THRD')
+INVT = to_bytes('INVT')
+STAT = to_bytes('STAT')
+
+MESSAGE_TYPES = set((ASBR, SETL, THRF, DETC, NEWT, EXTT, EXIT, EXCP, MODL, STPD, BRKS, BRKF, BRKH, BRKC, BKHC,
+                     LOAD, EXCE, EXCR, CHLD, CHLP, OUTP, REQH, LAST, FRMV, THRD, INVT, STAT))
+
+class MessageWriter(_vspu.MessageWriter):
+    """MessageWriter which also notes where each message starts while stats are collected, so that the
+    messages and bytes sent can be counted by type"""
+
+    def __init__(self):
+        _vspu.MessageWriter.__init__(self)
+        self.starts = []    # [(offset, message type)]
+
+    def write_bytes(self, b):
+        if COLLECT_STATS and len(b) == 4 and isinstance(b, bytes) and b in MESSAGE_TYPES:
+            self.starts.append((len(self.buffer), b))
+        self.buffer += b
+
+    def send(self, conn):
+        if COLLECT_STATS:
+            STATS.count_sent(len(self.buffer), self.starts)
+        del self.starts[:]
+        _vspu.MessageWriter.send(self, conn)
 
 def get_thread_from_id(id):
     THREADS_LOCK.acquire()
@@ -343,7 +612,7 @@ def get_thread_from_id(id):
 def should_send_frame(frame):
     return (frame is not None and
             frame.f_code not in DEBUG_ENTRYPOINTS and
-            path.normcase(frame.f_code.co_filename) not in DONT_DEBUG)
+            CODE_VERDICTS.should_send_file(frame.f_code.co_filename))
 
 KNOWN_DIRECTORIES = set((None, ''))
 KNOWN_ZIPS = set()
@@ -406,10 +675,14 @@ class ExceptionBreakInfo(object):
         path.normcase('build\\bdist.win-amd64\\egg\\pkg_resources.py'): ((None, None, '*'),),
     }
 
+    max_cached_types = 1000
+
     def __init__(self):
         self.default_mode = BREAK_MODE_UNHANDLED
         self.break_on = { }
+        self.mode_cache = { }
         self.handler_cache = dict(self.BUILT_IN_HANDLERS)
+        self.handler_mtimes = {}
         self.handler_lock = thread.allocate_lock()
         self.add_exception('exceptions.IndexError', BREAK_MODE_NEVER)
         self.add_exception('builtins.IndexError', BREAK_MODE_NEVER)
@@ -422,15 +695,28 @@ class ExceptionBreakInfo(object):
         self.add_exception('exceptions.GeneratorExit', BREAK_MODE_NEVER)
         self.add_exception('builtins.GeneratorExit', BREAK_MODE_NEVER)
 
-    def clear(self):
-        self.default_mode = BREAK_MODE_UNHANDLED
+    def clear(self, default_mode=BREAK_MODE_UNHANDLED):
+        self.default_mode = default_mode
         self.break_on.clear()
+        self.mode_cache = { }
         self.handler_cache = dict(self.BUILT_IN_HANDLERS)
+        self.handler_mtimes = {}
+
+    def get_mode(self, ex_type):
+        mode = self.mode_cache.get(ex_type)
+        if mode is None:
+            mode = self.break_on.get(get_exception_name(ex_type), self.default_mode)
+            mode_cache = self.mode_cache
+            if len(mode_cache) < self.max_cached_types:
+                mode_cache[ex_type] = mode
+        return mode
 
     def should_break(self, thread, ex_type, ex_value, trace):
+        mode = self.get_mode(ex_type)
+        if mode == BREAK_MODE_NEVER:
+            return BREAK_TYPE_NONE
+
         probe_stack()
-        name = get_exception_name(ex_type)
-        mode = self.break_on.get(name, self.default_mode)
         break_type = BREAK_TYPE_NONE
         if mode & BREAK_MODE_ALWAYS:
             if self.is_handled(thread, ex_type, ex_value, trace):
@@ -459,25 +745,70 @@ class ExceptionBreakInfo(object):
             # don't break if this is not the top of the traceback,
             # unless the previous frame was not debuggable
             return True
+          handled = self.get_handled_exception(thread, ex_value, trace)
+          if handled is not None:
+            return handled
+
+        handler_frame = self.find_handler(ex_type, trace.tb_frame)
+
+        # remember the traceback entry and the frame of the handler, so that the frames this exception
+        # unwinds through next can reuse the result rather than searching for handlers again
+        if handler_frame is None:
+            thread.handled_exception = (id(ex_value), id(trace), None, None)
+        else:
+            thread.handled_exception = (id(ex_value), id(trace), id(handler_frame), handler_frame.f_code)
+        return handler_frame is not None
+
+    def get_handled_exception(self, thread, ex_value, trace):
+        """returns the result of is_handled for ex_value if it was already computed for a frame
+        the exception has unwound from, and still holds, or None if it wasn't."""
+        handled_exception = thread.handled_exception
+        if handled_exception is None or handled_exception[0] != id(ex_value):
+            return None
+
+        trace_id = handled_exception[1]
+        cur_trace = trace.tb_next
+        while cur_trace is not None and id(cur_trace) != trace_id:
+            cur_trace = cur_trace.tb_next
+        if cur_trace is None:
+            return None
 
+        handler_frame_id, handler_code = handled_exception[2:]
+        if handler_frame_id is None:
+            # no handler was found in that frame or any of its callers, which include this frame
+            return False
+
+        # the handler only still applies if the exception hasn't left its frame yet (it may have been
+        # raised again from the handler itself); frames are compared by code as well as by id, since
+        # the id of a frame that is gone can be reused
         cur_frame = trace.tb_frame
+        while cur_frame is not None:
+            if id(cur_frame) == handler_frame_id and cur_frame.f_code is handler_code:
+                return True
+            cur_frame = cur_frame.f_back
+        return None
 
+    def find_handler(self, ex_type, cur_frame):
+        """returns the frame whose handler would catch an exception of ex_type raised in cur_frame, or
+        None if there is none."""
         while should_send_frame(cur_frame) and cur_frame.f_code is not None and cur_frame.f_code.co_filename is not None:
             filename = path.normcase(cur_frame.f_code.co_filename)
             if is_file_in_zip(filename):
                 # File is in a zip, so assume it handles exceptions
-                return True
+                return cur_frame
 
             if not is_same_py_file(filename, __file__):
-                handlers = self.handler_cache.get(filename)
+                handlers = self.get_handlers(filename)
 
                 if handlers is None:
-                    # req handlers for this file from the debug engine
+                    # source isn't available locally, req handlers for this file from the debug engine
                     self.handler_lock.acquire()
 
+                    msg = MessageWriter()
+                    msg.write_bytes(REQH)
+                    msg.write_string(filename)
                     with _SendLockCtx:
-                        write_bytes(conn, REQH)
-                        write_string(conn, filename)
+                        msg.send(conn)
 
                     # wait for the handler data to be received
                     self.handler_lock.acquire()
@@ -487,33 +818,111 @@ class ExceptionBreakInfo(object):
 
                 if handlers is None:
                     # no code available, so assume unhandled
-                    return False
+                    return None
 
                 line = cur_frame.f_lineno
                 for line_start, line_end, expressions in handlers:
                     if line_start is None or line_start <= line < line_end:
                         if '*' in expressions:
-                            return True
+                            return cur_frame
 
                         for text in expressions:
                             try:
                                 res = lookup_local(cur_frame, text)
                                 if res is not None and issubclass(ex_type, res):
-                                    return True
+                                    return cur_frame
                             except:
                                 pass
 
             cur_frame = cur_frame.f_back
 
-        return False
+        return None
+
+    def get_handlers(self, filename):
+        """returns the handlers for filename from the cache, analyzing the source locally if it
+        isn't cached yet or has changed since it was analyzed.  Returns None if neither worked, in
+        which case the debug engine has to be asked for them."""
+        mtime = self.handler_mtimes.get(filename)
+        if mtime is None:
+            handlers = self.handler_cache.get(filename)
+            if handlers is not None:
+                return handlers
+        try:
+            cur_mtime = path.getmtime(filename)
+        except:
+            return self.handler_cache.get(filename)
+
+        if mtime == cur_mtime:
+            return self.handler_cache[filename]
+
+        handlers = get_handler_ranges(filename)
+        if handlers is not None:
+            self.handler_cache[filename] = handlers
+            self.handler_mtimes[filename] = cur_mtime
+        return handlers
 
     def add_exception(self, name, mode=BREAK_MODE_UNHANDLED):
         if name.startswith(_EXCEPTIONS_MODULE + '.'):
             name = name[len(_EXCEPTIONS_MODULE) + 1:]
         self.break_on[name] = mode
+        self.mode_cache = { }
 
 BREAK_ON = ExceptionBreakInfo()
 
+if sys.version_info[0] >= 3:
+    _TRY_NODES = tuple(getattr(ast, name) for name in ('Try', 'TryStar') if hasattr(ast, name))
+else:
+    _TRY_NODES = (ast.TryExcept, )
+
+def get_dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        prefix = get_dotted_name(node.value)
+        if prefix is not None:
+            return prefix + '.' + node.attr
+    return None
+
+def get_end_lineno(node):
+    end_lineno = getattr(node, 'end_lineno', None)
+    if end_lineno is None:
+        end_lineno = max(getattr(child, 'lineno', 0) for child in ast.walk(node))
+    return end_lineno
+
+def get_handler_ranges(filename):
+    """computes the (line_start, line_end, expressions) tuples for the try/except statements in
+    filename the same way the debug engine does for REQH.  Returns None if the source can't be
+    read or parsed."""
+    try:
+        with open(filename, 'rb') as f:
+            tree = ast.parse(f.read(), filename)
+    except:
+        return None
+
+    handlers = []
+    for node in ast.walk(tree):
+        if not isinstance(node, _TRY_NODES) or not node.handlers:
+            # try/finally without an except doesn't handle anything
+            continue
+
+        expressions = set()
+        for handler in node.handlers:
+            if handler.type is None:
+                expressions = set('*')
+                break
+            elif isinstance(handler.type, ast.Tuple):
+                items = handler.type.elts
+            else:
+                items = (handler.type, )
+            for item in items:
+                text = get_dotted_name(item)
+                if text is not None:
+                    expressions.add(text)
+
+        if expressions:
+            handlers.append((node.lineno, get_end_lineno(node.body[-1]) + 1, expressions))
+    return handlers
+
 def probe_stack(depth = 10):
   """helper to make sure we have enough stack space to proceed w/o corrupting 
      debugger state."""
@@ -528,19 +937,79 @@ if hasattr(sys, 'base_prefix'):
 if hasattr(sys, 'real_prefix'):
     PREFIXES.append(path.normcase(sys.real_prefix))
 
+class CodeVerdictCache(object):
+    """Caches the per-file verdicts of should_debug_code, should_send_frame and is_debugger_file, which
+    are needed for every traced frame, by co_filename. The cached verdicts are dropped whenever
+    DEBUG_STDLIB or DONT_DEBUG change. DONT_DEBUG is only ever appended to, so checking its length
+    is enough to detect that."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.debug_stdlib = DEBUG_STDLIB
+        self.dont_debug_count = len(DONT_DEBUG)
+        self.debug_file = {}
+        self.send_file = {}
+        self.debugger_file = {}
+
+    def validate(self):
+        if self.debug_stdlib is not DEBUG_STDLIB or self.dont_debug_count != len(DONT_DEBUG):
+            self.clear()
+
+    def get(self, verdicts, filename, compute):
+        res = verdicts.get(filename)
+        if res is None:
+            self.misses += 1
+            res = verdicts[filename] = compute(filename)
+        else:
+            self.hits += 1
+        return res
+
+    def should_debug_file(self, filename):
+        self.validate()
+        return self.get(self.debug_file, filename, should_debug_file)
+
+    def should_send_file(self, filename):
+        self.validate()
+        return self.get(self.send_file, filename, should_send_file)
+
+    def is_debugger_file(self, filename):
+        self.validate()
+        return self.get(self.debugger_file, filename, is_debugger_file)
+
+CODE_VERDICTS = CodeVerdictCache()
+
 def should_debug_code(code):
+    if COLLECT_STATS:
+        STATS.should_debug_code_calls += 1
     if not code or not code.co_filename:
         return False
+    return CODE_VERDICTS.should_debug_file(code.co_filename)
 
-    filename = path.normcase(code.co_filename)
+def is_debugger_file(filename):
+    """returns True if the file is part of the debugger, or of some other code that registered itself
+    in DONT_DEBUG"""
+    filename = path.normcase(filename)
+    for dont_debug_file in DONT_DEBUG:
+        if is_same_py_file(filename, dont_debug_file):
+            return True
+    return False
+
+def should_send_file(filename):
+    return path.normcase(filename) not in DONT_DEBUG
+
+def should_debug_file(filename):
+    filename = path.normcase(filename)
     if not DEBUG_STDLIB:
         for prefix in PREFIXES:
             if filename.startswith(prefix):
                 return False
 
-    for dont_debug_file in DONT_DEBUG:
-        if is_same_py_file(filename, dont_debug_file):
-            return False
+    if is_debugger_file(filename):
+        return False
 
     if is_file_in_zip(filename):
         # file in inside an egg or zip, so we can't debug it
@@ -551,14 +1020,27 @@ def should_debug_code(code):
 attach_lock = thread.allocate()
 attach_sent_break = False
 
-local_path_to_vs_path = {}
+# Results of breakpoint_path_match by (vs_path, local_path), both positive and negative, and whether each
+# local directory is a package (i.e. has an __init__.py). Loading a new module may add packages that change
+# the outcome, so new_module drops both, along with the lines of pending breakpoints that were derived from
+# them.
+PATH_MATCHES = {}
+PACKAGE_DIRS = {}
+
+def is_package_dir(dirname):
+    res = PACKAGE_DIRS.get(dirname)
+    if res is None:
+        res = PACKAGE_DIRS[dirname] = path.exists(path.join(dirname, '__init__.py'))
+    return res
 
 def breakpoint_path_match(vs_path, local_path):
-    vs_path_norm = path.normcase(vs_path)
-    local_path_norm = path.normcase(local_path)
-    if local_path_to_vs_path.get(local_path_norm) == vs_path_norm:
-        return True
+    key = (vs_path, local_path)
+    res = PATH_MATCHES.get(key)
+    if res is None:
+        res = PATH_MATCHES[key] = match_breakpoint_path(vs_path, local_path)
+    return res
 
+def match_breakpoint_path(vs_path, local_path):
     # Walk the local filesystem from local_path up, matching agains win_path component by component,
     # and stop when we no longer see an __init__.py. This should give a reasonably close approximation
     # of matching the package name.
@@ -572,17 +1054,107 @@ def breakpoint_path_match(vs_path, local_path):
         # If we have an __init__.py, this module was inside the package, and we still need to match
         # thatpackage, so walk up one level and keep matching. Otherwise, we've walked as far as we
         # needed to, and matched all names on our way, so this is a match.
-        if not path.exists(path.join(local_path, '__init__.py')):
+        if not is_package_dir(local_path):
             break
 
-    local_path_to_vs_path[local_path_norm] = vs_path_norm
     return True
 
+# Lines that have breakpoints by co_filename, and whether code objects from those files contain any of
+# them. Both are filled lazily, and replaced with empty ones by breakpoints_changed.
+BREAKPOINT_LINES = {}
+CODE_HAS_BREAKPOINTS = {}
+
+def get_breakpoint_lines(filename):
+    """returns the set of lines that have breakpoints in code from the given co_filename"""
+    cache = BREAKPOINT_LINES
+    lines = cache.get(filename)
+    if lines is None:
+        lines = cache[filename] = BREAKPOINTS.get_lines(filename)
+    return lines
+
+def get_code_lines(code):
+    """returns the set of line numbers in the line table of the code object"""
+    try:
+        co_lines = code.co_lines
+    except AttributeError:
+        return set(line for _, line in dis.findlinestarts(code))
+    return set(line for _, _, line in co_lines() if line is not None)
+
+def get_code_last_line(code):
+    """returns the last line number in the line table of the code object"""
+    try:
+        lines = get_code_lines(code)
+    except:
+        try:
+            return code.Span.End.Line
+        except:
+            return -1
+    if not lines:
+        return code.co_firstlineno
+    return max(lines)
+
+# (first line, last line, absolute filename) of the code objects of reported frames, by code object.
+CODE_INFO = {}
+MAX_CODE_INFO = 10000
+
+def get_code_info(code):
+    """returns the first and last line numbers of the code object, and its absolute filename"""
+    info = CODE_INFO.get(code)
+    if info is None:
+        if len(CODE_INFO) >= MAX_CODE_INFO:
+            CODE_INFO.clear()
+        info = CODE_INFO[code] = (code.co_firstlineno, get_code_last_line(code), get_code_filename(code))
+    return info
+
+def code_has_breakpoints(code):
+    """returns True if any line of the code object (not including nested functions) has a breakpoint"""
+    if not BREAKPOINTS:
+        return False
+    lines = get_breakpoint_lines(code.co_filename)
+    if not lines:
+        return False
+    cache = CODE_HAS_BREAKPOINTS
+    res = cache.get(code)
+    if res is None:
+        res = cache[code] = not lines.isdisjoint(get_code_lines(code))
+    return res
+
+def breakpoints_changed():
+    global BREAKPOINT_LINES, CODE_HAS_BREAKPOINTS
+    BREAKPOINT_LINES = {}
+    CODE_HAS_BREAKPOINTS = {}
+    TRACE_ENGINE.breakpoints_changed()
+
+try:
+    # Python 3.7+ can turn off line events for a frame, while still getting return and exception events.
+    CAN_DISABLE_LINE_EVENTS = hasattr(sys._getframe(), 'f_trace_lines')
+except:
+    CAN_DISABLE_LINE_EVENTS = False
+
+def enable_line_events(thread_filter = None, code_filter = None):
+    """turns line events back on for the running frames that had them turned off by Thread.handle_call"""
+    frames = sys._current_frames()
+    THREADS_LOCK.acquire()
+    all_threads = list(THREADS.values())
+    THREADS_LOCK.release()
+
+    for cur_thread in all_threads:
+        if thread_filter is not None and not thread_filter(cur_thread):
+            continue
+        frame = frames.get(cur_thread.id)
+        while frame is not None:
+            if (frame.f_trace is cur_thread.trace_func and not frame.f_trace_lines and
+                (code_filter is None or code_filter(frame.f_code))):
+                frame.f_trace_lines = True
+            frame = frame.f_back
+
 def update_all_thread_stacks(blocking_thread = None, check_is_blocked = True):
     THREADS_LOCK.acquire()
     all_threads = list(THREADS.values())
     THREADS_LOCK.release()
 
+    TRACE_ENGINE.sync_frames(all_threads)
+
     for cur_thread in all_threads:
         if cur_thread is blocking_thread:
             continue
@@ -592,13 +1164,17 @@ def update_all_thread_stacks(blocking_thread = None, check_is_blocked = True):
             # release the lock, we're going to run user code to evaluate the frames
             cur_thread._block_starting_lock.release()        
 
-            frames = cur_thread.get_frame_list()
+            frame_ids = []
+            frames = cur_thread.get_frame_list(frame_ids)
 
             # re-acquire the lock and make sure we're still not blocked.  If so send
             # the frame list.
             cur_thread._block_starting_lock.acquire()
             if not check_is_blocked or not cur_thread._is_blocked:
-                cur_thread.send_frame_list(frames)
+                if STACK_DELTAS:
+                    cur_thread.send_frame_delta(frames, frame_ids)
+                else:
+                    cur_thread.send_frame_list(frames)
 
         cur_thread._block_starting_lock.release()
 
@@ -679,35 +1255,37 @@ class ModuleExitFrame(object):
         return getattr(self.real_frame, name)
 
 class Thread(object):
+    # Attributes which are rarely changed from their defaults are kept on the class, so that threads which
+    # never stop don't pay for them.
+    stopped_on_line = None
+    detach = False
+    prev_trace_func = None
+    reported = False
+    reported_process_loaded = False
+    django_stepping = None
+    is_sending = False
+    sent_frames = None
+    sent_frames_conn = None
+    handled_exception = None
+    timing_trace = False
+    blocked_time = 0.0
+
     def __init__(self, id = None):
         if id is not None:
             self.id = id 
         else:
             self.id = thread.get_ident()
-        self._events = {'call' : self.handle_call, 
-                        'line' : self.handle_line, 
-                        'return' : self.handle_return, 
-                        'exception' : self.handle_exception,
-                        'c_call' : self.handle_c_call,
-                        'c_return' : self.handle_c_return,
-                        'c_exception' : self.handle_c_exception,
-                       }
         self.cur_frame = None
         self.stepping = STEPPING_NONE
-        self.unblock_work = None
+        self.work_queue = deque()
         self._block_lock = thread.allocate_lock()
         self._block_lock.acquire()
         self._block_starting_lock = thread.allocate_lock()
         self._is_blocked = False
         self._is_working = False
-        self.stopped_on_line = None
-        self.detach = False
         self.trace_func = self.trace_func # replace self.trace_func w/ a bound method so we don't need to re-create these regularly
-        self.prev_trace_func = None
         self.trace_func_stack = []
-        self.reported_process_loaded = False
-        self.django_stepping = None
-        self.is_sending = False
+        self.child_enums = {}
 
         # stackless changes
         if stackless is not None:
@@ -773,6 +1351,8 @@ class Thread(object):
         # If we're so far into process shutdown that sys is already gone, just stop tracing.
         if sys is None:
             return None
+        elif COLLECT_STATS and not self.timing_trace:
+            return STATS.trace(self, frame, event, arg)
         elif self.is_sending:
             # https://pytools.codeplex.com/workitem/1864 
             # we're currently doing I/O w/ the socket, we don't want to deliver
@@ -803,7 +1383,7 @@ class Thread(object):
 
                 self.async_break()
 
-            return self._events[event](frame, arg)
+            return self._events[event](self, frame, arg)
         except (StackOverflowException, KeyboardInterrupt):
             # stack overflow, disable tracing
             return self.trace_func
@@ -836,11 +1416,10 @@ class Thread(object):
                 report_module_load(module)
 
                 # see if this module causes new break points to be bound
-                bound = set()
-                for pending_bp in PENDING_BREAKPOINTS:
-                    if try_bind_break_point(code.co_filename, module, pending_bp):
-                        bound.add(pending_bp)
-                PENDING_BREAKPOINTS.difference_update(bound)
+                for pending_bp in BREAKPOINTS.get_pending(module.filename):
+                    # skip breakpoints that were removed while we were looking
+                    if BREAKPOINTS.get(pending_bp.breakpoint_id) is pending_bp:
+                        try_bind_break_point(code.co_filename, module, pending_bp)
 
         stepping = self.stepping
         if stepping is not STEPPING_NONE and should_debug_code(frame.f_code):
@@ -869,6 +1448,20 @@ class Thread(object):
             self.prev_trace_func = None  # clear first incase old_trace_func stack overflows
             self.prev_trace_func = old_trace_func(frame, 'call', arg)
 
+        if CAN_DISABLE_LINE_EVENTS:
+            # Nothing can stop on a line of this frame if the thread isn't stepping, if the frame was called
+            # below the one being stepped over or out of, or if it isn't user code, so skip its line events.
+            # Stepping over a call then only costs the call and return events of the callee frames, which
+            # keep the stepping depth. The frame is still traced for return and exception events, and gets
+            # line events back when a thread starts stepping or a breakpoint is added to it - see
+            # enable_line_events. This is set on every call, since a resumed generator keeps its frame.
+            stepping = self.stepping
+            frame.f_trace_lines = bool(
+                self.django_stepping or self.prev_trace_func is not None or
+                (stepping != STEPPING_NONE and STEPPING_OUT <= stepping <= STEPPING_OVER and
+                 (stepping not in USER_STEPPING or should_debug_code(frame.f_code))) or
+                code_has_breakpoints(frame.f_code))
+
         return self.trace_func
 
     def should_block_on_frame(self, frame):
@@ -885,13 +1478,10 @@ class Thread(object):
             if frame.f_code in DEBUG_ENTRYPOINTS:
                 break
             # Otherwise, check if it's some other debugger code.
-            filename = path.normcase(frame.f_code.co_filename)
-            is_debugger_frame = False
-            for debugger_file in DONT_DEBUG:
-                if is_same_py_file(filename, debugger_file):
-                    # If it is, then the frames above it on the stack that we have just walked through
-                    # were for debugger internal purposes, and we do not want to block here.
-                    return False
+            if CODE_VERDICTS.is_debugger_file(frame.f_code.co_filename):
+                # If it is, then the frames above it on the stack that we have just walked through
+                # were for debugger internal purposes, and we do not want to block here.
+                return False
             frame = frame.f_back
         return True
 
@@ -914,65 +1504,49 @@ class Thread(object):
 
             # handle breakpoints
             hit_bp_id = None
-            if BREAKPOINTS and handle_breakpoints:
-                bp = BREAKPOINTS.get(frame.f_lineno)
-                if bp is not None:
-                    for (filename, bp_id), bp in bp.items():
-                        if filename != frame.f_code.co_filename:
-                            # When the breakpoint is bound, the filename is updated to match co_filename of
-                            # the module to which it was bound, so only exact matches are considered hits.
-                            if bp.is_bound:
+            if BREAKPOINTS and handle_breakpoints and frame.f_lineno in get_breakpoint_lines(frame.f_code.co_filename):
+                for bp in BREAKPOINTS.get_breakpoints(frame.f_code.co_filename, frame.f_lineno):
+                    bp_id = bp.breakpoint_id
+
+                    # Check condition to see if we actually hit this breakpoint.
+                    if bp.condition_kind != BREAKPOINT_CONDITION_ALWAYS:
+                        if bp.condition_code is None:
+                            # The condition could not be compiled, so like a condition that fails to
+                            # evaluate, the breakpoint is hit. Report why, unless that was done already.
+                            if not bp.condition_error_reported:
+                                report_breakpoint_condition_error(bp, self.id)
+                        elif not bp.is_condition_met(frame):
+                            continue
+
+                    # If we got here, then condition matched, and we need to update the hit count
+                    # (even if we don't end up signaling the breakpoint because of pass count).
+                    bp.hit_count += 1
+
+                    # Check the new hit count against pass count.
+                    if bp.pass_count_kind != BREAKPOINT_PASS_COUNT_ALWAYS:
+                        pass_count_kind = bp.pass_count_kind
+                        pass_count = bp.pass_count
+                        hit_count = bp.hit_count
+                        if pass_count_kind == BREAKPOINT_PASS_COUNT_EVERY:
+                            if (hit_count % pass_count) != 0:
                                 continue
-                            # Otherwise, use relaxed path check that tries to handle differences between 
-                            # local and remote filesystems for remote scenarios:
-                            if not breakpoint_path_match(filename, frame.f_code.co_filename):
+                        elif pass_count_kind == BREAKPOINT_PASS_COUNT_WHEN_EQUAL:
+                            if hit_count != pass_count:
+                                continue
+                        elif pass_count_kind == BREAKPOINT_PASS_COUNT_WHEN_EQUAL_OR_GREATER:
+                            if hit_count < pass_count:
                                 continue
 
-                        # If we got here, filename and line number both match.
-
-                        # Check condition to see if we actually hit this breakpoint.
-                        if bp.condition_kind != BREAKPOINT_CONDITION_ALWAYS:
-                            try:
-                                res = eval(bp.condition, frame.f_globals, frame.f_locals)
-                                if bp.condition_kind == BREAKPOINT_CONDITION_WHEN_CHANGED:
-                                    last_val = bp.last_condition_value
-                                    bp.last_condition_value = res
-                                    if last_val == res:
-                                        # Condition didn't change, breakpoint not hit.
-                                        continue
-                                else:
-                                    if not res:
-                                        # Condition isn't true, breakpoint not hit.
-                                        continue
-                            except:
-                                # If anything goes wrong while evaluating condition, breakpoint is hit.
-                                pass
+                    # If we got here, then condition and pass count both match. Logpoints only log
+                    # their message, without stopping any threads; other breakpoints notify VS.
+                    if bp.log_parts is not None:
+                        self.write_log_message(bp, frame)
+                        continue
+                    hit_bp_id = bp_id
 
-                        # If we got here, then condition matched, and we need to update the hit count
-                        # (even if we don't end up signaling the breakpoint because of pass count).
-                        bp.hit_count += 1
-
-                        # Check the new hit count against pass count.
-                        if bp.pass_count_kind != BREAKPOINT_PASS_COUNT_ALWAYS:
-                            pass_count_kind = bp.pass_count_kind
-                            pass_count = bp.pass_count
-                            hit_count = bp.hit_count
-                            if pass_count_kind == BREAKPOINT_PASS_COUNT_EVERY:
-                                if (hit_count % pass_count) != 0:
-                                    continue
-                            elif pass_count_kind == BREAKPOINT_PASS_COUNT_WHEN_EQUAL:
-                                if hit_count != pass_count:
-                                    continue
-                            elif pass_count_kind == BREAKPOINT_PASS_COUNT_WHEN_EQUAL_OR_GREATER:
-                                if hit_count < pass_count:
-                                    continue
-
-                        # If we got here, then condition and pass count both match, so we should notify VS.
-                        hit_bp_id = bp_id
-
-                        # There may be other breakpoints for the same file/line, and we need to update
-                        # their hit counts, too, so keep looping. If more than one is hit, it's fine,
-                        # we will just signal the last one.
+                    # There may be other breakpoints for the same file/line, and we need to update
+                    # their hit counts, too, so keep looping. If more than one is hit, it's fine,
+                    # we will just signal the last one.
 
             if hit_bp_id is not None:
                 # handle case where both hitting a breakpoint and step complete by reporting the breakpoint
@@ -1047,6 +1621,15 @@ class Thread(object):
 
         return self.trace_func
 
+    def write_log_message(self, bp, frame):
+        parts = bp.format_log_message(frame)
+        try:
+            OUTPUT_PUMP.write(self.id, ''.join(parts))
+        except:
+            # mixed str and unicode which can't be combined, let the output pump send them as they are
+            for part in parts:
+                OUTPUT_PUMP.write(self.id, part)
+
     def handle_c_call(self, frame, arg):
         # break points?
         pass
@@ -1058,6 +1641,15 @@ class Thread(object):
     def handle_c_exception(self, frame, arg):
         pass
 
+    _events = {'call' : handle_call, 
+               'line' : handle_line, 
+               'return' : handle_return, 
+               'exception' : handle_exception,
+               'c_call' : handle_c_call,
+               'c_return' : handle_c_return,
+               'c_exception' : handle_c_exception,
+              }
+
     def block_maybe_attach(self):
         will_block_now = True
         if self.stepping == STEPPING_ATTACH_BREAK:
@@ -1094,8 +1686,10 @@ class Thread(object):
                     # multiple threads could be sending this...
                     SEND_BREAK_COMPLETE = False
                     sent_break_complete = True
-                    write_bytes(conn, ASBR)
-                    write_int(conn, self.id)
+                    msg = MessageWriter()
+                    msg.write_bytes(ASBR)
+                    msg.write_int(self.id)
+                    msg.send(conn)
 
             if sent_break_complete:
                 # if we have threads which have not broken yet capture their frame list and 
@@ -1109,9 +1703,12 @@ class Thread(object):
     def block(self, block_lambda, keep_stopped_on_line = False):
         """blocks the current thread until the debugger resumes it"""
         assert not self._is_blocked
+        if COLLECT_STATS:
+            start = stats_timer()
         #assert self.id == thread.get_ident(), 'wrong thread identity' + str(self.id) + ' ' + str(thread.get_ident())    # we should only ever block ourselves
 
-        # send thread frames before we block
+        # send any output written so far, and thread frames before we block
+        OUTPUT_PUMP.send()
         self.enum_thread_frames_locally()
 
         if not keep_stopped_on_line:
@@ -1125,20 +1722,33 @@ class Thread(object):
 
         while not DETACHED:
             self._block_lock.acquire()
-            if self.unblock_work is None:
+            if not self.work_queue:
                 break
 
-            # the debugger wants us to do something, do it, and then block again
-            self._is_working = True
-            self.unblock_work()
-            self.unblock_work = None
-            self._is_working = False
+            # the debugger wants us to do something, do it and anything queued up meanwhile, and then
+            # block again
+            while True:
+                work = self.work_queue.popleft()
+                work()
+                self._block_starting_lock.acquire()
+                if not self.work_queue:
+                    self._is_working = False
+                    self._block_starting_lock.release()
+                    break
+                self._block_starting_lock.release()
 
         self._block_starting_lock.acquire()
         assert self._is_blocked
         self._is_blocked = False
         self._block_starting_lock.release()
 
+        # the collections may change once we're running, so their iterators can't be reused
+        self.child_enums.clear()
+
+        if COLLECT_STATS:
+            # being stopped isn't overhead, so it's taken out of the time spent in the trace function
+            self.blocked_time += stats_timer() - start
+
     def unblock(self):
         """unblocks the current thread allowing it to continue to run"""
         assert self._is_blocked 
@@ -1147,42 +1757,72 @@ class Thread(object):
         self._block_lock.release()
 
     def schedule_work(self, work):
-        self.unblock_work = work
-        self.unblock()
+        """queues work to be done by the blocked thread, and wakes it up unless it's already working.
+        Must be called with _block_starting_lock held."""
+        self.work_queue.append(work)
+        if not self._is_working:
+            self._is_working = True
+            self.unblock()
 
     def run_on_thread(self, text, cur_frame, execution_id, frame_kind, repr_kind = PYTHON_EVALUATION_RESULT_REPR_KIND_NORMAL):
         self._block_starting_lock.acquire()
 
         if not self._is_blocked:
             report_execution_error('<expression cannot be evaluated at this time>', execution_id)
-        elif not self._is_working:
+        else:
             self.schedule_work(lambda : self.run_locally(text, cur_frame, execution_id, frame_kind, repr_kind))
+
+        self._block_starting_lock.release()
+
+    def run_batch_on_thread(self, expressions, cur_frame, frame_kind):
+        self._block_starting_lock.acquire()
+
+        if not self._is_blocked:
+            msg = MessageWriter()
+            for text, execution_id, repr_kind in expressions:
+                write_execution_error(msg, '<expression cannot be evaluated at this time>', execution_id)
+            with _SendLockCtx:
+                msg.send(conn)
         else:
-            report_execution_error('<error: previous evaluation has not completed>', execution_id)
+            self.schedule_work(lambda : self.run_batch_locally(expressions, cur_frame, frame_kind))
 
         self._block_starting_lock.release()
 
     def run_on_thread_no_report(self, text, cur_frame, frame_kind):
         self._block_starting_lock.acquire()
 
-        if not self._is_blocked:
-            pass
-        elif not self._is_working:
+        if self._is_blocked:
             self.schedule_work(lambda : self.run_locally_no_report(text, cur_frame, frame_kind))
-        else:
-            pass
 
         self._block_starting_lock.release()
 
     def enum_child_on_thread(self, text, cur_frame, execution_id, frame_kind):
         self._block_starting_lock.acquire()
-        if not self._is_working and self._is_blocked:
+        if self._is_blocked:
             self.schedule_work(lambda : self.enum_child_locally(text, cur_frame, execution_id, frame_kind))
             self._block_starting_lock.release()
         else:
             self._block_starting_lock.release()
             report_children(execution_id, [])
 
+    def enum_child_page_on_thread(self, text, cur_frame, execution_id, frame_kind, offset, count):
+        self._block_starting_lock.acquire()
+        if self._is_blocked:
+            self.schedule_work(lambda : self.enum_child_page_locally(text, cur_frame, execution_id, frame_kind, offset, count))
+            self._block_starting_lock.release()
+        else:
+            self._block_starting_lock.release()
+            report_children_page(execution_id, -1, [])
+
+    def enum_frame_variables_on_thread(self, cur_frame, execution_id):
+        self._block_starting_lock.acquire()
+        if self._is_blocked:
+            self.schedule_work(lambda : self.enum_frame_variables_locally(cur_frame, execution_id))
+            self._block_starting_lock.release()
+        else:
+            self._block_starting_lock.release()
+            report_frame_variables(execution_id, [])
+
     def get_locals(self, cur_frame, frame_kind):
         if frame_kind == FRAME_KIND_DJANGO:
             locs = {}
@@ -1206,25 +1846,54 @@ class Thread(object):
             pass
 
     def compile(self, text, cur_frame):
-        try:
-            code = compile(text, '<debug input>', 'eval')
-        except:
-            code = compile(text, '<debug input>', 'exec')
+        code = COMPILED_EXPRESSIONS.get(text)
+        if code is None:
+            try:
+                code = compile(text, '<debug input>', 'eval')
+            except:
+                code = compile(text, '<debug input>', 'exec')
+            if len(COMPILED_EXPRESSIONS) >= MAX_COMPILED_EXPRESSIONS:
+                COMPILED_EXPRESSIONS.clear()
+            COMPILED_EXPRESSIONS[text] = code
         return code
 
     def run_locally(self, text, cur_frame, execution_id, frame_kind, repr_kind = PYTHON_EVALUATION_RESULT_REPR_KIND_NORMAL):
         try:
             code = self.compile(text, cur_frame)
-            res = eval(code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
+            timed_out, res = EVALUATION_WATCHDOG.call(EVAL_TIMEOUT, eval, code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
             self.locals_to_fast(cur_frame)
             # Report any updated variable values first
             self.enum_thread_frames_locally()
-            report_execution_result(execution_id, res, repr_kind)
+            if timed_out:
+                report_execution_error(TIMED_OUT_REPR, execution_id)
+            else:
+                report_execution_result(execution_id, res, repr_kind)
         except:
             # Report any updated variable values first
             self.enum_thread_frames_locally()
             report_execution_exception(execution_id, sys.exc_info())
 
+    def run_batch_locally(self, expressions, cur_frame, frame_kind):
+        """evaluates each (text, execution id, repr kind) in the frame, and sends all results at once"""
+        msg = MessageWriter()
+        cur_locals = self.get_locals(cur_frame, frame_kind)
+        for text, execution_id, repr_kind in expressions:
+            try:
+                code = self.compile(text, cur_frame)
+                timed_out, res = EVALUATION_WATCHDOG.call(EVAL_TIMEOUT, eval, code, cur_frame.f_globals, cur_locals)
+            except:
+                write_execution_error(msg, get_exception_text(sys.exc_info()), execution_id)
+            else:
+                if timed_out:
+                    write_execution_error(msg, TIMED_OUT_REPR, execution_id)
+                else:
+                    write_execution_result(msg, execution_id, res, repr_kind)
+        self.locals_to_fast(cur_frame)
+        # Report any updated variable values first
+        self.enum_thread_frames_locally()
+        with _SendLockCtx:
+            msg.send(conn)
+
     def run_locally_no_report(self, text, cur_frame, frame_kind):
         code = self.compile(text, cur_frame)
         res = eval(code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
@@ -1234,58 +1903,19 @@ class Thread(object):
     def enum_child_locally(self, expr, cur_frame, execution_id, frame_kind):
         try:
             code = compile(expr, cur_frame.f_code.co_name, 'eval')
-            res = eval(code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
+            timed_out, res = EVALUATION_WATCHDOG.call(EVAL_TIMEOUT, eval, code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
+            if timed_out:
+                raise EvaluationTimeout()
 
             children = [] # [(name, expression, value, flags)]
 
             # Process attributes.
 
-            cls_dir = set(dir(type(res)))
-            res_dict = getattr(res, '__dict__', {})
-            res_slots = set(getattr(res, '__slots__', ()))
-
-            for attr_name in dir(res):
-                try:
-                    # Skip special attributes.
-                    if attr_name.startswith('__') and attr_name.endswith('__'):
-                        continue
-                    attr_value = getattr(res, attr_name)
-                    # If it comes from the class and is not shadowed by any instance attribute, filter it out if it looks like a method.
-                    if attr_name in cls_dir and attr_name not in res_dict and attr_name not in res_slots:
-                        if isinstance(attr_value, METHOD_TYPES):
-                            continue
-                    children.append((attr_name, expr + '.' + attr_name, attr_value, 0))
-                except:
-                    # Skip this attribute if we can't process it.
-                    pass
+            self.collect_attribute_children(children, res, expr)
 
             # Process items, if this is a collection.
 
-            try:
-                if hasattr(res, '__iter__') and iter(res) is res:
-                    # An iterable object that is its own iterator - iterators, generators, enumerate() etc. These can only be iterated once, so
-                    # don't try to iterate them immediately. Instead, provide a child item that will do so when expanded, to give user full control.
-                    children.append(('Results View', 'tuple(' + expr + ')', SynthesizedValue('Expanding the Results View will run the iterator'), PYTHON_EVALUATION_RESULT_METHOD_CALL | PYTHON_EVALUATION_RESULT_SIDE_EFFECTS))
-                    enum = ()
-                elif isinstance(res, dict) or (hasattr(res, 'items') and hasattr(res, 'has_key')):
-                    # Dictionary-like object.
-                    try:
-                        enum = res.viewitems()
-                        enum_expr = expr + '.viewitems()'
-                        children.append(('viewitems()', enum_expr, SynthesizedValue(), PYTHON_EVALUATION_RESULT_METHOD_CALL))
-                    except:
-                        enum = res.items()
-                        enum_expr = expr + '.items()'
-                        children.append(('items()', enum_expr, SynthesizedValue(), PYTHON_EVALUATION_RESULT_METHOD_CALL))
-                    enum_var = '(k, v)'
-                    enum = enumerate(enum)
-                else:
-                    # Indexable or enumerable object.
-                    enum = enumerate(enumerate(res))
-                    enum_expr = expr
-                    enum_var = 'v'
-            except:
-                enum = ()
+            enum, enum_expr, enum_var = self.get_item_enum(children, res, expr)
 
             for index, (key, item) in enum:
                 try:
@@ -1294,85 +1924,158 @@ class Thread(object):
                         children.append(('[...]', None, 'Evaluation halted because sequence has too many items', 0))
                         break
 
-                    key_repr = safe_repr(key)
+                    children.append(self.get_item_child(res, expr, enum_expr, enum_var, index, key, item))
 
-                    # Some objects are enumerable but not indexable, or repr(key) is not a valid Python expression. For those, we
-                    # cannot use obj[key] to get the item by its key, and have to retrieve it by index from enumerate() instead.
-                    try:
-                        item_by_key = res[eval_repr(key)]
-                        use_index = item is not item_by_key
-                    except:
-                        use_index = True
-                    else:
-                        use_index = False
+                except:
+                    # Skip this item if we can't process it.
+                    pass
 
-                    item_name = '[' + key_repr + ']'
-                    if use_index:
-                        item_expr = 'next((v for i, %s in enumerate(%s) if i == %s))' % (enum_var, enum_expr, index)
-                    else:
-                        item_expr = expr + item_name
+            report_children(execution_id, children)
 
-                    children.append((item_name, item_expr, item, 0))
+        except:
+            report_children(execution_id, [])
 
+    def enum_child_page_locally(self, expr, cur_frame, execution_id, frame_kind, offset, count):
+        """reports the items [offset, offset + count) of the collection that expr evaluates to, preceded by
+        its attributes if offset is 0.  The iterator used for collections that can't be indexed by position
+        is kept until the thread resumes, so that the next page continues where this one stopped."""
+        try:
+            code = compile(expr, cur_frame.f_code.co_name, 'eval')
+            timed_out, res = EVALUATION_WATCHDOG.call(EVAL_TIMEOUT, eval, code, cur_frame.f_globals, self.get_locals(cur_frame, frame_kind))
+            if timed_out:
+                raise EvaluationTimeout()
+
+            try:
+                total = len(res)
+            except:
+                total = -1
+
+            children = []
+            if offset == 0:
+                self.collect_attribute_children(children, res, expr)
+
+            if type(res) in SEQUENCE_TYPES:
+                for index in xrange(offset, min(offset + count, total)):
+                    children.append(('[' + str(index) + ']', expr + '[' + str(index) + ']', res[index], 0))
+                report_children_page(execution_id, total, children)
+                return
+
+            key = (expr, id(res))
+            cached = self.child_enums.pop(key, None)
+            if offset != 0 and cached is not None and cached[0] is res and cached[4] <= offset:
+                res, enum, enum_expr, enum_var, position = cached
+            else:
+                synthesized = []
+                enum, enum_expr, enum_var = self.get_item_enum(synthesized, res, expr)
+                if offset == 0:
+                    # only the first page reports the children that stand for the items
+                    children.extend(synthesized)
+                position = 0
+
+            for index, (item_key, item) in islice(enum, offset - position, offset - position + count):
+                try:
+                    children.append(self.get_item_child(res, expr, enum_expr, enum_var, index, item_key, item))
                 except:
                     # Skip this item if we can't process it.
                     pass
+                position = index + 1
 
-            report_children(execution_id, children)
+            if position == offset + count:
+                self.child_enums[key] = (res, enum, enum_expr, enum_var, position)
+
+            report_children_page(execution_id, total, children)
 
         except:
-            report_children(execution_id, [])
+            report_children_page(execution_id, -1, [])
 
-    def get_frame_list(self):
-        frames = []
-        cur_frame = self.cur_frame
+    def collect_attribute_children(self, children, res, expr):
+        cls_dir = set(dir(type(res)))
+        res_dict = getattr(res, '__dict__', {})
+        res_slots = set(getattr(res, '__slots__', ()))
 
-        while should_send_frame(cur_frame):
-            # calculate the ending line number
-            lineno = cur_frame.f_code.co_firstlineno
+        for attr_name in dir(res):
             try:
-                linetable = cur_frame.f_code.co_lnotab
+                # Skip special attributes.
+                if attr_name.startswith('__') and attr_name.endswith('__'):
+                    continue
+                timed_out, attr_value = EVALUATION_WATCHDOG.call(REPR_TIMEOUT, getattr, res, attr_name)
+                if timed_out:
+                    children.append((attr_name, expr + '.' + attr_name, SynthesizedValue(TIMED_OUT_REPR, len_value=0), 0))
+                    continue
+                # If it comes from the class and is not shadowed by any instance attribute, filter it out if it looks like a method.
+                if attr_name in cls_dir and attr_name not in res_dict and attr_name not in res_slots:
+                    if isinstance(attr_value, METHOD_TYPES):
+                        continue
+                children.append((attr_name, expr + '.' + attr_name, attr_value, 0))
             except:
+                # Skip this attribute if we can't process it.
+                pass
+
+    def get_item_enum(self, children, res, expr):
+        """returns (enum, enum_expr, enum_var) for the items of res, where enum yields (index, (key, item)),
+        and adds the synthesized children that stand for the items to children"""
+        try:
+            if hasattr(res, '__iter__') and iter(res) is res:
+                # An iterable object that is its own iterator - iterators, generators, enumerate() etc. These can only be iterated once, so
+                # don't try to iterate them immediately. Instead, provide a child item that will do so when expanded, to give user full control.
+                children.append(('Results View', 'tuple(' + expr + ')', SynthesizedValue('Expanding the Results View will run the iterator'), PYTHON_EVALUATION_RESULT_METHOD_CALL | PYTHON_EVALUATION_RESULT_SIDE_EFFECTS))
+                return (), None, None
+            elif isinstance(res, dict) or (hasattr(res, 'items') and hasattr(res, 'has_key')):
+                # Dictionary-like object.
                 try:
-                    lineno = cur_frame.f_code.Span.End.Line
+                    enum = res.viewitems()
+                    enum_expr = expr + '.viewitems()'
+                    children.append(('viewitems()', enum_expr, SynthesizedValue(), PYTHON_EVALUATION_RESULT_METHOD_CALL))
                 except:
-                    lineno = -1
+                    enum = res.items()
+                    enum_expr = expr + '.items()'
+                    children.append(('items()', enum_expr, SynthesizedValue(), PYTHON_EVALUATION_RESULT_METHOD_CALL))
+                return enumerate(enum), enum_expr, '(k, v)'
             else:
-                for line_incr in linetable[1::2]:
-                    if sys.version >= '3':
-                        lineno += line_incr
-                    else:
-                        lineno += ord(line_incr)
+                # Indexable or enumerable object.
+                return enumerate(enumerate(res)), expr, 'v'
+        except:
+            return (), None, None
+
+    def get_item_child(self, res, expr, enum_expr, enum_var, index, key, item):
+        key_repr = safe_repr(key)
 
-            frame_locals = cur_frame.f_locals
-            var_names = cur_frame.f_code.co_varnames
+        # Some objects are enumerable but not indexable, or repr(key) is not a valid Python expression. For those, we
+        # cannot use obj[key] to get the item by its key, and have to retrieve it by index from enumerate() instead.
+        try:
+            item_by_key = res[eval_repr(key)]
+            use_index = item is not item_by_key
+        except:
+            use_index = True
+        else:
+            use_index = False
+
+        item_name = '[' + key_repr + ']'
+        if use_index:
+            item_expr = 'next((v for i, %s in enumerate(%s) if i == %s))' % (enum_var, enum_expr, index)
+        else:
+            item_expr = expr + item_name
+
+        return (item_name, item_expr, item, 0)
+
+    def get_frame_list(self, frame_ids = None):
+        frames = []
+        cur_frame = self.cur_frame
+
+        while should_send_frame(cur_frame):
+            if frame_ids is not None:
+                frame_ids.append(id(cur_frame))
+
+            firstlineno, lineno, filename = get_code_info(cur_frame.f_code)
 
             source_obj = None
             if DJANGO_DEBUG:
                 source_obj = get_django_frame_source(cur_frame)
-                if source_obj is not None:
-                    frame_locals = self.get_locals(cur_frame, FRAME_KIND_DJANGO)
-                    var_names = frame_locals
 
-            if source_obj is not None:
-                process_globals_in_functions = False
-            elif frame_locals is cur_frame.f_globals:
-                var_names = frame_locals
-                process_globals_in_functions = False
+            if LAZY_FRAME_VARIABLES:
+                vars = []
             else:
-                process_globals_in_functions = True
-
-            # collect frame locals
-            vars = []
-            treated = set()
-            self.collect_variables(vars, frame_locals, var_names, treated)
-            if process_globals_in_functions:
-                # collect closed over variables used locally (frame_locals not already treated based on var_names)
-                self.collect_variables(vars, frame_locals, frame_locals, treated)
-                # collect globals used locally, skipping undefined found in builtins
-                f_globals = cur_frame.f_globals
-                if f_globals: # ensure globals to work with (IPy may have None for cur_frame.f_globals for frames within stdlib)
-                    self.collect_variables(vars, f_globals, cur_frame.f_code.co_names, treated, skip_unknown = True)
+                vars = self.get_frame_variables(cur_frame, source_obj)
 
             frame_info = None
 
@@ -1396,17 +2099,17 @@ class Thread(object):
                         0,
                         vars,
                         FRAME_KIND_DJANGO,
-                        get_code_filename(cur_frame.f_code),
+                        filename,
                         cur_frame.f_lineno
                     )
 
             if frame_info is None:
                 frame_info = (
-                    cur_frame.f_code.co_firstlineno,
+                    firstlineno,
                     lineno, 
                     cur_frame.f_lineno, 
                     cur_frame.f_code.co_name,
-                    get_code_filename(cur_frame.f_code),
+                    filename,
                     cur_frame.f_code.co_argcount,
                     vars,
                     FRAME_KIND_PYTHON,
@@ -1420,7 +2123,45 @@ class Thread(object):
 
         return frames
 
+    def get_frame_variables(self, cur_frame, source_obj = None):
+        frame_locals = cur_frame.f_locals
+        var_names = cur_frame.f_code.co_varnames
+
+        if source_obj is not None:
+            frame_locals = self.get_locals(cur_frame, FRAME_KIND_DJANGO)
+            var_names = frame_locals
+            process_globals_in_functions = False
+        elif frame_locals is cur_frame.f_globals:
+            var_names = frame_locals
+            process_globals_in_functions = False
+        else:
+            process_globals_in_functions = True
+
+        # collect frame locals
+        vars = []
+        treated = set()
+        self.collect_variables(vars, frame_locals, var_names, treated)
+        if process_globals_in_functions:
+            # collect closed over variables used locally (frame_locals not already treated based on var_names)
+            self.collect_variables(vars, frame_locals, frame_locals, treated)
+            # collect globals used locally, skipping undefined found in builtins
+            f_globals = cur_frame.f_globals
+            if f_globals: # ensure globals to work with (IPy may have None for cur_frame.f_globals for frames within stdlib)
+                self.collect_variables(vars, f_globals, cur_frame.f_code.co_names, treated, skip_unknown = True)
+        return vars
+
+    def enum_frame_variables_locally(self, cur_frame, execution_id):
+        try:
+            source_obj = None
+            if DJANGO_DEBUG:
+                source_obj = get_django_frame_source(cur_frame)
+            vars = self.get_frame_variables(cur_frame, source_obj)
+        except:
+            vars = []
+        report_frame_variables(execution_id, vars)
+
     def collect_variables(self, vars, objects, names, treated, skip_unknown = False):
+        collected = []
         for name in names:
             if name not in treated:
                 try:
@@ -1437,42 +2178,120 @@ class Thread(object):
                         continue
                     obj = SynthesizedValue('<undefined>', len_value=0)
                     type_name = 'unknown'
-                vars.append((name, type(obj), safe_repr(obj), safe_hex_repr(obj), type_name, get_object_len(obj)))
+                collected.append((name, obj, type_name))
                 treated.add(name)
 
-    def send_frame_list(self, frames, thread_name = None):
+        infos = get_objects_info([obj for name, obj, type_name in collected])
+        for (name, obj, type_name), (obj_repr, hex_repr, obj_len) in zip(collected, infos):
+            vars.append((name, type(obj), obj_repr, hex_repr, type_name, obj_len))
+
+    def send_frame_list(self, frames, thread_name = None, frame_ids = None):
+        msg = MessageWriter()
         with _SendLockCtx:
-            write_bytes(conn, THRF)
-            write_int(conn, self.id)
-            write_string(conn, thread_name)
-
-            # send the frame count
-            write_int(conn, len(frames))
-            for firstlineno, lineno, curlineno, name, filename, argcount, variables, frameKind, sourceFile, sourceLine in frames:
-                # send each frame    
-                write_int(conn, firstlineno)
-                write_int(conn, lineno)
-                write_int(conn, curlineno)
-
-                write_string(conn, name)
-                write_string(conn, filename)
-                write_int(conn, argcount)
-
-                write_int(conn, frameKind)
+            self.write_frame_list(msg, frames, thread_name, frame_ids)
+            msg.send(conn)
+
+    def write_frame_list(self, msg, frames, thread_name = None, frame_ids = None):
+        self.write_new_thread(msg)
+        msg.write_bytes(THRF)
+        msg.write_int(self.id)
+        msg.write_string(thread_name)
+
+        # send the frame count
+        msg.write_int(len(frames))
+        for frame in frames:
+            write_frame(msg, frame)
+
+        if STACK_DELTAS and frame_ids is not None:
+            self.sent_frames = [get_frame_state(frame_id, frame) for frame_id, frame in zip(frame_ids, frames)]
+            self.sent_frames_conn = conn
+        else:
+            self.sent_frames = None
+
+    def write_new_thread(self, msg):
+        """writes a NEWT for this thread unless it was reported already, preceded by the pending thread exits
+        so that the debugger doesn't confuse it with an exited thread with the same id.  Must be called with
+        the send lock held."""
+        if self.reported:
+            return
+        OUTPUT_PUMP.write_exits(msg)
+        msg.write_bytes(NEWT)
+        msg.write_int(self.id)
+        self.reported = True
+
+    def send_frame_delta(self, frames, frame_ids):
+        """reports the frames popped, the frames pushed, and the retained frames whose line or variables
+        changed since the frame list of this thread was last reported.  Falls back to sending the full
+        frame list if nothing was reported to the current debugger yet, or if no frame was retained."""
+        msg = MessageWriter()
+        with _SendLockCtx:
+            sent = self.sent_frames
+            if sent is None or self.sent_frames_conn is not conn:
+                self.write_frame_list(msg, frames, None, frame_ids)
+                msg.send(conn)
+                return
+
+            state = [get_frame_state(frame_id, frame) for frame_id, frame in zip(frame_ids, frames)]
+
+            # frames are ordered innermost first, so the retained frames are at the end of both lists
+            retained = 0
+            max_retained = min(len(sent), len(state))
+            while retained < max_retained and sent[-1 - retained][0] == state[-1 - retained][0]:
+                retained += 1
+
+            if retained == 0:
+                self.write_frame_list(msg, frames, None, frame_ids)
+                msg.send(conn)
+                return
+
+            popped = len(sent) - retained
+            pushed = len(state) - retained
+            changed = []
+            for i in xrange(pushed, len(state)):
+                old_key, old_line, old_vars = sent[i - pushed + popped]
+                new_key, new_line, new_vars = state[i]
+                if old_line != new_line or old_vars != new_vars:
+                    changed.append((i, old_vars, new_vars))
+
+            self.sent_frames = state
+            if not popped and not pushed and not changed:
+                return
+
+            msg.write_bytes(THRD)
+            msg.write_int(self.id)
+            msg.write_int(popped)
+            msg.write_int(pushed)
+            for frame in frames[:pushed]:
+                write_frame(msg, frame)
+
+            msg.write_int(len(changed))
+            for i, old_vars, new_vars in changed:
+                firstlineno, lineno, curlineno, name, filename, argcount, variables, frameKind, sourceFile, sourceLine = frames[i]
+                msg.write_int(i)
+                msg.write_int(curlineno)
                 if frameKind == FRAME_KIND_DJANGO:
-                    write_string(conn, sourceFile)
-                    write_int(conn, sourceLine)
+                    msg.write_int(sourceLine)
+
+                updated = [var for var in variables if old_vars.get(var[0]) != new_vars[var[0]]]
+                msg.write_int(len(updated))
+                for name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in updated:
+                    msg.write_string(name)
+                    write_object(msg, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len)
+
+                removed = [name for name in old_vars if name not in new_vars]
+                msg.write_int(len(removed))
+                for name in removed:
+                    msg.write_string(name)
 
-                write_int(conn, len(variables))
-                for name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in variables:
-                    write_string(conn, name)
-                    write_object(conn, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len)
+            msg.send(conn)
 
     def enum_thread_frames_locally(self):
         global threading
         if threading is None:
             import threading
-        self.send_frame_list(self.get_frame_list(), getattr(threading.currentThread(), 'name', 'Python Thread'))
+        frame_ids = []
+        frames = self.get_frame_list(frame_ids)
+        self.send_frame_list(frames, getattr(threading.currentThread(), 'name', 'Python Thread'), frame_ids)
 
 threading = None
 
@@ -1492,17 +2311,9 @@ def get_code(func):
 
 class DebuggerExitException(Exception): pass
 
-def add_break_point(bp):
-    cur_bp = BREAKPOINTS.get(bp.lineno)
-    if cur_bp is None:
-        cur_bp = BREAKPOINTS[bp.lineno] = dict()
-    cur_bp[(bp.filename, bp.breakpoint_id)] = bp
-
 def try_bind_break_point(mod_filename, module, bp):
     if module.filename.lower() == path.abspath(bp.filename).lower():
-        bp.filename = mod_filename
-        bp.is_bound = True
-        add_break_point(bp)
+        BREAKPOINTS.bind(bp, mod_filename)
         report_breakpoint_bound(bp.breakpoint_id)
         return True
     return False
@@ -1514,14 +2325,16 @@ def mark_all_threads_for_break(stepping = STEPPING_BREAK, skip_thread = None):
             continue
         thread.stepping = stepping
     THREADS_LOCK.release()
+    TRACE_ENGINE.update_events()
 
 class DebuggerLoop(object):
 
     instance = None
 
-    def __init__(self, conn):
+    def __init__(self, conn, reader = None):
         DebuggerLoop.instance = self
-        self.conn = conn
+        # commands are read through a buffered reader, replies are sent on the global conn
+        self.conn = reader or ConnectionReader(conn)
         self.repl_backend = None
         self.command_table = {
             to_bytes('stpi') : self.command_step_into,
@@ -1529,6 +2342,7 @@ class DebuggerLoop(object):
             to_bytes('stpv') : self.command_step_over,
             to_bytes('brkp') : self.command_set_breakpoint,
             to_bytes('brkc') : self.command_set_breakpoint_condition,
+            to_bytes('brkl') : self.command_set_breakpoint_log_message,
             to_bytes('bkpc') : self.command_set_breakpoint_pass_count,
             to_bytes('bkgh') : self.command_get_breakpoint_hit_count,
             to_bytes('bksh') : self.command_set_breakpoint_hit_count,
@@ -1538,11 +2352,16 @@ class DebuggerLoop(object):
             to_bytes('rest') : self.command_resume_thread,
             to_bytes('ares') : self.command_auto_resume,
             to_bytes('exec') : self.command_execute_code,
+            to_bytes('exem') : self.command_execute_code_batch,
             to_bytes('chld') : self.command_enum_children,
+            to_bytes('chlp') : self.command_enum_children_page,
+            to_bytes('frmv') : self.command_enum_frame_variables,
             to_bytes('setl') : self.command_set_lineno,
             to_bytes('detc') : self.command_detach,
             to_bytes('clst') : self.command_clear_stepping,
             to_bytes('sexi') : self.command_set_exception_info,
+            to_bytes('evto') : self.command_set_evaluation_timeouts,
+            to_bytes('stat') : self.command_get_stats,
             to_bytes('sehi') : self.command_set_exception_handler_info,
             to_bytes('bkdr') : self.command_remove_django_breakpoint,
             to_bytes('bkda') : self.command_add_django_breakpoint,
@@ -1554,7 +2373,7 @@ class DebuggerLoop(object):
     def loop(self):
         try:
             while True:
-                inp = read_bytes(conn, 4)
+                inp = read_bytes(self.conn, 4)
                 cmd = self.command_table.get(inp)
                 if cmd is not None:
                     cmd()
@@ -1564,7 +2383,7 @@ class DebuggerLoop(object):
                     break
         except DebuggerExitException:
             pass
-        except socket.error:
+        except (socket.error, EOFError):
             pass
         except:
             traceback.print_exc()
@@ -1610,14 +2429,15 @@ class DebuggerLoop(object):
         pass_count_kind = read_int(self.conn)
         pass_count = read_int(self.conn)
         bp = BreakpointInfo(breakpoint_id, filename, lineno, condition_kind, condition, pass_count_kind, pass_count)
+        if bp.condition_error is not None:
+            report_breakpoint_condition_error(bp)
 
         for mod_filename, module in MODULES:
             if try_bind_break_point(mod_filename, module, bp):
                 break
         else:
             # Failed to bind break point (e.g. module is not loaded yet); report as pending.
-            add_break_point(bp)
-            PENDING_BREAKPOINTS.add(bp)
+            BREAKPOINTS.add(bp)
             report_breakpoint_failed(breakpoint_id)
 
     def command_set_breakpoint_condition(self):
@@ -1627,8 +2447,17 @@ class DebuggerLoop(object):
 
         bp = BreakpointInfo.find_by_id(breakpoint_id)
         if bp is not None:
-            bp.condition_kind = kind
-            bp.condition = condition
+            bp.set_condition(kind, condition)
+            if bp.condition_error is not None:
+                report_breakpoint_condition_error(bp)
+
+    def command_set_breakpoint_log_message(self):
+        breakpoint_id = read_int(self.conn)
+        message = read_string(self.conn)
+
+        bp = BreakpointInfo.find_by_id(breakpoint_id)
+        if bp is not None:
+            bp.set_log_message(message)
 
     def command_set_breakpoint_pass_count(self):
         breakpoint_id = read_int(self.conn)
@@ -1657,22 +2486,17 @@ class DebuggerLoop(object):
         if bp is not None:
             count = bp.hit_count
 
+        msg = MessageWriter()
+        msg.write_bytes(BKHC)
+        msg.write_int(req_id)
+        msg.write_int(count)
         with _SendLockCtx:
-            write_bytes(conn, BKHC)
-            write_int(conn, req_id)
-            write_int(conn, count)
+            msg.send(conn)
 
     def command_remove_breakpoint(self):
         line_no = read_int(self.conn)
         brkpt_id = read_int(self.conn)
-        cur_bp = BREAKPOINTS.get(line_no)
-        if cur_bp is not None:
-            for file, id in cur_bp:
-                if id == brkpt_id:
-                    del cur_bp[file, id]
-                    if not cur_bp:
-                        del BREAKPOINTS[line_no]
-                    break
+        BREAKPOINTS.remove(brkpt_id)
 
     def command_remove_django_breakpoint(self):
         line_no = read_int(self.conn)
@@ -1692,6 +2516,7 @@ class DebuggerLoop(object):
             DJANGO_BREAKPOINTS[filename.lower()] = bp_info = DjangoBreakpointInfo(filename)
 
         bp_info.add_breakpoint(line_no, brkpt_id)
+        breakpoints_changed()
 
     def command_connect_repl(self):
         port_num = read_int(self.conn)
@@ -1703,10 +2528,10 @@ class DebuggerLoop(object):
         self.repl_backend.connect_from_debugger(port_num)
         self.repl_backend.execution_loop()
 
-    def connect_to_repl_backend_using_socket(self, sock):
+    def connect_to_repl_backend_using_socket(self, sock, reader = None):
         DONT_DEBUG.append(path.normcase(_vspr.__file__))
         self.repl_backend = _vspr.DebugReplBackend(self)
-        self.repl_backend.connect_from_debugger_using_socket(sock)
+        self.repl_backend.connect_from_debugger_using_socket(sock, reader)
         self.repl_backend.execution_loop()
 
     def command_disconnect_repl(self):
@@ -1731,6 +2556,7 @@ class DebuggerLoop(object):
             if thread._is_blocked:
                 thread.unblock()
             thread._block_starting_lock.release()
+        TRACE_ENGINE.update_events()
 
     def command_resume_thread(self):
         tid = read_int(self.conn)
@@ -1756,9 +2582,22 @@ class DebuggerLoop(object):
         else:
             self.command_resume_all()
 
+    def command_set_evaluation_timeouts(self):
+        global REPR_TIMEOUT, EVAL_TIMEOUT
+        REPR_TIMEOUT = read_int(self.conn) / 1000.0
+        EVAL_TIMEOUT = read_int(self.conn) / 1000.0
+
+    def command_get_stats(self):
+        action = read_int(self.conn)
+        stats = STATS.get()
+        if action == STATS_START:
+            collect_stats(True)
+        elif action == STATS_STOP:
+            collect_stats(False)
+        report_stats(stats)
+
     def command_set_exception_info(self):
-        BREAK_ON.clear()
-        BREAK_ON.default_mode = read_int(self.conn)
+        BREAK_ON.clear(read_int(self.conn))
 
         break_on_count = read_int(self.conn)
         for i in xrange(break_on_count):
@@ -1796,6 +2635,7 @@ class DebuggerLoop(object):
         thread = get_thread_from_id(tid)
         if thread is not None:
             thread.stepping = STEPPING_NONE
+            TRACE_ENGINE.update_events()
 
     def command_set_lineno(self):
         tid = read_int(self.conn)
@@ -1806,17 +2646,21 @@ class DebuggerLoop(object):
             THREADS[tid].cur_frame.f_lineno = lineno
             newline = THREADS[tid].cur_frame.f_lineno
             THREADS_LOCK.release()
+            msg = MessageWriter()
+            msg.write_bytes(SETL)
+            msg.write_int(1)
+            msg.write_int(tid)
+            msg.write_int(newline)
             with _SendLockCtx:
-                write_bytes(self.conn, SETL)
-                write_int(self.conn, 1)
-                write_int(self.conn, tid)
-                write_int(self.conn, newline)
+                msg.send(conn)
         except:
+            msg = MessageWriter()
+            msg.write_bytes(SETL)
+            msg.write_int(0)
+            msg.write_int(tid)
+            msg.write_int(0)
             with _SendLockCtx:
-                write_bytes(self.conn, SETL)
-                write_int(self.conn, 0)
-                write_int(self.conn, tid)
-                write_int(self.conn, 0)
+                msg.send(conn)
 
     def command_execute_code(self):
         # execute given text in specified frame
@@ -1831,6 +2675,23 @@ class DebuggerLoop(object):
         if thread is not None and cur_frame is not None:
             thread.run_on_thread(text, cur_frame, eid, frame_kind, repr_kind)
 
+    def command_execute_code_batch(self):
+        # execute several expressions in the specified frame, in one go
+        tid = read_int(self.conn) # thread id
+        fid = read_int(self.conn) # frame id
+        frame_kind = read_int(self.conn)
+        count = read_int(self.conn)
+        expressions = []
+        for _ in xrange(count):
+            text = read_string(self.conn)
+            eid = read_int(self.conn) # execution id
+            repr_kind = read_int(self.conn)
+            expressions.append((text, eid, repr_kind))
+
+        thread, cur_frame = self.get_thread_and_frame(tid, fid, frame_kind)
+        if thread is not None and cur_frame is not None:
+            thread.run_batch_on_thread(expressions, cur_frame, frame_kind)
+
     def execute_code_no_report(self, text, tid, fid, frame_kind):
         # execute given text in specified frame, without sending back the results
         thread, cur_frame = self.get_thread_and_frame(tid, fid, frame_kind)
@@ -1849,6 +2710,35 @@ class DebuggerLoop(object):
         if thread is not None and cur_frame is not None:
             thread.enum_child_on_thread(text, cur_frame, eid, frame_kind)
 
+    def command_enum_children_page(self):
+        # report a page of the children of the given text in specified frame
+        text = read_string(self.conn)
+        tid = read_int(self.conn) # thread id
+        fid = read_int(self.conn) # frame id
+        eid = read_int(self.conn) # execution id
+        frame_kind = read_int(self.conn) # frame kind
+        offset = read_int(self.conn)
+        count = read_int(self.conn)
+
+        thread, cur_frame = self.get_thread_and_frame(tid, fid, frame_kind)
+        if thread is not None and cur_frame is not None:
+            thread.enum_child_page_on_thread(text, cur_frame, eid, frame_kind, offset, count)
+        else:
+            report_children_page(eid, -1, [])
+
+    def command_enum_frame_variables(self):
+        # send the variables of the specified frame
+        tid = read_int(self.conn) # thread id
+        fid = read_int(self.conn) # frame id
+        eid = read_int(self.conn) # execution id
+        frame_kind = read_int(self.conn) # frame kind
+
+        thread, cur_frame = self.get_thread_and_frame(tid, fid, frame_kind)
+        if thread is not None and cur_frame is not None:
+            thread.enum_frame_variables_on_thread(cur_frame, eid)
+        else:
+            report_frame_variables(eid, [])
+
     def get_thread_and_frame(self, tid, fid, frame_kind):
         thread = get_thread_from_id(tid)
         cur_frame = None
@@ -1871,8 +2761,11 @@ class DebuggerLoop(object):
             k32.FreeLibrary(debugger_dll_handle)
             debugger_dll_handle = None
 
+        OUTPUT_PUMP.send()
+        msg = MessageWriter()
+        msg.write_bytes(DETC)
         with _SendLockCtx:
-            write_bytes(conn, DETC)
+            msg.send(conn)
             detach_process()        
 
         for callback in DETACH_CALLBACKS:
@@ -1886,24 +2779,32 @@ class DebuggerLoop(object):
 DETACH_CALLBACKS = []
 
 def new_thread_wrapper(func, posargs, kwargs):
-    cur_thread = new_thread()
+    # threads started by the program are only reported to the debugger once it needs to know about them,
+    # so that programs which start many short lived threads don't flood it with NEWT and EXTT
+    cur_thread = new_thread(report = False)
     try:
-        sys.settrace(cur_thread.trace_func)
+        if not (TRACE_ONLY_WHEN_ATTACHED and DETACHED):
+            TRACE_ENGINE.start_thread(cur_thread)
         func(*posargs, **kwargs)
     finally:
+        if not DETACHED:
+            # sending the output reports the thread if it wasn't already, so send it while it's registered
+            OUTPUT_PUMP.send((cur_thread.id,))
+
         THREADS_LOCK.acquire()
         if not cur_thread.detach:
             del THREADS[cur_thread.id]
         THREADS_LOCK.release()
 
-        if not DETACHED:
+        if not DETACHED and cur_thread.reported:
             report_thread_exit(cur_thread)
 
 def report_new_thread(new_thread):
-    ident = new_thread.id
+    msg = MessageWriter()
     with _SendLockCtx:
-        write_bytes(conn, NEWT)
-        write_int(conn, ident)
+        new_thread.write_new_thread(msg)
+        if msg.buffer:
+            msg.send(conn)
 
 def report_all_threads():
     THREADS_LOCK.acquire()
@@ -1913,10 +2814,11 @@ def report_all_threads():
         report_new_thread(cur_thread)
 
 def report_thread_exit(old_thread):
+    """sends the remaining output of the thread, and queues the EXTT to be sent with the next flush of
+    the output pump"""
     ident = old_thread.id
-    with _SendLockCtx:
-        write_bytes(conn, EXTT)
-        write_int(conn, ident)
+    OUTPUT_PUMP.send((ident,))
+    OUTPUT_PUMP.thread_exited(ident)
 
 def report_exception(frame, exc_info, tid, break_type):
     exc_type = exc_info[0]
@@ -1931,64 +2833,143 @@ def report_exception(frame, exc_info, tid, break_type):
 
     excp_text = str(exc_value)
 
+    msg = MessageWriter()
+    msg.write_bytes(EXCP)
+    msg.write_string(exc_name)
+    msg.write_int(tid)
+    msg.write_int(break_type)
+    msg.write_string(excp_text)
     with _SendLockCtx:
-        write_bytes(conn, EXCP)
-        write_string(conn, exc_name)
-        write_int(conn, tid)
-        write_int(conn, break_type)
-        write_string(conn, excp_text)
+        msg.send(conn)
 
 def new_module(frame):
     mod = Module(get_code_filename(frame.f_code))
     MODULES.append((frame.f_code.co_filename, mod))
+    PATH_MATCHES.clear()
+    PACKAGE_DIRS.clear()
+    if BREAKPOINTS.pending:
+        breakpoints_changed()
 
     return frame.f_code, mod
 
 def report_module_load(mod):
+    msg = MessageWriter()
+    write_module_load(msg, mod)
     with _SendLockCtx:
-        write_bytes(conn, MODL)
-        write_int(conn, mod.module_id)
-        write_string(conn, mod.filename)
+        msg.send(conn)
+
+def write_module_load(msg, mod):
+    msg.write_bytes(MODL)
+    msg.write_int(mod.module_id)
+    msg.write_string(mod.filename)
+
+def report_inventory(all_threads, modules):
+    """reports the given threads and modules, with one INVT if the client supports it, or otherwise with a
+    NEWT per thread and a MODL per module sent all at once"""
+    msg = MessageWriter()
+    for cur_thread in all_threads:
+        cur_thread.reported = True
+    if not BULK_INVENTORY:
+        for cur_thread in all_threads:
+            msg.write_bytes(NEWT)
+            msg.write_int(cur_thread.id)
+        for filename, module in modules:
+            write_module_load(msg, module)
+        with _SendLockCtx:
+            msg.send(conn)
+        return
+
+    payload = MessageWriter()
+    payload.write_int(len(all_threads))
+    for cur_thread in all_threads:
+        payload.write_int(cur_thread.id)
+    payload.write_int(len(modules))
+    for filename, module in modules:
+        payload.write_int(module.module_id)
+        payload.write_string(module.filename)
+
+    data = payload.buffer
+    flags = 0
+    if zlib is not None and len(data) > INVENTORY_COMPRESS_SIZE:
+        data = zlib.compress(bytes(data))
+        flags |= INVENTORY_COMPRESSED
+
+    msg.write_bytes(INVT)
+    msg.write_int(flags)
+    msg.write_int(len(data))
+    msg.write_bytes(data)
+    with _SendLockCtx:
+        msg.send(conn)
 
 def report_step_finished(tid):
+    msg = MessageWriter()
+    msg.write_bytes(STPD)
+    msg.write_int(tid)
     with _SendLockCtx:
-        write_bytes(conn, STPD)
-        write_int(conn, tid)
+        msg.send(conn)
 
 def report_breakpoint_bound(id):
+    msg = MessageWriter()
+    msg.write_bytes(BRKS)
+    msg.write_int(id)
     with _SendLockCtx:
-        write_bytes(conn, BRKS)
-        write_int(conn, id)
+        msg.send(conn)
 
 def report_breakpoint_failed(id):
+    msg = MessageWriter()
+    msg.write_bytes(BRKF)
+    msg.write_int(id)
     with _SendLockCtx:
-        write_bytes(conn, BRKF)
-        write_int(conn, id)
+        msg.send(conn)
+
+def report_breakpoint_condition_error(bp, tid = None):
+    # There is no dedicated message for this, so it goes to the debug output of the given thread, or
+    # of any thread. If there is no thread yet, it's reported by the first one that hits the breakpoint.
+    if tid is None:
+        THREADS_LOCK.acquire()
+        all_threads = list(THREADS)
+        THREADS_LOCK.release()
+        if not all_threads:
+            return
+        tid = all_threads[0]
+    bp.condition_error_reported = True
+    OUTPUT_PUMP.write(tid, 'Breakpoint condition "%s" could not be compiled: %s\n' % (bp.condition, bp.condition_error))
+    OUTPUT_PUMP.send((tid,))
 
 def report_breakpoint_hit(id, tid):    
+    msg = MessageWriter()
+    msg.write_bytes(BRKH)
+    msg.write_int(id)
+    msg.write_int(tid)
     with _SendLockCtx:
-        write_bytes(conn, BRKH)
-        write_int(conn, id)
-        write_int(conn, tid)
+        msg.send(conn)
 
 def report_process_loaded(tid):
+    msg = MessageWriter()
+    msg.write_bytes(LOAD)
+    msg.write_int(tid)
     with _SendLockCtx:
-        write_bytes(conn, LOAD)
-        write_int(conn, tid)
+        msg.send(conn)
 
 def report_execution_error(exc_text, execution_id):
+    msg = MessageWriter()
+    write_execution_error(msg, exc_text, execution_id)
     with _SendLockCtx:
-        write_bytes(conn, EXCE)
-        write_int(conn, execution_id)
-        write_string(conn, exc_text)
+        msg.send(conn)
 
-def report_execution_exception(execution_id, exc_info):
+def write_execution_error(msg, exc_text, execution_id):
+    msg.write_bytes(EXCE)
+    msg.write_int(execution_id)
+    msg.write_string(exc_text)
+
+def get_exception_text(exc_info):
     try:
-        exc_text = str(exc_info[1])
+        return str(exc_info[1])
     except:
-        exc_text = 'An exception was thrown'
+        return 'An exception was thrown'
 
-    report_execution_error(exc_text, execution_id)
+def report_execution_exception(execution_id, exc_info):
+    report_execution_error(get_exception_text(exc_info), execution_id)
 
 def safe_hex_repr(obj):
     try:
@@ -2003,11 +2984,15 @@ def get_object_len(obj):
         return None
 
 def report_execution_result(execution_id, result, repr_kind = PYTHON_EVALUATION_RESULT_REPR_KIND_NORMAL):
+    msg = MessageWriter()
+    write_execution_result(msg, execution_id, result, repr_kind)
+    with _SendLockCtx:
+        msg.send(conn)
+
+def write_execution_result(msg, execution_id, result, repr_kind = PYTHON_EVALUATION_RESULT_REPR_KIND_NORMAL):
     if repr_kind == PYTHON_EVALUATION_RESULT_REPR_KIND_NORMAL:
         flags = 0
-        obj_repr = safe_repr(result)
-        obj_len = get_object_len(result)
-        hex_repr = safe_hex_repr(result)
+        obj_repr, hex_repr, obj_len = get_object_info(result)
     else:
         flags = PYTHON_EVALUATION_RESULT_RAW
         hex_repr = None                
@@ -2025,21 +3010,74 @@ def report_execution_result(execution_id, result, repr_kind = PYTHON_EVALUATION_
     res_type = type(result)
     type_name = type(result).__name__
 
-    with _SendLockCtx:
-        write_bytes(conn, EXCR)
-        write_int(conn, execution_id)
-        write_object(conn, res_type, obj_repr, hex_repr, type_name, obj_len, flags)
+    msg.write_bytes(EXCR)
+    msg.write_int(execution_id)
+    write_object(msg, res_type, obj_repr, hex_repr, type_name, obj_len, flags)
 
 def report_children(execution_id, children):
-    children = [(name, expression, flags, safe_repr(result), safe_hex_repr(result), type(result), type(result).__name__, get_object_len(result)) for name, expression, result, flags in children]
+    msg = MessageWriter()
+    msg.write_bytes(CHLD)
+    msg.write_int(execution_id)
+    write_children(msg, children)
     with _SendLockCtx:
-        write_bytes(conn, CHLD)
-        write_int(conn, execution_id)
-        write_int(conn, len(children))
-        for name, expression, flags, obj_repr, hex_repr, res_type, type_name, obj_len in children:
-            write_string(conn, name)
-            write_string(conn, expression)
-            write_object(conn, res_type, obj_repr, hex_repr, type_name, obj_len, flags)
+        msg.send(conn)
+
+def report_children_page(execution_id, total, children):
+    msg = MessageWriter()
+    msg.write_bytes(CHLP)
+    msg.write_int(execution_id)
+    msg.write_int(total)
+    write_children(msg, children)
+    with _SendLockCtx:
+        msg.send(conn)
+
+def write_children(msg, children):
+    infos = get_objects_info([result for name, expression, result, flags in children])
+    children = [(name, expression, flags) + info + (type(result), type(result).__name__) for (name, expression, result, flags), info in zip(children, infos)]
+    msg.write_int(len(children))
+    for name, expression, flags, obj_repr, hex_repr, obj_len, res_type, type_name in children:
+        msg.write_string(name)
+        msg.write_string(expression)
+        write_object(msg, res_type, obj_repr, hex_repr, type_name, obj_len, flags)
+
+def report_frame_variables(execution_id, variables):
+    msg = MessageWriter()
+    msg.write_bytes(FRMV)
+    msg.write_int(execution_id)
+    msg.write_int(len(variables))
+    for name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in variables:
+        msg.write_string(name)
+        write_object(msg, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len)
+    with _SendLockCtx:
+        msg.send(conn)
+
+def write_frame(msg, frame):
+    firstlineno, lineno, curlineno, name, filename, argcount, variables, frameKind, sourceFile, sourceLine = frame
+    msg.write_int(firstlineno)
+    msg.write_int(lineno)
+    msg.write_int(curlineno)
+
+    msg.write_string(name)
+    msg.write_string(filename)
+    msg.write_int(argcount)
+
+    msg.write_int(frameKind)
+    if frameKind == FRAME_KIND_DJANGO:
+        msg.write_string(sourceFile)
+        msg.write_int(sourceLine)
+
+    msg.write_int(len(variables))
+    for name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in variables:
+        msg.write_string(name)
+        write_object(msg, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len)
+
+def get_frame_state(frame_id, frame):
+    """returns (identity, line, {variable name: repr hash}) for a frame as reported in THRF"""
+    firstlineno, lineno, curlineno, name, filename, argcount, variables, frameKind, sourceFile, sourceLine = frame
+    var_hashes = {}
+    for var_name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in variables:
+        var_hashes[var_name] = hash((safe_repr_obj, hex_repr_obj, type_name, obj_len))
+    return (frame_id, firstlineno, name, filename, frameKind, sourceFile), (curlineno, sourceLine), var_hashes
 
 def get_code_filename(code):
     return path.abspath(code.co_filename)
@@ -2049,13 +3087,13 @@ try:
     NONEXPANDABLE_TYPES.append(long)
 except NameError: pass
 
-def write_object(conn, obj_type, obj_repr, hex_repr, type_name, obj_len, flags = 0):
-    write_string(conn, obj_repr)
-    write_string(conn, hex_repr)
+def write_object(msg, obj_type, obj_repr, hex_repr, type_name, obj_len, flags = 0):
+    msg.write_string(obj_repr)
+    msg.write_string(hex_repr)
     if obj_type is SynthesizedValue:
-        write_string(conn, '')
+        msg.write_string('')
     else:
-        write_string(conn, type_name)
+        msg.write_string(type_name)
     if obj_type not in NONEXPANDABLE_TYPES and obj_len != 0:
         flags |= PYTHON_EVALUATION_RESULT_EXPANDABLE
     try:
@@ -2065,8 +3103,8 @@ def write_object(conn, obj_type, obj_repr, hex_repr, type_name, obj_len, flags =
                 break
     except: # guard against broken issubclass for types which aren't actually types, like vtkclass
         pass
-    write_int(conn, obj_len or 0)
-    write_int(conn, flags)
+    msg.write_int(obj_len or 0)
+    msg.write_int(flags)
 
 debugger_thread_id = -1
 _INTERCEPTING_FOR_ATTACH = False
@@ -2099,16 +3137,18 @@ def attach_process(port_num, debug_id, report = False, block = False):
         raise Exception('failed to attach')
     attach_process_from_socket(conn, report, block)
 
-def attach_process_from_socket(sock, report = False, block = False):
+def attach_process_from_socket(sock, report = False, block = False, reader = None):
     global conn
     global DETACHED
     global attach_sent_break
     conn = sock
     attach_sent_break = False
 
+    start_trace_engine()
+
     # start the debugging loop
     global debugger_thread_id
-    debugger_thread_id = _start_new_thread(DebuggerLoop(conn).loop, ())
+    debugger_thread_id = _start_new_thread(DebuggerLoop(conn, reader).loop, ())
 
     for mod_name, mod_value in sys.modules.items():
         try:
@@ -2129,10 +3169,7 @@ def attach_process_from_socket(sock, report = False, block = False):
         if block:
             main_thread = THREADS[thread.get_ident()]
         THREADS_LOCK.release()
-        for cur_thread in all_threads:
-            report_new_thread(cur_thread)
-        for filename, module in MODULES:
-            report_module_load(module)
+        report_inventory(all_threads, list(MODULES))
     DETACHED = False
 
     if block:
@@ -2166,6 +3203,8 @@ def detach_process():
         thread.start_new_thread = _start_new_thread
         thread.start_new = _start_new_thread
 
+    stop_trace_engine()
+
 def detach_threads():
     # tell all threads to stop tracing...
     THREADS_LOCK.acquire()
@@ -2187,7 +3226,7 @@ def detach_threads():
 
     BREAKPOINTS.clear()
 
-def new_thread(tid = None, set_break = False, frame = None):
+def new_thread(tid = None, set_break = False, frame = None, report = True):
     # called during attach w/ a thread ID provided.
     if tid == debugger_thread_id:
         return None
@@ -2199,7 +3238,8 @@ def new_thread(tid = None, set_break = False, frame = None):
     cur_thread.push_frame(frame)
     if set_break:
         cur_thread.stepping = STEPPING_ATTACH_BREAK
-    if not DETACHED:
+        TRACE_ENGINE.update_events()
+    if report and not DETACHED:
         report_new_thread(cur_thread)
     return cur_thread
 
@@ -2212,7 +3252,441 @@ def new_external_thread():
         # user requested break all, make this thread break
         thread.stepping = STEPPING_BREAK
 
-    sys.settrace(thread.trace_func)
+    TRACE_ENGINE.start_thread(thread)
+
+def can_trace_all_threads():
+    """returns True if trace_all_threads is supported on this interpreter"""
+    return sys.platform != 'cli' and hasattr(sys, '_settraceallthreads')
+
+def trace_attached_thread(frame, event, arg):
+    """the trace function trace_all_threads installs on every thread. On the first event of each thread, it is
+    replaced with the trace function of the Thread for it, or removed if there is none."""
+    cur_thread = get_thread_from_id(thread.get_ident())
+    if cur_thread is None:
+        sys.settrace(None)
+        return None
+    sys.settrace(cur_thread.trace_func)
+    return cur_thread.trace_func(frame, event, arg)
+
+def is_debugger_thread_frame(frame):
+    """returns True if the given frame is the bottom frame of a thread started by the debugger or REPL for
+    their own purposes"""
+    while frame.f_back is not None:
+        frame = frame.f_back
+    if frame.f_code in DEBUG_ENTRYPOINTS:
+        return False
+    return CODE_VERDICTS.is_debugger_file(frame.f_code.co_filename)
+
+def trace_all_threads():
+    """Installs trace functions on all running threads other than the current one, creating Thread
+    objects for any that are not known yet. Used on attach when TRACE_ONLY_WHEN_ATTACHED is set,
+    in which case no thread is traced while the debugger is detached. When TRACE_ENGINE does not use
+    sys.settrace, the threads are only registered.
+
+    The trace function of another thread can't be set directly, so trace_attached_thread is installed on all
+    threads (and on the threads started by threading from now on), and each running frame gets the trace
+    function of its Thread. Requires Python 3.12 or later."""
+    frames = sys._current_frames()
+    uses_settrace = TRACE_ENGINE.uses_settrace
+    cur_tid = thread.get_ident()
+
+    THREADS_LOCK.acquire()
+    for tid in list(THREADS):
+        if tid not in frames:
+            # exited while we were not tracing it
+            del THREADS[tid]
+    THREADS_LOCK.release()
+
+    for tid, frame in frames.items():
+        if tid == cur_tid or tid == debugger_thread_id:
+            continue
+        if is_debugger_thread_frame(frame):
+            continue
+
+        cur_thread = get_thread_from_id(tid)
+        if cur_thread is None:
+            cur_thread = new_thread(tid, frame = frame)
+        else:
+            cur_thread.push_frame(frame)
+        if not uses_settrace:
+            continue
+        cur_thread.prev_trace_func = None
+        del cur_thread.trace_func_stack[:]
+
+        f = frame
+        while f is not None:
+            f.f_trace = cur_thread.trace_func
+            f = f.f_back
+
+    if uses_settrace:
+        import threading
+        threading.settrace_all_threads(trace_attached_thread)
+
+def untrace_all_threads():
+    """Removes the trace functions installed by trace_all_threads."""
+    import threading
+    threading.settrace_all_threads(None)
+    frames = sys._current_frames()
+
+    THREADS_LOCK.acquire()
+    all_threads = list(THREADS.values())
+    THREADS_LOCK.release()
+
+    for cur_thread in all_threads:
+        f = frames.get(cur_thread.id)
+        while f is not None:
+            if f.f_trace is cur_thread.trace_func:
+                f.f_trace = None
+            f = f.f_back
+
+class SettraceEngine(object):
+    """Traces threads by installing the trace function of each Thread with sys.settrace. This is
+    the default engine, and the only one available before Python 3.12."""
+
+    uses_settrace = True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if TRACE_ONLY_WHEN_ATTACHED:
+            untrace_all_threads()
+
+    def start_thread(self, cur_thread):
+        sys.settrace(cur_thread.trace_func)
+
+    def stop_thread(self, cur_thread):
+        sys.settrace(None)
+
+    def update_events(self):
+        if CAN_DISABLE_LINE_EVENTS:
+            enable_line_events(thread_filter = lambda cur_thread: cur_thread.stepping != STEPPING_NONE or cur_thread.django_stepping)
+
+    def breakpoints_changed(self):
+        if CAN_DISABLE_LINE_EVENTS:
+            enable_line_events(code_filter = code_has_breakpoints)
+
+    def sync_frames(self, all_threads):
+        pass
+
+class MonitoringEngine(object):
+    """Traces threads with sys.monitoring (PEP 669, Python 3.12 or later).
+
+    Only PY_START and RAISE are monitored globally while no thread is stepping. PY_START is
+    disabled for each code object after it has been seen once, unless it is module code (which
+    is needed to report module loads and bind pending breakpoints) or a Django template render.
+    LINE events are only enabled locally on code objects that contain breakpoints, and are
+    disabled for the lines that don't have one.
+
+    A thread that steps over or out of a frame only gets LINE and return events locally on the
+    code of that frame, and the events of the other frames running that code are ignored. The
+    frames below the stepped frame don't get any events, except for breakpoints and module
+    loads, which are dispatched as if the stepping depth was tracked. Once the stepped frame
+    returns, its caller becomes the stepped frame. A thread that steps into a call gets the same
+    events on the code of its current frame, and PY_START is not disabled until the thread has
+    entered a frame that is debugged, which then becomes the stepped frame. While any thread
+    breaks, or steps in a way that can't be tracked by frame, all events are enabled globally.
+
+    sys.monitoring does not have per-thread callbacks, so the events are dispatched to the
+    trace function of the Thread for the current thread, and events from threads that are
+    not known to the debugger are ignored."""
+
+    uses_settrace = False
+
+    @staticmethod
+    def is_supported():
+        try:
+            monitoring = sys.monitoring
+        except AttributeError:
+            return False
+        return stackless is None and monitoring.get_tool(monitoring.DEBUGGER_ID) is None
+
+    def __init__(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        self.tool_id = monitoring.DEBUGGER_ID
+        self.base_events = events.PY_START | events.RAISE
+        self.stepping_events = (self.base_events | events.PY_RESUME | events.PY_THROW | events.PY_RETURN |
+                                events.PY_YIELD | events.PY_UNWIND | events.LINE)
+        # PY_UNWIND can't be enabled locally, so it's enabled globally while a frame is being stepped
+        self.step_events = events.PY_RETURN | events.PY_YIELD | events.LINE
+        self.local_stepping_events = self.base_events | events.PY_UNWIND
+        self.callbacks = {
+            events.PY_START : self.on_start,
+            events.PY_RESUME : self.on_start,
+            events.PY_THROW : self.on_start,
+            events.PY_RETURN : self.on_return,
+            events.PY_YIELD : self.on_return,
+            events.PY_UNWIND : self.on_unwind,
+            events.LINE : self.on_line,
+            events.RAISE : self.on_raise,
+        }
+        self.lock = thread.allocate_lock()
+        self.global_events = events.NO_EVENTS
+        self.is_stepping = False
+        self.is_stepping_into = False
+        # the frame being stepped by thread id, and the code objects of those frames
+        self.step_frames = {}
+        self.step_code = set()
+        # all code objects that have started executing, by co_filename, so that breakpoints can be
+        # bound to them without waiting for another PY_START
+        self.code_by_file = {}
+        self.known_code = weakref.WeakSet()
+        self.line_code = weakref.WeakSet()
+
+    def start(self):
+        monitoring = sys.monitoring
+        monitoring.use_tool_id(self.tool_id, 'ptvs')
+        for event, callback in self.callbacks.items():
+            monitoring.register_callback(self.tool_id, event, callback)
+        # code that is already running won't get another PY_START
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                if frame.f_code not in self.known_code:
+                    self.register_code(frame.f_code)
+                frame = frame.f_back
+        self.update_events()
+
+    def stop(self):
+        monitoring = sys.monitoring
+        monitoring.set_events(self.tool_id, monitoring.events.NO_EVENTS)
+        for code in list(self.line_code):
+            monitoring.set_local_events(self.tool_id, code, monitoring.events.NO_EVENTS)
+        for event in self.callbacks:
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+
+    def start_thread(self, cur_thread):
+        # the events are global, there's nothing to install on the thread
+        self.update_events()
+
+    def stop_thread(self, cur_thread):
+        pass
+
+    def update_events(self):
+        """enables the events that the threads currently need - the base events if no thread is
+        stepping or breaking, the local step events on the code of the frames being stepped, and all
+        events globally if a thread is stepping or breaking in any other way"""
+        self.lock.acquire()
+        try:
+            THREADS_LOCK.acquire()
+            is_stepping = False
+            is_stepping_into = False
+            step_frames = {}
+            for cur_thread in THREADS.values():
+                stepping = cur_thread.stepping
+                if cur_thread.django_stepping:
+                    is_stepping = True
+                elif stepping in USER_STEPPING:
+                    frame = cur_thread.cur_frame
+                    if isinstance(frame, types.FrameType):
+                        step_frames[cur_thread.id] = frame
+                        if stepping == STEPPING_INTO:
+                            is_stepping_into = True
+                    elif frame is not None:
+                        is_stepping = True
+                elif stepping > STEPPING_OVER or stepping < STEPPING_OUT:
+                    # stopped at a breakpoint below the stepped frame, which is still being stepped
+                    frame = self.step_frames.get(cur_thread.id)
+                    if frame is not None:
+                        step_frames[cur_thread.id] = frame
+                    else:
+                        is_stepping = True
+                elif stepping != STEPPING_NONE:
+                    is_stepping = True
+            THREADS_LOCK.release()
+
+            self.step_frames = step_frames
+            step_code = set(frame.f_code for frame in step_frames.values())
+            restart = False
+            if step_code != self.step_code:
+                old_step_code = self.step_code
+                self.step_code = step_code
+                for code in old_step_code ^ step_code:
+                    self.update_local_events(code)
+                restart = True
+            if is_stepping_into and not self.is_stepping_into:
+                # PY_START was disabled for the code that had been seen
+                restart = True
+            self.is_stepping_into = is_stepping_into
+
+            self.is_stepping = is_stepping
+            if is_stepping:
+                events = self.stepping_events
+            elif step_frames:
+                events = self.local_stepping_events
+            else:
+                events = self.base_events
+            if events != self.global_events:
+                self.global_events = events
+                sys.monitoring.set_events(self.tool_id, events)
+                restart = restart or is_stepping
+            if restart:
+                # the lines of the stepped code may have been disabled while it only had breakpoints
+                sys.monitoring.restart_events()
+        finally:
+            self.lock.release()
+
+    def breakpoints_changed(self):
+        for codes in list(self.code_by_file.values()):
+            for code in list(codes):
+                self.update_local_events(code)
+        sys.monitoring.restart_events()
+
+    def sync_frames(self, all_threads):
+        # cur_frame is only maintained for threads that get events, so fetch the current frame
+        # of the others from the interpreter.
+        frames = sys._current_frames()
+        for cur_thread in all_threads:
+            if cur_thread._is_blocked:
+                continue
+            frame = frames.get(cur_thread.id)
+            while frame is not None and not should_send_frame(frame):
+                frame = frame.f_back
+            if frame is not None:
+                cur_thread.cur_frame = frame
+
+    def register_code(self, code):
+        self.known_code.add(code)
+        codes = self.code_by_file.get(code.co_filename)
+        if codes is None:
+            codes = self.code_by_file[code.co_filename] = weakref.WeakSet()
+        codes.add(code)
+        self.update_local_events(code)
+
+    def update_local_events(self, code):
+        if code in self.step_code:
+            sys.monitoring.set_local_events(self.tool_id, code, self.step_events)
+            self.line_code.add(code)
+        elif code_has_breakpoints(code):
+            sys.monitoring.set_local_events(self.tool_id, code, sys.monitoring.events.LINE)
+            self.line_code.add(code)
+        elif code in self.line_code:
+            sys.monitoring.set_local_events(self.tool_id, code, sys.monitoring.events.NO_EVENTS)
+            self.line_code.discard(code)
+
+    def get_thread(self):
+        # THREADS is only read here, which is atomic - taking THREADS_LOCK on every event would be
+        # too expensive.
+        cur_thread = THREADS.get(thread.get_ident())
+        if cur_thread is None or cur_thread.detach:
+            return None
+        return cur_thread
+
+    def dispatch(self, cur_thread, frame, event, arg):
+        # events are sparse, so cur_frame can't be maintained by call/return events alone
+        cur_thread.cur_frame = frame
+        cur_thread.trace_func(frame, event, arg)
+
+    def dispatch_below(self, cur_thread, frame, event, arg):
+        """dispatches an event of a frame below the one being stepped. The frames in between don't get
+        call and return events, so the thread is stepping one level deeper while the event is handled,
+        unless it was told to step again meanwhile."""
+        stepping = cur_thread.stepping
+        if stepping >= STEPPING_INTO:
+            cur_thread.stepping = STEPPING_OVER + 1
+        else:
+            cur_thread.stepping = STEPPING_OUT - 1
+        try:
+            self.dispatch(cur_thread, frame, event, arg)
+        finally:
+            if cur_thread.stepping > STEPPING_OVER or cur_thread.stepping < STEPPING_OUT:
+                cur_thread.stepping = stepping
+
+    def on_start(self, code, instruction_offset, exception = None):
+        if code not in self.known_code:
+            self.register_code(code)
+        is_traced = code.co_name == '<module>' or (DJANGO_BREAKPOINTS and code.co_name == 'render')
+        if not self.is_stepping and not self.is_stepping_into and not is_traced:
+            if exception is None:
+                return sys.monitoring.DISABLE
+            return
+        cur_thread = self.get_thread()
+        if cur_thread is not None:
+            if cur_thread.id not in self.step_frames:
+                if self.is_stepping or is_traced:
+                    self.dispatch(cur_thread, sys._getframe(1), 'call', None)
+            elif cur_thread.stepping == STEPPING_INTO:
+                self.dispatch(cur_thread, sys._getframe(1), 'call', None)
+                if cur_thread.stepping != STEPPING_INTO:
+                    # stepped into this frame, which is stepped over from now on
+                    self.update_events()
+            else:
+                self.dispatch_below(cur_thread, sys._getframe(1), 'call', None)
+
+    def on_return(self, code, instruction_offset, retval):
+        if self.is_stepping or code in self.step_code:
+            self.handle_return(sys._getframe(1), retval)
+
+    def on_unwind(self, code, instruction_offset, exception):
+        if self.is_stepping or code in self.step_code:
+            self.handle_return(sys._getframe(1), None)
+
+    def handle_return(self, frame, retval):
+        cur_thread = self.get_thread()
+        if cur_thread is not None:
+            step_frame = self.step_frames.get(cur_thread.id)
+            if step_frame is None:
+                if self.is_stepping:
+                    self.dispatch(cur_thread, frame, 'return', retval)
+            elif frame is step_frame:
+                self.dispatch(cur_thread, frame, 'return', retval)
+                if self.step_frames.get(cur_thread.id) is frame:
+                    # still stepping after returning into code that isn't debugged, so step the caller
+                    self.update_events()
+
+    def on_line(self, code, line_number):
+        is_step_code = code in self.step_code
+        if not self.is_stepping and not is_step_code and line_number not in get_breakpoint_lines(code.co_filename):
+            return sys.monitoring.DISABLE
+        cur_thread = self.get_thread()
+        if cur_thread is not None:
+            frame = sys._getframe(1)
+            step_frame = self.step_frames.get(cur_thread.id)
+            if frame is step_frame:
+                self.dispatch(cur_thread, frame, 'line', None)
+            elif line_number in get_breakpoint_lines(code.co_filename):
+                if step_frame is None:
+                    self.dispatch(cur_thread, frame, 'line', None)
+                else:
+                    self.dispatch_below(cur_thread, frame, 'line', None)
+            elif self.is_stepping and step_frame is None:
+                # LINE is enabled globally, but nothing but a breakpoint can stop below the frame being
+                # stepped over or out of
+                stepping = cur_thread.stepping
+                if STEPPING_OUT <= stepping <= STEPPING_OVER:
+                    self.dispatch(cur_thread, frame, 'line', None)
+
+    def on_raise(self, code, instruction_offset, exception):
+        cur_thread = self.get_thread()
+        if cur_thread is not None:
+            self.dispatch(cur_thread, sys._getframe(1), 'exception', (type(exception), exception, exception.__traceback__))
+
+TRACE_ENGINE = SettraceEngine()
+
+def start_trace_engine():
+    """picks the engine that will be used to trace threads until the debugger detaches"""
+    global TRACE_ENGINE
+    TRACE_ENGINE = SettraceEngine()
+    # Threads that are already being traced with sys.settrace (e.g. by enable_attach or the REPL)
+    # have to stay on it, unless they're only traced while the debugger is attached.
+    if TRACE_ONLY_WHEN_ATTACHED or not THREADS:
+        if MonitoringEngine.is_supported():
+            engine = MonitoringEngine()
+            try:
+                engine.start()
+            except:
+                try:
+                    engine.stop()
+                except:
+                    pass
+            else:
+                TRACE_ENGINE = engine
+
+def stop_trace_engine():
+    global TRACE_ENGINE
+    TRACE_ENGINE.stop()
+    TRACE_ENGINE = SettraceEngine()
 
 def do_wait():
     try:
@@ -2230,8 +3704,426 @@ def enable_output_redirection():
     sys.stdout = _DebuggerOutput(sys.stdout, is_stdout = True)
     sys.stderr = _DebuggerOutput(sys.stderr, is_stdout = False)
 
-def connect_repl_using_socket(sock):
-    _start_new_thread(DebuggerLoop.instance.connect_to_repl_backend_using_socket, (sock,))
+def connect_repl_using_socket(sock, reader = None):
+    _start_new_thread(DebuggerLoop.instance.connect_to_repl_backend_using_socket, (sock, reader))
+
+# Time budgets, in seconds, for computing the repr, hex repr and length of a value shown in the variables
+# windows (including getting attributes), and for evaluating an expression requested by the debugger. Zero
+# disables the budget. Both can be changed with the 'evto' command.
+REPR_TIMEOUT = 1.0
+EVAL_TIMEOUT = 3.0
+TIMED_OUT_REPR = '<timed out>'
+
+class EvaluationTimeout(BaseException):
+    """raised in a thread whose evaluation ran out of time.  Derives from BaseException, so that it isn't
+    caught by "except Exception" in the code being evaluated."""
+
+class EvaluationWatchdog(object):
+    """Interrupts evaluations that run longer than their time budget, by raising EvaluationTimeout in the
+    evaluating thread with PyThreadState_SetAsyncExc. Where that isn't available, evaluations run without
+    a budget. The watchdog thread is started when needed, and exits once it has been idle for a while."""
+
+    interval = 0.05
+    idle_time = 1.0
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        # {id(token): token}, where token is [thread id, deadline, timed out, timeout, progress, seen progress]
+        self.pending = {}
+        self.running = False
+        self.last_start = 0
+        try:
+            thread_id_type = ctypes.c_ulong if sys.version_info >= (3, 7) else ctypes.c_long
+            func = ('PyThreadState_SetAsyncExc', ctypes.pythonapi)
+            self.raise_exc = ctypes.PYFUNCTYPE(ctypes.c_int, thread_id_type, ctypes.py_object)(func)
+            self.clear_exc = ctypes.PYFUNCTYPE(ctypes.c_int, thread_id_type, ctypes.c_void_p)(func)
+        except:
+            self.raise_exc = self.clear_exc = None
+
+    def start(self, timeout):
+        """starts timing an evaluation on the current thread, and returns the token to pass to stop"""
+        if not timeout or self.raise_exc is None:
+            return None
+        now = time.time()
+        token = [thread.get_ident(), now + timeout, False, timeout, 0, 0]
+        with self.lock:
+            self.pending[id(token)] = token
+            self.last_start = now
+            start_watchdog = not self.running
+            self.running = True
+        if start_watchdog:
+            _start_new_thread(self.watch, ())
+        return token
+
+    def stop(self, token):
+        """stops timing the evaluation, and returns whether it ran out of time"""
+        if token is None:
+            return False
+        with self.lock:
+            self.pending.pop(id(token), None)
+        if token[2]:
+            # the evaluation may have completed before the exception was raised, don't leave it pending
+            self.clear_exc(token[0], None)
+        return token[2]
+
+    def call(self, timeout, func, *args):
+        """calls func(*args), and returns (True, None) if it ran out of time, or (False, result) otherwise.
+        Any other exception raised by func is propagated."""
+        if COLLECT_STATS:
+            return STATS.time_evaluation(self.call_with_timeout, timeout, func, *args)
+        return self.call_with_timeout(timeout, func, *args)
+
+    def call_with_timeout(self, timeout, func, *args):
+        token = self.start(timeout)
+        try:
+            try:
+                res = func(*args)
+            finally:
+                timed_out = self.stop(token)
+        except EvaluationTimeout:
+            if token is None or not token[2]:
+                # an outer evaluation ran out of time
+                raise
+            return True, None
+        if timed_out:
+            return True, None
+        return False, res
+
+    def call_each(self, timeout, func, items):
+        """calls func(item) for each of items (a sequence), each within timeout, and returns a list of what call
+        would have returned for each. Rather than being started and stopped for each item, a single token is used,
+        whose progress is advanced before each call; the watchdog gives the token a new deadline when it sees that.
+        The exception can then be raised anywhere in the loop, so the items are only evaluated while it is caught,
+        and the token is stopped before leaving it."""
+        if COLLECT_STATS:
+            return [self.call(timeout, func, item) for item in items]
+        token = self.start(timeout)
+        if token is None:
+            return [(False, func(item)) for item in items]
+
+        results = []
+        evaluating = None
+        try:
+            while True:
+                try:
+                    for item in islice(items, len(results), None):
+                        if token is None:
+                            token = self.start(timeout)
+                        else:
+                            token[4] += 1
+                        evaluating = len(results)
+                        results.append((False, func(item)))
+                    self.stop(token)
+                    token = None
+                    return results
+                except EvaluationTimeout:
+                    if token is None or not token[2]:
+                        raise
+                    # the watchdog is done with this token, start a new one for the remaining items
+                    self.stop(token)
+                    token = None
+                    # unless the exception was raised after the result was added, or between items
+                    if len(results) == evaluating:
+                        results.append((True, None))
+        finally:
+            self.stop(token)
+
+    def watch(self):
+        try:
+            while True:
+                time.sleep(self.interval)
+                now = time.time()
+                with self.lock:
+                    if not self.pending and now - self.last_start > self.idle_time:
+                        self.running = False
+                        return
+                    for key, token in list(self.pending.items()):
+                        if token[4] != token[5]:
+                            # call_each moved on to its next item since the last check
+                            token[5] = token[4]
+                            token[1] = now + token[3]
+                        elif token[1] <= now:
+                            del self.pending[key]
+                            token[2] = True
+                            self.raise_exc(token[0], EvaluationTimeout)
+        except:
+            # the process is shutting down
+            self.running = False
+
+EVALUATION_WATCHDOG = EvaluationWatchdog()
+
+class DebuggerStats(object):
+    """Counters and timers for the overhead of the debugger on the process, collected while COLLECT_STATS
+    is set. They are updated without taking any lock, so they may miss a few updates made concurrently by
+    several threads."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.stop_time = None
+        self.trace_events = {}          # {event: count}
+        self.trace_time = 0.0
+        self.should_debug_code_calls = 0
+        self.messages_sent = {}         # {message type: count}
+        self.bytes_sent = {}            # {message type: byte count}
+        self.sends = 0
+        self.send_lock_acquires = 0
+        self.send_lock_time = 0.0
+        self.evaluations = 0
+        self.evaluation_timeouts = 0
+        self.evaluation_time = 0.0
+        self.max_evaluation_time = 0.0
+
+    def trace(self, cur_thread, frame, event, arg):
+        """calls the trace function of the thread, counting the event and the time spent in the trace
+        function, less the time the thread was stopped"""
+        blocked_time = cur_thread.blocked_time
+        cur_thread.timing_trace = True
+        start = stats_timer()
+        try:
+            return cur_thread.trace_func(frame, event, arg)
+        finally:
+            self.trace_time += stats_timer() - start - (cur_thread.blocked_time - blocked_time)
+            cur_thread.timing_trace = False
+            trace_events = self.trace_events
+            trace_events[event] = trace_events.get(event, 0) + 1
+
+    def count_sent(self, size, starts):
+        """counts the messages sent in one go, given the size of the data sent and the (offset, message
+        type) of each message in it"""
+        self.sends += 1
+        messages_sent = self.messages_sent
+        bytes_sent = self.bytes_sent
+        end = size
+        for offset, msg_type in reversed(starts):
+            messages_sent[msg_type] = messages_sent.get(msg_type, 0) + 1
+            bytes_sent[msg_type] = bytes_sent.get(msg_type, 0) + end - offset
+            end = offset
+
+    def time_evaluation(self, func, *args):
+        """calls func(*args) which evaluates user code, and returns (timed out, result) as
+        EvaluationWatchdog.call does"""
+        start = stats_timer()
+        try:
+            res = func(*args)
+        finally:
+            duration = stats_timer() - start
+            self.evaluations += 1
+            self.evaluation_time += duration
+            if duration > self.max_evaluation_time:
+                self.max_evaluation_time = duration
+        if res[0]:
+            self.evaluation_timeouts += 1
+        return res
+
+    def get(self):
+        """returns the counters and timers as a flat dict, with the times in seconds"""
+        stop_time = self.stop_time
+        if stop_time is None:
+            stop_time = time.time()
+        stats = {
+            'collecting' : COLLECT_STATS,
+            'seconds' : stop_time - self.start_time,
+            'trace_time' : self.trace_time,
+            'should_debug_code_calls' : self.should_debug_code_calls,
+            'sends' : self.sends,
+            'send_lock_acquires' : self.send_lock_acquires,
+            'send_lock_time' : self.send_lock_time,
+            'evaluations' : self.evaluations,
+            'evaluation_timeouts' : self.evaluation_timeouts,
+            'evaluation_time' : self.evaluation_time,
+            'max_evaluation_time' : self.max_evaluation_time,
+        }
+        for event, count in list(self.trace_events.items()):
+            stats['trace_events.' + event] = count
+        stats['trace_events'] = sum(self.trace_events.values())
+        for msg_type, count in list(self.messages_sent.items()):
+            name = str(msg_type.decode('ascii'))
+            stats['messages_sent.' + name] = count
+            stats['bytes_sent.' + name] = self.bytes_sent.get(msg_type, 0)
+        stats['messages_sent'] = sum(self.messages_sent.values())
+        stats['bytes_sent'] = sum(self.bytes_sent.values())
+        return stats
+
+STATS = DebuggerStats()
+
+def collect_stats(enabled):
+    """starts collecting the counters and timers of STATS from zero, or stops collecting them"""
+    global COLLECT_STATS
+    if enabled:
+        STATS.reset()
+    elif COLLECT_STATS:
+        STATS.stop_time = time.time()
+    COLLECT_STATS = enabled
+
+def report_stats(stats):
+    msg = MessageWriter()
+    msg.write_bytes(STAT)
+    msg.write_int(len(stats))
+    for name in sorted(stats):
+        value = stats[name]
+        if isinstance(value, float):
+            value = repr(value)
+        else:
+            value = str(int(value))
+        msg.write_string(name)
+        msg.write_string(value)
+    with _SendLockCtx:
+        msg.send(conn)
+
+def get_object_info(obj):
+    """returns the repr, hex repr and length of obj for the variables windows, within REPR_TIMEOUT"""
+    timed_out, res = EVALUATION_WATCHDOG.call(REPR_TIMEOUT, _get_object_info, obj)
+    if timed_out:
+        return TIMED_OUT_REPR, None, None
+    return res
+
+def get_objects_info(objs):
+    """returns the result of get_object_info for each of objs"""
+    return [res if not timed_out else (TIMED_OUT_REPR, None, None)
+            for timed_out, res in EVALUATION_WATCHDOG.call_each(REPR_TIMEOUT, _get_object_info, objs)]
+
+def _get_object_info(obj):
+    return safe_repr(obj), safe_hex_repr(obj), get_object_len(obj)
+
+# A thread's pending output is sent once this many characters are pending...
+OUTPUT_PUMP_SIZE = 8192
+# ...or at the latest this many seconds after it was written.
+OUTPUT_PUMP_INTERVAL = 0.05
+
+class OutputPump(object):
+    """Collects the redirected output of each thread, so that it is sent with as few OUTP messages as
+    possible. Each thread's output is kept in order in its own buffer, which is sent up to the last complete
+    line once OUTPUT_PUMP_SIZE characters are pending, and entirely when it is flushed, before the debugger is
+    notified that a thread stopped or exited, and by a background thread OUTPUT_PUMP_INTERVAL seconds after
+    it was written.  The exits of threads are batched the same way, and sent after the pending output.  The
+    background thread is started by the first write after it exited, and exits once nothing is pending."""
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.pending = {}   # {thread id: [text, ...]}
+        self.sizes = {}     # {thread id: number of pending characters}
+        self.exits = []     # [thread id, ...]
+        self.flusher_running = False
+
+    def write(self, tid, text):
+        if not text:
+            return
+        self.lock.acquire()
+        try:
+            chunks = self.pending.get(tid)
+            if chunks is None:
+                self.pending[tid] = chunks = []
+                self.sizes[tid] = 0
+            chunks.append(text)
+            size = self.sizes[tid] = self.sizes[tid] + len(text)
+            start_flusher = not self.flusher_running
+            self.flusher_running = True
+        finally:
+            self.lock.release()
+
+        if start_flusher:
+            _start_new_thread(self.flusher, ())
+        if size >= OUTPUT_PUMP_SIZE:
+            self.send((tid,), whole_lines = True)
+
+    def thread_exited(self, tid):
+        self.lock.acquire()
+        try:
+            self.exits.append(tid)
+            start_flusher = not self.flusher_running
+            self.flusher_running = True
+        finally:
+            self.lock.release()
+
+        if start_flusher:
+            _start_new_thread(self.flusher, ())
+
+    def write_exits(self, msg):
+        """writes an EXTT for each pending thread exit.  Must be called with the send lock held."""
+        if not self.exits:
+            return
+        self.lock.acquire()
+        exits = self.exits
+        self.exits = []
+        self.lock.release()
+        for tid in exits:
+            msg.write_bytes(EXTT)
+            msg.write_int(tid)
+
+    def send(self, tids = None, whole_lines = False):
+        """sends the pending output of the given threads, or of all threads along with the pending thread
+        exits"""
+        if not self.pending and (tids is not None or not self.exits):
+            return
+        probe_stack(3)
+        # the output is taken while holding the send lock, so that it is sent in the order it was written
+        with _SendLockCtx:
+            outputs = []
+            send_exits = tids is None
+            self.lock.acquire()
+            try:
+                if tids is None:
+                    tids = list(self.pending)
+                for tid in tids:
+                    chunks = self.pending.pop(tid, None)
+                    if not chunks:
+                        continue
+                    del self.sizes[tid]
+                    try:
+                        text = ''.join(chunks)
+                    except:
+                        # mixed str and unicode which can't be combined, send them as they were written
+                        outputs.extend((tid, chunk) for chunk in chunks)
+                        continue
+                    if whole_lines:
+                        end = text.rfind('\n') + 1
+                        if 0 < end < len(text):
+                            self.pending[tid] = [text[end:]]
+                            self.sizes[tid] = len(text) - end
+                            text = text[:end]
+                    outputs.append((tid, text))
+            finally:
+                self.lock.release()
+
+            msg = MessageWriter()
+            for tid, text in outputs:
+                # the debugger ignores the output of threads it doesn't know about
+                cur_thread = THREADS.get(tid)
+                if cur_thread is not None:
+                    cur_thread.write_new_thread(msg)
+                msg.write_bytes(OUTP)
+                msg.write_int(tid)
+                msg.write_string(text)
+            if send_exits:
+                self.write_exits(msg)
+            if msg.buffer:
+                msg.send(conn)
+
+    def flusher(self):
+        while True:
+            time.sleep(OUTPUT_PUMP_INTERVAL)
+            if not DETACHED:
+                try:
+                    self.send()
+                except:
+                    # the connection is gone, the output that was taken for sending is lost with it
+                    pass
+            self.lock.acquire()
+            try:
+                if DETACHED:
+                    self.pending.clear()
+                    self.sizes.clear()
+                    self.exits = []
+                if not self.pending and not self.exits:
+                    self.flusher_running = False
+                    return
+            finally:
+                self.lock.release()
+
+OUTPUT_PUMP = OutputPump()
 
 class _DebuggerOutput(object):
     """file like object which redirects output to the repl window."""
@@ -2244,6 +4136,8 @@ class _DebuggerOutput(object):
             self.buffer = DebuggerBuffer(old_out.buffer)
 
     def flush(self):
+        if not DETACHED:
+            OUTPUT_PUMP.send((thread.get_ident(),))
         if self.old_out:
             self.old_out.flush()
 
@@ -2257,11 +4151,7 @@ class _DebuggerOutput(object):
 
     def write(self, value):
         if not DETACHED:
-            probe_stack(3)
-            with _SendLockCtx:
-                write_bytes(conn, OUTP)
-                write_int(conn, thread.get_ident())
-                write_string(conn, value)
+            OUTPUT_PUMP.write(thread.get_ident(), value)
         if self.old_out:
             self.old_out.write(value)
 
@@ -2287,15 +4177,12 @@ class DebuggerBuffer(object):
 
     def write(self, data):
         if not DETACHED:
-            probe_stack(3)
-            str_data = utf_8.decode(data)[0]
-            with _SendLockCtx:
-                write_bytes(conn, OUTP)
-                write_int(conn, thread.get_ident())
-                write_string(conn, str_data)
+            OUTPUT_PUMP.write(thread.get_ident(), utf_8.decode(data)[0])
         self.buffer.write(data)
 
     def flush(self): 
+        if not DETACHED:
+            OUTPUT_PUMP.send((thread.get_ident(),))
         self.buffer.flush()
 
     def truncate(self, pos = None):
@@ -2380,7 +4267,7 @@ def debug(
     cur_thread.stepping = STEPPING_LAUNCH_BREAK
 
     # start tracing on this thread
-    sys.settrace(cur_thread.trace_func)
+    TRACE_ENGINE.start_thread(cur_thread)
 
     # now execute main file
     globals_obj = {'__name__': '__main__'}
@@ -2392,7 +4279,7 @@ def debug(
         else:
             exec_file(file, globals_obj)
     finally:
-        sys.settrace(None)
+        TRACE_ENGINE.stop_thread(cur_thread)
         THREADS_LOCK.acquire()
         del THREADS[cur_thread.id]
         THREADS_LOCK.release()
@@ -2405,8 +4292,11 @@ def debug(
             import threading
         global last_ack_event
         last_ack_event = threading.Event()
+        OUTPUT_PUMP.send()
+        msg = MessageWriter()
+        msg.write_bytes(LAST)
         with _SendLockCtx:
-            write_bytes(conn, LAST)
+            msg.send(conn)
         last_ack_event.wait(5)
 
     if wait_on_exit:
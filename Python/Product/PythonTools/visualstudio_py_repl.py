@@ -30,7 +30,6 @@ import socket
 import select
 import time
 import struct
-import imp
 import traceback
 import random
 import os
@@ -54,6 +53,9 @@ read_string = _vspu.read_string
 write_bytes = _vspu.write_bytes
 write_int = _vspu.write_int
 write_string = _vspu.write_string
+MessageWriter = _vspu.MessageWriter
+ConnectionReader = _vspu.ConnectionReader
+new_module = _vspu.new_module
 
 try:
     unicode
@@ -163,6 +165,7 @@ actual inspection and introspection."""
     
     def __init__(self):
         self.conn = None
+        self.reader = None
         self.send_lock = SafeSendLock()
         self.input_event = threading.Lock()
         self.input_event.acquire()  # lock starts acquired (we use it like a manual reset event)        
@@ -172,12 +175,14 @@ actual inspection and introspection."""
     def connect(self, port):
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect(('127.0.0.1', port))
+        self.reader = ConnectionReader(self.conn)
 
         # start a new thread for communicating w/ the remote process
         start_new_thread(self._repl_loop, ())
 
-    def connect_using_socket(self, socket):
+    def connect_using_socket(self, socket, reader = None):
         self.conn = socket
+        self.reader = reader or ConnectionReader(socket)
         start_new_thread(self._repl_loop, ())
 
     def _repl_loop(self):
@@ -199,7 +204,7 @@ actual inspection and introspection."""
                 else:
                     timeout_exc_types = socket.timeout
                 try:
-                    inp = read_bytes(self.conn, 4)
+                    inp = read_bytes(self.reader, 4)
                 except timeout_exc_types: 
                     r, w, x = select.select([], [], [self.conn], 0)
                     if x:
@@ -234,7 +239,7 @@ actual inspection and introspection."""
 
     def _cmd_run(self):
         """runs the received snippet of code"""
-        self.run_command(read_string(self.conn))
+        self.run_command(read_string(self.reader))
 
     def _cmd_abrt(self):
         """aborts the current running command"""
@@ -248,7 +253,7 @@ actual inspection and introspection."""
 
     def _cmd_mems(self):
         """gets the list of members available for the given expression"""
-        expression = read_string(self.conn)
+        expression = read_string(self.reader)
         try:
             name, inst_members, type_members = self.get_members(expression)
         except:
@@ -257,15 +262,17 @@ actual inspection and introspection."""
             _debug_write('error in eval')
             _debug_write(traceback.format_exc())
         else:
+            msg = MessageWriter()
+            msg.write_bytes(ReplBackend._MRES)
+            msg.write_string(name)
+            self._write_member_dict(msg, inst_members)
+            self._write_member_dict(msg, type_members)
             with self.send_lock:
-                write_bytes(self.conn, ReplBackend._MRES)
-                write_string(self.conn, name)
-                self._write_member_dict(inst_members)
-                self._write_member_dict(type_members)
+                msg.send(self.conn)
 
     def _cmd_sigs(self):
         """gets the signatures for the given expression"""
-        expression = read_string(self.conn)
+        expression = read_string(self.reader)
         try:
             sigs = self.get_signatures(expression)
         except:
@@ -274,35 +281,37 @@ actual inspection and introspection."""
             _debug_write('error in eval')
             _debug_write(traceback.format_exc())
         else:
+            msg = MessageWriter()
+            msg.write_bytes(ReplBackend._SRES)
+            # single overload
+            msg.write_int(len(sigs))
+            for doc, args, vargs, varkw, defaults in sigs:
+                # write overload
+                msg.write_string((doc or '')[:4096])
+                arg_count = len(args) + (vargs is not None) + (varkw is not None)
+                msg.write_int(arg_count)
+                
+                def_values = [''] * (len(args) - len(defaults)) + ['=' + d for d in defaults]
+                for arg, def_value in zip(args, def_values):
+                    msg.write_string((arg or '') + def_value)
+                if vargs is not None:
+                    msg.write_string('*' + vargs)
+                if varkw is not None:
+                    msg.write_string('**' + varkw)
             with self.send_lock:
-                write_bytes(self.conn, ReplBackend._SRES)
-                # single overload
-                write_int(self.conn, len(sigs))
-                for doc, args, vargs, varkw, defaults in sigs:
-                    # write overload
-                    write_string(self.conn, (doc or '')[:4096])
-                    arg_count = len(args) + (vargs is not None) + (varkw is not None)
-                    write_int(self.conn, arg_count)
-                    
-                    def_values = [''] * (len(args) - len(defaults)) + ['=' + d for d in defaults]
-                    for arg, def_value in zip(args, def_values):
-                        write_string(self.conn, (arg or '') + def_value)
-                    if vargs is not None:
-                        write_string(self.conn, '*' + vargs)
-                    if varkw is not None:
-                        write_string(self.conn, '**' + varkw)
+                msg.send(self.conn)
     
     def _cmd_setm(self):
         global exec_mod
         """sets the current module which code will execute against"""
-        mod_name = read_string(self.conn)
+        mod_name = read_string(self.reader)
         self.set_current_module(mod_name)
 
     def _cmd_sett(self):
         """sets the current thread and frame which code will execute against"""
-        thread_id = read_int(self.conn)
-        frame_id = read_int(self.conn)
-        frame_kind = read_int(self.conn)
+        thread_id = read_int(self.reader)
+        frame_id = read_int(self.reader)
+        frame_kind = read_int(self.reader)
         self.set_current_thread_and_frame(thread_id, frame_id, frame_kind)
 
     def _cmd_mods(self):
@@ -313,34 +322,36 @@ actual inspection and introspection."""
         except:
             res = []
         
+        msg = MessageWriter()
+        msg.write_bytes(ReplBackend._MODS)
+        msg.write_int(len(res))
+        for name, filename in res:
+            msg.write_string(name)
+            msg.write_string(filename)
         with self.send_lock:
-            write_bytes(self.conn, ReplBackend._MODS)
-            write_int(self.conn, len(res))
-            for name, filename in res:
-                write_string(self.conn, name)
-                write_string(self.conn, filename)
+            msg.send(self.conn)
 
     def _cmd_inpl(self):
         """handles the input command which returns a string of input"""
-        self.input_string = read_string(self.conn)
+        self.input_string = read_string(self.reader)
         self.input_event.release()
     
     def _cmd_excf(self):
         """handles executing a single file"""
-        filename = read_string(self.conn)
-        args = read_string(self.conn)
+        filename = read_string(self.reader)
+        args = read_string(self.reader)
         self.execute_file(filename, args)
 
     def _cmd_excx(self):
         """handles executing a single file, module or process"""
-        filetype = read_string(self.conn)
-        filename = read_string(self.conn)
-        args = read_string(self.conn)
+        filetype = read_string(self.reader)
+        filename = read_string(self.reader)
+        args = read_string(self.reader)
         self.execute_file_ex(filetype, filename, args)
 
     def _cmd_debug_attach(self):
-        port = read_int(self.conn)
-        id = read_string(self.conn)
+        port = read_int(self.reader)
+        id = read_string(self.reader)
         self.attach_process(port, id)
 
     _COMMANDS = {
@@ -358,11 +369,11 @@ actual inspection and introspection."""
         to_bytes('dbga'): _cmd_debug_attach,
     }
 
-    def _write_member_dict(self, mem_dict):
-        write_int(self.conn, len(mem_dict))
+    def _write_member_dict(self, msg, mem_dict):
+        msg.write_int(len(mem_dict))
         for name, type_name in mem_dict.items():
-            write_string(self.conn, name)
-            write_string(self.conn, type_name)
+            msg.write_string(name)
+            msg.write_string(type_name)
 
     def on_debugger_detach(self):
         with self.send_lock:
@@ -532,7 +543,7 @@ class BasicReplBackend(ReplBackend):
                 self.exec_mod = Scope()
                 self.exec_mod.__name__ = '__main__'
             else:
-                sys.modules[mod_name] = self.exec_mod = imp.new_module(mod_name)
+                sys.modules[mod_name] = self.exec_mod = new_module(mod_name)
         else:
             self.exec_mod = sys.modules['__main__']
 
@@ -555,8 +566,8 @@ class BasicReplBackend(ReplBackend):
         ReplBackend.connect(self, port)
         self.init_connection()
 
-    def connect_using_socket(self, socket):
-        ReplBackend.connect_using_socket(self, socket)
+    def connect_using_socket(self, socket, reader = None):
+        ReplBackend.connect_using_socket(self, socket, reader)
         self.init_connection()
 
 
@@ -1043,8 +1054,8 @@ class DebugReplBackend(BasicReplBackend):
         ReplBackend.connect(self, port)
         self.init_connection()
 
-    def connect_from_debugger_using_socket(self, socket):
-        ReplBackend.connect_using_socket(self, socket)
+    def connect_from_debugger_using_socket(self, socket, reader = None):
+        ReplBackend.connect_using_socket(self, socket, reader)
         self.init_connection()
 
     def disconnect_from_debugger(self):
@@ -12,14 +12,20 @@
  #
  # ###########################################################################
 
-import imp
 import os
 import sys
 import struct
+from itertools import islice
 
 # Import encodings early to avoid import on the debugger thread, which may cause deadlock
 from encodings import utf_8, ascii
 
+try:
+    from imp import new_module
+except ImportError:
+    # imp was removed in Python 3.12
+    from types import ModuleType as new_module
+
 # WARNING: Avoid imports beyond this point, specifically on the debugger thread, as this may cause
 # deadlock where the debugger thread performs an import while a user thread has the import lock
 
@@ -62,7 +68,7 @@ def exec_code(code, file, global_variables):
 
     global_variables = dict(global_variables)
     mod_name = global_variables.setdefault('__name__', '<run_path>')
-    mod = sys.modules[mod_name] = imp.new_module(mod_name)
+    mod = sys.modules[mod_name] = new_module(mod_name)
     mod.__dict__.update(global_variables)
     global_variables = mod.__dict__
     global_variables.setdefault('__file__', file)
@@ -117,8 +123,69 @@ UNICODE_PREFIX = to_bytes('U')
 ASCII_PREFIX = to_bytes('A')
 NONE_PREFIX = to_bytes('N')
 
+INT_STRUCT = struct.Struct('!q')
+INT_PLACEHOLDER = to_bytes('\0' * INT_STRUCT.size)
+
+
+class ConnectionReader(object):
+    """reads from a socket through a reusable buffer, so that command names and ints are
+    served from the buffer rather than with a recv call each, and large strings are received
+    in place rather than concatenated.  Can be passed to read_bytes, read_int and read_string
+    instead of the socket."""
+
+    def __init__(self, conn, buffer_size = 65536):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _recv_into(self, view):
+        received = self.conn.recv_into(view)
+        if not received:
+            raise EOFError('connection closed')
+        return received
+
+    def _fill(self, count):
+        """receives until at least count bytes are buffered"""
+        if self.start + count > len(self.buffer):
+            # move the unread bytes to the front to make room
+            available = self.end - self.start
+            self.view[:available] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = available
+        while self.end - self.start < count:
+            self.end += self._recv_into(self.view[self.end:])
+
+    def read_bytes(self, count):
+        if count > len(self.buffer):
+            # too large for the buffer, receive directly into the result
+            res = bytearray(count)
+            res_view = memoryview(res)
+            pos = self.end - self.start
+            res_view[:pos] = self.view[self.start:self.end]
+            self.start = self.end = 0
+            while pos < count:
+                pos += self._recv_into(res_view[pos:])
+            return bytes(res)
+
+        if self.end - self.start < count:
+            self._fill(count)
+        start = self.start
+        self.start = start + count
+        return self.view[start:start + count].tobytes()
+
+    def read_int(self):
+        if self.end - self.start < INT_STRUCT.size:
+            self._fill(INT_STRUCT.size)
+        start = self.start
+        self.start = start + INT_STRUCT.size
+        return INT_STRUCT.unpack_from(self.buffer, start)[0]
+
 
 def read_bytes(conn, count):
+    if isinstance(conn, ConnectionReader):
+        return conn.read_bytes(count)
     b = to_bytes('')
     while len(b) < count:
         b += conn.recv(count - len(b))
@@ -130,6 +197,8 @@ def write_bytes(conn, b):
 
 
 def read_int(conn):
+    if isinstance(conn, ConnectionReader):
+        return conn.read_int()
     return struct.unpack('!q', read_bytes(conn, 8))[0]
 
 
@@ -142,9 +211,7 @@ def read_string(conn):
     strlen = read_int(conn)
     if not strlen:
         return ''
-    res = to_bytes('')
-    while len(res) < strlen:
-        res = res + conn.recv(strlen - len(res))
+    res = read_bytes(conn, strlen)
 
     res = utf_8.decode(res)[0]
     if sys.version_info[0] == 2 and sys.platform != 'cli':
@@ -174,6 +241,47 @@ def write_string(conn, s):
         if s_len > 0:
             write_bytes(conn, s)
 
+
+class MessageWriter(object):
+    """accumulates a message in the same format as write_bytes, write_int and write_string,
+    so that it can be sent with a single sendall call once it is complete."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write_bytes(self, b):
+        self.buffer += b
+
+    def write_int(self, i):
+        buffer = self.buffer
+        pos = len(buffer)
+        buffer += INT_PLACEHOLDER
+        INT_STRUCT.pack_into(buffer, pos, i)
+
+    def write_string(self, s):
+        buffer = self.buffer
+        if s is None:
+            buffer += NONE_PREFIX
+            return
+        elif isinstance(s, unicode):
+            b = utf_8.encode(s)[0]
+            buffer += UNICODE_PREFIX
+        else:
+            b = s
+            buffer += ASCII_PREFIX
+        pos = len(buffer)
+        buffer += INT_PLACEHOLDER
+        INT_STRUCT.pack_into(buffer, pos, len(b))
+        buffer += b
+
+    # allows the write_* functions above to be used on a message as well
+    sendall = write_bytes
+
+    def send(self, conn):
+        """sends the message, and resets it so that the writer can be reused"""
+        conn.sendall(self.buffer)
+        del self.buffer[:]
+
 class SafeRepr(object):
     # String types are truncated to maxstring_outer when at the outer-
     # most level, and truncated to maxstring_inner characters inside
@@ -220,6 +328,12 @@ class SafeRepr(object):
     # different limits.
     maxother_outer = 2 ** 16
     maxother_inner = 30
+
+    # The number of types for which the repr strategy is remembered, see _get_repr_func.
+    max_cached_types = 1000
+
+    def __init__(self):
+        self._repr_funcs = {}
     
     def __call__(self, obj):
         try:
@@ -233,8 +347,41 @@ class SafeRepr(object):
     def _repr(self, obj, level):
         '''Returns an iterable of the parts in the final repr string.'''
 
+        obj_type = type(obj)
         try:
-            obj_repr = type(obj).__repr__
+            is_proxy = obj.__class__ is not obj_type
+        except:
+            is_proxy = True
+        if is_proxy:
+            # Objects that claim to be of another class (mocks and other proxies) are matched by isinstance(),
+            # which goes by __class__, so what matches them isn't decided by their type alone.
+            repr_func, args = self._get_repr_func(obj_type, lambda t: isinstance(obj, t))
+        else:
+            try:
+                repr_func, args = self._repr_funcs[obj_type]
+            except KeyError:
+                repr_func, args = self._get_repr_func(obj_type, lambda t: issubclass(obj_type, t))
+                if len(self._repr_funcs) >= self.max_cached_types:
+                    self._repr_funcs.clear()
+                self._repr_funcs[obj_type] = repr_func, args
+            except TypeError:
+                # unhashable type
+                repr_func, args = self._get_repr_func(obj_type, lambda t: issubclass(obj_type, t))
+
+        if repr_func is None:
+            if self._is_long_iter(obj):
+                return self._repr_long_iter(obj)
+            return self._repr_other(obj, level)
+
+        return repr_func(obj, level, *args)
+
+    def _get_repr_func(self, obj_type, is_instance):
+        '''Returns the method and its extra arguments that produce the repr for objects of obj_type,
+        or (None, ()) if they are reprs of other objects. is_instance(t) tells whether the object is
+        an instance of t.'''
+
+        try:
+            obj_repr = obj_type.__repr__
         except:
             obj_repr = None
 
@@ -246,21 +393,18 @@ class SafeRepr(object):
                 return obj_repr is r
 
         for t, prefix, suffix, comma in self.collection_types:
-            if isinstance(obj, t) and has_obj_repr(t):
-                return self._repr_iter(obj, level, prefix, suffix, comma)
-        
+            if is_instance(t) and has_obj_repr(t):
+                return self._repr_iter, (prefix, suffix, comma)
+
         for t, prefix, suffix, item_prefix, item_sep, item_suffix in self.dict_types:
-            if isinstance(obj, t) and has_obj_repr(t):
-                return self._repr_dict(obj, level, prefix, suffix, item_prefix, item_sep, item_suffix)
+            if is_instance(t) and has_obj_repr(t):
+                return self._repr_dict, (prefix, suffix, item_prefix, item_sep, item_suffix)
 
         for t in self.string_types:
-            if isinstance(obj, t) and has_obj_repr(t):
-                return self._repr_str(obj, level)
+            if is_instance(t) and has_obj_repr(t):
+                return self._repr_str, ()
 
-        if self._is_long_iter(obj):
-            return self._repr_long_iter(obj)
-        
-        return self._repr_other(obj, level)
+        return None, ()
 
     # Determines whether an iterable exceeds the limits set in maxlimits, and is therefore unsafe to repr().
     def _is_long_iter(self, obj, level = 0):
@@ -302,9 +446,10 @@ class SafeRepr(object):
                     l = len(obj)
                 except:
                     l = None
-                if l is not None and l > self.maxcollection[level]:
-                    return True
-                return any((self._is_long_iter(item, level + 1) for item in obj))
+                if l is not None:
+                    if l > self.maxcollection[level]:
+                        return True
+                    return any((self._is_long_iter(item, level + 1) for item in obj))
             return any(i > self.maxcollection[level] or self._is_long_iter(item, level + 1) for i, item in enumerate(obj))
 
         except:
@@ -359,10 +504,12 @@ class SafeRepr(object):
         count = self.maxcollection[level]
         yield_comma = False
         
+        # Only the first count keys can be shown, so only those are sorted - taking them in iteration order
+        # keeps the cost independent of the size of the dict.
         try:
-            sorted_keys = sorted(obj)
+            sorted_keys = sorted(islice(obj, count))
         except Exception:
-            sorted_keys = list(obj)
+            sorted_keys = list(islice(obj, count))
         
         for key in sorted_keys:
             if yield_comma:
@@ -0,0 +1,54 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Helpers shared by the debugger benchmarks. The benchmarks run directly against the
+sources in Python/Product/PythonTools, so that no build or install step is needed.
+"""
+
+import os
+import sys
+import time
+
+PYTHON_TOOLS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'Product', 'PythonTools'))
+
+def add_python_tools_path():
+    """makes visualstudio_py_* and the ptvsd package importable.
+
+    In the shipped ptvsd package, visualstudio_py_* are copied into the package
+    directory at build time; here they are aliased as submodules instead."""
+    if PYTHON_TOOLS_DIR not in sys.path:
+        sys.path.insert(0, PYTHON_TOOLS_DIR)
+    import visualstudio_py_util
+    import visualstudio_py_repl
+    import visualstudio_py_debugger
+    for mod in (visualstudio_py_util, visualstudio_py_repl, visualstudio_py_debugger):
+        sys.modules['ptvsd.' + mod.__name__] = mod
+
+def best_of(func, repeat = 5):
+    """returns the best wall clock time, in seconds, of `repeat` calls to func"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, baseline = None):
+    if baseline:
+        print('%-48s %10.4fs  %6.2fx' % (name, seconds, seconds / baseline))
+    else:
+        print('%-48s %10.4fs' % (name, seconds))
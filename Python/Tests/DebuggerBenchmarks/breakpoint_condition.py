@@ -0,0 +1,52 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the cost of evaluating a "when true" breakpoint condition on every
+iteration of a 1M-iteration loop, with the condition compiled once (as
+BreakpointInfo does now) versus passed to eval() as a string on every hit.
+
+Usage: python breakpoint_condition.py
+"""
+
+import sys
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+ITERATIONS = 1000000
+CONDITION = 'i % 3 == 0 and total >= 0'
+
+def loop(evaluate):
+    total = 0
+    for i in range(ITERATIONS):
+        evaluate(sys._getframe())
+        total += i
+    return total
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    bp = vspd.BreakpointInfo(1, __file__, 0, vspd.BREAKPOINT_CONDITION_WHEN_TRUE, CONDITION,
+                             vspd.BREAKPOINT_PASS_COUNT_ALWAYS, 0)
+
+    def eval_string(frame):
+        return eval(bp.condition, frame.f_globals, frame.f_locals)
+
+    baseline = best_of(lambda: loop(lambda frame: None), repeat = 3)
+    report('no condition', baseline)
+    report('eval(condition string)', best_of(lambda: loop(eval_string), repeat = 3), baseline)
+    report('BreakpointInfo.is_condition_met', best_of(lambda: loop(bp.is_condition_met), repeat = 3), baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the cost of collecting the debugger overhead stats (see
+ptvsd.get_stats) for a CPU-bound workload in a process with a debugger
+attached, and prints what they report for it.
+
+Usage: python debugger_stats.py
+"""
+
+import socket
+import threading
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def workload():
+    total = 0
+    for i in range(100000):
+        total += i % 7
+    fib(18)
+    return total
+
+def drain(sock):
+    while True:
+        try:
+            if not sock.recv(65536):
+                return
+        except socket.error:
+            return
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    import ptvsd
+
+    baseline = best_of(workload)
+    report('not attached', baseline)
+
+    client_end, debugger_end = socket.socketpair()
+    client_thread = threading.Thread(target = drain, args = (client_end,))
+    client_thread.daemon = True
+    client_thread.start()
+    vspd.attach_process_from_socket(debugger_end)
+    vspd.TRACE_ENGINE.start_thread(vspd.new_thread())
+
+    attached = best_of(workload)
+    report('attached', attached, baseline)
+
+    ptvsd.enable_stats()
+    report('attached, collecting stats', best_of(workload), baseline)
+    ptvsd.enable_stats(False)
+
+    stats = ptvsd.get_stats()
+    for name in sorted(stats):
+        print('    %-44s %s' % (name, stats[name]))
+
+    vspd.detach_process()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the steady-state slowdown of a CPU-bound loop in a process that has
+called ptvsd.enable_attach, but has no debugger attached.
+
+Usage: python enable_attach_overhead.py
+
+Each mode runs in its own process, since enable_attach can only be called once.
+trace_only_when_attached requires Python 3.12 or later, and is skipped otherwise.
+"""
+
+import subprocess
+import sys
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+MODES = ('none', 'enable_attach', 'enable_attach(trace_only_when_attached=True)')
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def workload():
+    total = 0
+    for i in range(200000):
+        total += i % 7
+    fib(20)
+    return total
+
+def run_mode(mode):
+    if mode != 'none':
+        add_python_tools_path()
+        import ptvsd
+        try:
+            ptvsd.enable_attach(None, ('127.0.0.1', 0), redirect_output = False,
+                                trace_only_when_attached = mode != 'enable_attach')
+        except ValueError:
+            print('unsupported')
+            return
+    print(best_of(workload))
+
+def main():
+    results = []
+    for mode in MODES:
+        out = subprocess.check_output([sys.executable, __file__, mode]).decode('ascii').strip()
+        if out != 'unsupported':
+            results.append((mode, float(out)))
+
+    baseline = results[0][1]
+    for mode, seconds in results:
+        report(mode, seconds, baseline)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_mode(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,74 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures Thread.get_frame_list on a 500-deep recursive stack, as done for every
+stopped thread on every stop. Frame variables are left out (as for clients that
+request them on demand), so that the time is spent on the frames themselves.
+In the "uncached" mode, the line range and filename of each frame are computed
+the way get_frame_list used to, by summing the co_lnotab line increments and
+calling path.abspath for every frame.
+
+Usage: python frame_list.py
+"""
+
+import sys
+import warnings
+from os import path
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+DEPTH = 500
+REPEAT = 100
+
+def recurse(depth, func):
+    if depth:
+        return recurse(depth - 1, func)
+    return func(sys._getframe())
+
+def uncached_code_info(code):
+    lineno = code.co_firstlineno
+    for line_incr in code.co_lnotab[1::2]:
+        if sys.version >= '3':
+            lineno += line_incr
+        else:
+            lineno += ord(line_incr)
+    return code.co_firstlineno, lineno, path.abspath(code.co_filename)
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    vspd.LAZY_FRAME_VARIABLES = True
+    cur_thread = vspd.Thread()
+
+    def frame_list(frame):
+        cur_thread.cur_frame = frame
+        for _ in range(REPEAT):
+            cur_thread.get_frame_list()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), DEPTH + 100))
+    get_code_info = vspd.get_code_info
+    try:
+        vspd.get_code_info = uncached_code_info
+        with warnings.catch_warnings():
+            # co_lnotab is deprecated in Python 3.12
+            warnings.simplefilter('ignore', DeprecationWarning)
+            baseline = best_of(lambda: recurse(DEPTH, frame_list), repeat = 3)
+    finally:
+        vspd.get_code_info = get_code_info
+    report('%d x %d frames, uncached' % (REPEAT, DEPTH), baseline)
+    report('%d x %d frames, get_code_info' % (REPEAT, DEPTH), best_of(lambda: recurse(DEPTH, frame_list), repeat = 3), baseline)
+
+if __name__ == '__main__':
+    main()
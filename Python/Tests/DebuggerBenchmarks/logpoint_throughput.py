@@ -0,0 +1,133 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the throughput of a hot request handler in a process with a debugger
+attached, with no breakpoint in the handler, with a breakpoint that the client
+resumes as soon as it is hit (the way VS handles tracepoints), and with a
+logpoint. The client end of the connection is a thread in this process, so
+the breakpoint mode does not even include real network latency.
+
+Usage: python logpoint_throughput.py
+"""
+
+import socket
+import sys
+import threading
+import time
+
+from benchmark_util import add_python_tools_path, report
+
+REQUESTS = 5000
+BREAKPOINT_ID = 1
+
+def handle_request(request_id, path):
+    response = {'id': request_id, 'path': path, 'status': 200}
+    return response
+
+def serve(flush = None):
+    start = time.time()
+    for i in range(REQUESTS):
+        handle_request(i, '/items/%d' % i)
+    if flush is not None:
+        flush()
+    return time.time() - start
+
+class Client(object):
+    """stands in for VS: resumes all threads whenever a breakpoint is hit"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.breakpoint_hits = 0
+
+    def run(self):
+        tail = b''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            data = tail + data
+            hits = data.count(b'BRKH')
+            if hits:
+                self.breakpoint_hits += hits
+                self.sock.sendall(b'resa' * hits)
+            tail = data[-3:]
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    from visualstudio_py_util import write_bytes, write_int
+
+    client_end, debugger_end = socket.socketpair()
+    client = Client(client_end)
+    client_thread = threading.Thread(target = client.run)
+    client_thread.daemon = True
+    client_thread.start()
+    vspd.attach_process_from_socket(debugger_end)
+    vspd.TRACE_ENGINE.start_thread(vspd.new_thread())
+
+    lineno = handle_request.__code__.co_firstlineno + 2
+    filename = handle_request.__code__.co_filename
+
+    def write_command_string(text):
+        # strings sent to the debugger have no type prefix
+        data = text.encode('utf-8')
+        write_int(client_end, len(data))
+        write_bytes(client_end, data)
+
+    def set_breakpoint(log_message):
+        write_bytes(client_end, vspd.to_bytes('brkp'))
+        write_int(client_end, BREAKPOINT_ID)
+        write_int(client_end, lineno)
+        write_command_string(filename)
+        write_int(client_end, vspd.BREAKPOINT_CONDITION_ALWAYS)
+        write_command_string('')
+        write_int(client_end, vspd.BREAKPOINT_PASS_COUNT_ALWAYS)
+        write_int(client_end, 0)
+        if log_message:
+            write_bytes(client_end, vspd.to_bytes('brkl'))
+            write_int(client_end, BREAKPOINT_ID)
+            write_command_string(log_message)
+        while True:
+            bp = vspd.BreakpointInfo.find_by_id(BREAKPOINT_ID)
+            if bp is not None and bp.is_bound and bp.log_message == log_message:
+                return
+            time.sleep(0.01)
+
+    def remove_breakpoint():
+        write_bytes(client_end, vspd.to_bytes('brkr'))
+        write_int(client_end, lineno)
+        write_int(client_end, BREAKPOINT_ID)
+        while vspd.BREAKPOINTS:
+            time.sleep(0.01)
+
+    baseline = serve()
+    report('%d requests, no breakpoint' % REQUESTS, baseline)
+
+    set_breakpoint(None)
+    report('%d requests, breakpoint resumed by client' % REQUESTS, serve(), baseline)
+    remove_breakpoint()
+
+    set_breakpoint('request {request_id} for {path} -> {response["status"]}')
+    # the logged messages are sent by the output pump; include sending the last of them
+    report('%d requests, logpoint' % REQUESTS, serve(vspd.OUTPUT_PUMP.send), baseline)
+    remove_breakpoint()
+
+    vspd.detach_process()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Counts the socket send calls, and measures the time, needed to send a THRF
+message for a frame with 500 variables and a CHLD message with 1000 children,
+written field by field to the socket versus buffered in a MessageWriter and
+sent with a single sendall call.
+
+Usage: python message_syscalls.py
+"""
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+VARIABLES = 500
+CHILDREN = 1000
+
+class CountingSocket(object):
+    """stands in for the debugger socket, counting the calls made to it"""
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def sendall(self, b):
+        self.calls += 1
+        self.bytes += len(b)
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    from visualstudio_py_util import write_bytes, write_int, write_string
+
+    variables = [('var%d' % i, int, repr(i), hex(i), 'int', 0) for i in range(VARIABLES)]
+    frames = [(1, 10, 5, 'func', __file__, 0, variables, vspd.FRAME_KIND_PYTHON, None, None)]
+    children = [('[%d]' % i, 'x[%d]' % i, i, 0) for i in range(CHILDREN)]
+    thread = vspd.Thread(0)
+
+    def send_frame_list_unbuffered(conn):
+        # the message format of Thread.send_frame_list, written the way it was before MessageWriter
+        write_bytes(conn, vspd.THRF)
+        write_int(conn, thread.id)
+        write_string(conn, None)
+        write_int(conn, len(frames))
+        for firstlineno, lineno, curlineno, name, filename, argcount, variables, frameKind, sourceFile, sourceLine in frames:
+            write_int(conn, firstlineno)
+            write_int(conn, lineno)
+            write_int(conn, curlineno)
+            write_string(conn, name)
+            write_string(conn, filename)
+            write_int(conn, argcount)
+            write_int(conn, frameKind)
+            write_int(conn, len(variables))
+            for name, type_obj, safe_repr_obj, hex_repr_obj, type_name, obj_len in variables:
+                write_string(conn, name)
+                write_string(conn, safe_repr_obj)
+                write_string(conn, hex_repr_obj)
+                write_string(conn, type_name)
+                write_int(conn, obj_len)
+                write_int(conn, 0)
+
+    def send_frame_list_buffered(conn):
+        vspd.conn = conn
+        thread.send_frame_list(frames)
+
+    def report_children_buffered(conn):
+        vspd.conn = conn
+        vspd.report_children(1, children)
+
+    for name, send in (('THRF, %d variables, unbuffered' % VARIABLES, send_frame_list_unbuffered),
+                       ('THRF, %d variables, MessageWriter' % VARIABLES, send_frame_list_buffered),
+                       ('CHLD, %d children, MessageWriter' % CHILDREN, report_children_buffered)):
+        conn = CountingSocket()
+        send(conn)
+        print('%-48s %6d send calls, %7d bytes' % (name, conn.calls, conn.bytes))
+
+    baseline = best_of(lambda: send_frame_list_unbuffered(CountingSocket()))
+    report('THRF unbuffered', baseline)
+    report('THRF MessageWriter', best_of(lambda: send_frame_list_buffered(CountingSocket())), baseline)
+
+if __name__ == '__main__':
+    main()
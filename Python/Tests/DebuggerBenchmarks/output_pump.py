@@ -0,0 +1,92 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures a print-heavy workload with output redirected to a debugger: 100k
+short lines printed by one thread, and by four threads at once. Each write is
+sent as its own OUTP message in the "per write" mode, the way _DebuggerOutput
+used to send output, and collected by the output pump otherwise. The debugger
+end of the connection is a socket that is drained by a background thread.
+
+Usage: python output_pump.py
+"""
+
+import socket
+import sys
+import threading
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+LINES = 100000
+
+class NullOutput(object):
+    def write(self, value):
+        pass
+
+    def flush(self):
+        pass
+
+def drain(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except socket.error:
+        pass
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    from visualstudio_py_util import write_bytes, write_int, write_string
+
+    class PerWriteOutput(vspd._DebuggerOutput):
+        def write(self, value):
+            vspd.probe_stack(3)
+            with vspd._SendLockCtx:
+                write_bytes(vspd.conn, vspd.OUTP)
+                write_int(vspd.conn, vspd.thread.get_ident())
+                write_string(vspd.conn, value)
+
+    debugger_end, vspd.conn = socket.socketpair()
+    drain_thread = threading.Thread(target = drain, args = (debugger_end,))
+    drain_thread.daemon = True
+    drain_thread.start()
+    vspd.DETACHED = False
+
+    def print_lines(count):
+        for i in range(count):
+            print('line %d' % i)
+        sys.stdout.flush()
+
+    def print_on_threads(thread_count):
+        threads = [threading.Thread(target = print_lines, args = (LINES // thread_count,)) for _ in range(thread_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    real_stdout = sys.stdout
+    try:
+        for thread_count in (1, 4):
+            sys.stdout = PerWriteOutput(NullOutput(), is_stdout = True)
+            baseline = best_of(lambda: print_on_threads(thread_count), repeat = 3)
+            sys.stdout = vspd._DebuggerOutput(NullOutput(), is_stdout = True)
+            pumped = best_of(lambda: print_on_threads(thread_count), repeat = 3)
+            sys.stdout = real_stdout
+            report('%d lines on %d thread(s), per write' % (LINES, thread_count), baseline)
+            report('%d lines on %d thread(s), output pump' % (LINES, thread_count), pumped, baseline)
+    finally:
+        sys.stdout = real_stdout
+
+if __name__ == '__main__':
+    main()
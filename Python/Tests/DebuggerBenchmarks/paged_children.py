@@ -0,0 +1,70 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the time the debuggee thread spends expanding a 10M-element list and
+a 1M-key dict in the debugger: all children at once (the 'chld' command, which
+stops at 10000 items), versus the first, a middle and the next page of 100
+children ('chlp'). For the dict, the next page continues from the iterator
+position cached by the middle page.
+
+Usage: python paged_children.py
+"""
+
+import sys
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+LIST_SIZE = 10000000
+DICT_SIZE = 1000000
+PAGE = 100
+
+class NullSocket(object):
+    def sendall(self, b):
+        pass
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    vspd.conn = NullSocket()
+    thread = vspd.Thread(0)
+
+    big_list = list(range(LIST_SIZE))
+    big_dict = dict((i, str(i)) for i in range(DICT_SIZE))
+    frame = sys._getframe()
+    kind = vspd.FRAME_KIND_PYTHON
+
+    def enum_all(expr):
+        thread.enum_child_locally(expr, frame, 0, kind)
+
+    def enum_page(expr, offset):
+        thread.enum_child_page_locally(expr, frame, 0, kind, offset, PAGE)
+
+    for expr, size in (('big_list', LIST_SIZE), ('big_dict', DICT_SIZE)):
+        middle = size // 2
+        baseline = best_of(lambda: enum_all(expr), repeat = 3)
+        report('%s: chld' % expr, baseline)
+        report('%s: chlp first page' % expr, best_of(lambda: enum_page(expr, 0)), baseline)
+
+        def middle_page():
+            thread.child_enums.clear()
+            enum_page(expr, middle)
+        report('%s: chlp middle page' % expr, best_of(middle_page, repeat = 3), baseline)
+
+        # each call moves the cached position past the page it reports, so time one call only
+        middle_page()
+        report('%s: chlp page after the middle one' % expr, best_of(lambda: enum_page(expr, middle + PAGE), repeat = 1), baseline)
+
+if __name__ == '__main__':
+    main()
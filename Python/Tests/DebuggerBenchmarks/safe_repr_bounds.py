@@ -0,0 +1,55 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the time 100 SafeRepr calls take for giant locals: a 2M-key dict, a 2M-element
+list, a list of 10 100K-element lists, and a defaultdict with 2M keys (which
+is reported by length, not contents). The cost should stay in the same range
+regardless of the size of the collections.
+
+Usage: python safe_repr_bounds.py
+"""
+
+from collections import defaultdict
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+SIZE = 2000000
+CALLS = 100
+
+def main():
+    add_python_tools_path()
+    from visualstudio_py_util import SafeRepr
+    safe_repr = SafeRepr()
+
+    def repr_calls(value):
+        for _ in range(CALLS):
+            safe_repr(value)
+
+    big_dict = dict((str(i), i) for i in range(SIZE))
+    big_list = list(range(SIZE))
+    nested = [list(range(100000)) for _ in range(10)]
+    big_defaultdict = defaultdict(int, big_dict)
+    small = dict((str(i), i) for i in range(10))
+
+    baseline = best_of(lambda: repr_calls(small))
+    report('10-key dict', baseline)
+    for name, value in (('%d-key dict' % SIZE, big_dict),
+                        ('%d-element list' % SIZE, big_list),
+                        ('10 lists of 100000 elements', nested),
+                        ('%d-key defaultdict' % SIZE, big_defaultdict)):
+        report(name, best_of(lambda: repr_calls(value), repeat = 3), baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures the slowdown of a CPU-bound loop while ptvsd samples the stacks of
+all threads (see ptvsd.sample_to_file) at various intervals, and prints the
+most frequent stacks of the last run.
+
+Usage: python sampling_overhead.py
+
+Each mode runs in its own process, so that the samplers of earlier modes are
+not still running.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+INTERVALS = (None, 0.01, 0.001)
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+def workload():
+    total = 0
+    for i in range(200000):
+        total += i % 7
+    fib(20)
+    return total
+
+def run_mode(interval, filename):
+    if interval:
+        add_python_tools_path()
+        import ptvsd
+        ptvsd.sample_to_file(filename, interval, duration = 60.0)
+    print(best_of(workload))
+
+def main():
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        results = []
+        for interval in INTERVALS:
+            out = subprocess.check_output([sys.executable, __file__, str(interval), filename])
+            results.append((interval, float(out.decode('ascii').strip())))
+
+        baseline = results[0][1]
+        for interval, seconds in results:
+            report(interval and 'sampling every %gs' % interval or 'not sampling', seconds, baseline)
+
+        # the sampler writes the file when its duration has passed, so take a short profile for the stacks
+        subprocess.check_call([sys.executable, __file__, 'stacks', filename])
+        with open(filename) as f:
+            for line in f.readlines()[:5]:
+                stack, count = line.rsplit(' ', 1)
+                print('    %6d  %s' % (int(count), stack.split(';')[-1]))
+    finally:
+        os.remove(filename)
+
+def run_stacks(filename):
+    add_python_tools_path()
+    import ptvsd
+    import threading
+    worker = threading.Thread(target = best_of, args = (workload, 50))
+    worker.start()
+    ptvsd.sample_to_file(filename, 0.001, duration = 1.0, wait = True)
+    worker.join()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'stacks':
+            run_stacks(sys.argv[2])
+        else:
+            run_mode(sys.argv[1] != 'None' and float(sys.argv[1]), sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,154 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Measures stepping over and out of a call that runs many lines of Python code
+in a process with a debugger attached, with the line events of the frames
+below the stepped frame turned off, and with every frame getting line events
+(the way the debugger behaves on Python versions that can't turn them off).
+With sys.monitoring, only the code of the stepped frame gets events, and
+there is nothing to compare with. The client
+end of the connection is a thread in this process, which steps as soon as
+the breakpoint is hit.
+
+Usage: python step_over.py
+"""
+
+import socket
+import struct
+import sys
+import threading
+import time
+
+from benchmark_util import add_python_tools_path, best_of, report
+
+BREAKPOINT_ID = 1
+
+def library_work(n):
+    total = 0
+    for i in range(n):
+        total += i % 7
+    return total
+
+def callee():
+    total = library_work(200000)
+    total += sum(library_work(10) for i in range(20000))
+    return total
+
+def stepped():
+    x = 1
+    x += callee()
+    return x
+
+class Client(object):
+    """stands in for VS: steps with the given command whenever a breakpoint is hit, and resumes all
+    threads once the step is complete"""
+
+    def __init__(self, sock, step_command):
+        self.sock = sock
+        self.step_command = step_command
+        self.steps = 0
+
+    def run(self):
+        data = b''
+        while True:
+            try:
+                received = self.sock.recv(65536)
+            except socket.error:
+                return
+            if not received:
+                return
+            data += received
+            while True:
+                hit = data.find(b'BRKH')
+                step = data.find(b'STPD')
+                if step >= 0 and (hit < 0 or step < hit):
+                    self.steps += 1
+                    self.sock.sendall(b'resa')
+                    data = data[step + 4:]
+                elif hit >= 0 and len(data) >= hit + 20:
+                    tid = struct.unpack('!q', data[hit + 12:hit + 20])[0]
+                    self.sock.sendall(self.step_command + struct.pack('!q', tid))
+                    data = data[hit + 20:]
+                else:
+                    break
+            if data.find(b'BRKH') < 0:
+                data = data[-3:]
+
+def main():
+    add_python_tools_path()
+    import visualstudio_py_debugger as vspd
+    from visualstudio_py_util import write_bytes, write_int
+
+    if not vspd.CAN_DISABLE_LINE_EVENTS:
+        print('This version of Python can\'t turn off the line events of a frame.')
+        return
+
+    client_end, debugger_end = socket.socketpair()
+    client = Client(client_end, b'stpv')
+    client_thread = threading.Thread(target = client.run)
+    client_thread.daemon = True
+    client_thread.start()
+    vspd.attach_process_from_socket(debugger_end)
+    vspd.TRACE_ENGINE.start_thread(vspd.new_thread())
+
+    def write_command_string(text):
+        # strings sent to the debugger have no type prefix
+        data = text.encode('utf-8')
+        write_int(client_end, len(data))
+        write_bytes(client_end, data)
+
+    def set_breakpoint(func, offset):
+        write_bytes(client_end, vspd.to_bytes('brkp'))
+        write_int(client_end, BREAKPOINT_ID)
+        write_int(client_end, func.__code__.co_firstlineno + offset)
+        write_command_string(func.__code__.co_filename)
+        write_int(client_end, vspd.BREAKPOINT_CONDITION_ALWAYS)
+        write_command_string('')
+        write_int(client_end, vspd.BREAKPOINT_PASS_COUNT_ALWAYS)
+        write_int(client_end, 0)
+        while True:
+            bp = vspd.BreakpointInfo.find_by_id(BREAKPOINT_ID)
+            if bp is not None and bp.is_bound:
+                return
+            time.sleep(0.01)
+
+    def remove_breakpoint(func, offset):
+        write_bytes(client_end, vspd.to_bytes('brkr'))
+        write_int(client_end, func.__code__.co_firstlineno + offset)
+        write_int(client_end, BREAKPOINT_ID)
+        while vspd.BREAKPOINTS:
+            time.sleep(0.01)
+
+    baseline = best_of(stepped)
+    report('no breakpoint', baseline)
+
+    for title, command, func, offset in (('step over', b'stpv', stepped, 2),
+                                         ('step out', b'stpo', callee, 1)):
+        client.step_command = command
+        set_breakpoint(func, offset)
+        steps = client.steps
+        report(title, best_of(stepped), baseline)
+
+        if vspd.TRACE_ENGINE.uses_settrace:
+            vspd.CAN_DISABLE_LINE_EVENTS = False
+            report(title + ', line events in every frame', best_of(stepped), baseline)
+            vspd.CAN_DISABLE_LINE_EVENTS = True
+        remove_breakpoint(func, offset)
+        assert client.steps > steps
+
+    vspd.detach_process()
+
+if __name__ == '__main__':
+    main()
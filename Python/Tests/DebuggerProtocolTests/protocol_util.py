@@ -0,0 +1,126 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Helpers shared by the debugger protocol tests. The tests run directly against the
+sources in Python/Product/PythonTools, and decode the messages that the debugger
+writes to a fake connection the way the client in PythonProcess.cs reads them.
+"""
+
+import os
+import struct
+import sys
+import types
+
+PYTHON_TOOLS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'Product', 'PythonTools'))
+
+def add_python_tools_path():
+    """makes visualstudio_py_* and the submodules of the ptvsd package importable.
+
+    In the shipped ptvsd package, visualstudio_py_* are copied into the package
+    directory at build time; here they are aliased as submodules instead. The
+    package is set up without running its __init__, so that the aliases are in
+    place before ptvsd.attach_server imports them."""
+    if PYTHON_TOOLS_DIR not in sys.path:
+        sys.path.insert(0, PYTHON_TOOLS_DIR)
+    if 'ptvsd' in sys.modules:
+        return
+    import visualstudio_py_util
+    import visualstudio_py_repl
+    import visualstudio_py_debugger
+    package = types.ModuleType('ptvsd')
+    package.__path__ = [os.path.join(PYTHON_TOOLS_DIR, 'ptvsd')]
+    for mod in (visualstudio_py_util, visualstudio_py_repl, visualstudio_py_debugger):
+        setattr(package, mod.__name__, mod)
+        sys.modules['ptvsd.' + mod.__name__] = mod
+    sys.modules['ptvsd'] = package
+
+class FakeConnection(object):
+    """stands in for the socket to VS, and keeps everything sent on it"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def sendall(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+    def reader(self):
+        """returns a reader for everything sent so far, and starts over"""
+        data = bytes(self.data)
+        del self.data[:]
+        return MessageReader(data)
+
+class MessageReader(object):
+    """reads the messages written by MessageWriter"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def at_end(self):
+        return self.pos == len(self.data)
+
+    def read_bytes(self, count):
+        if self.pos + count > len(self.data):
+            raise EOFError('message is truncated')
+        res = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return res
+
+    def read_int(self):
+        return struct.unpack('!q', self.read_bytes(8))[0]
+
+    def read_string(self):
+        prefix = self.read_bytes(1)
+        if prefix == b'N':
+            return None
+        data = self.read_bytes(self.read_int())
+        if prefix == b'A':
+            return data.decode('ascii')
+        assert prefix == b'U', 'unknown string prefix %r' % prefix
+        return data.decode('utf-8')
+
+    def read_object(self):
+        """returns (repr, hex repr, type name, length, flags)"""
+        return self.read_string(), self.read_string(), self.read_string(), self.read_int(), self.read_int()
+
+    def read_variables(self):
+        """returns the variables as {name: (repr, hex repr, type name, length, flags)}, and their names in order"""
+        variables = {}
+        names = []
+        for _ in range(self.read_int()):
+            name = self.read_string()
+            variables[name] = self.read_object()
+            names.append(name)
+        return variables, names
+
+    def read_frame(self, django_kind = 2):
+        frame = {
+            'first_line' : self.read_int(),
+            'last_line' : self.read_int(),
+            'line' : self.read_int(),
+            'name' : self.read_string(),
+            'filename' : self.read_string(),
+            'arg_count' : self.read_int(),
+            'kind' : self.read_int(),
+        }
+        if frame['kind'] == django_kind:
+            frame['source_file'] = self.read_string()
+            frame['source_line'] = self.read_int()
+        frame['variables'] = self.read_variables()[0]
+        return frame
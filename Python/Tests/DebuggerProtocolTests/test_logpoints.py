@@ -0,0 +1,147 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Tests the messages of logpoints, and that the thread that hits a logpoint sends its
+message as output without stopping.
+
+Usage: python -m unittest discover -s Python/Tests/DebuggerProtocolTests
+"""
+
+import sys
+import threading
+import unittest
+
+from protocol_util import FakeConnection, add_python_tools_path
+
+add_python_tools_path()
+import visualstudio_py_debugger as vspd
+
+THREAD_ID = 1
+BREAKPOINT_ID = 1
+
+def get_frame(x, items):
+    return sys._getframe()
+
+def make_logpoint(message, lineno = 1, condition = None, pass_count_kind = vspd.BREAKPOINT_PASS_COUNT_ALWAYS, pass_count = 0):
+    condition_kind = condition and vspd.BREAKPOINT_CONDITION_WHEN_TRUE or vspd.BREAKPOINT_CONDITION_ALWAYS
+    bp = vspd.BreakpointInfo(BREAKPOINT_ID, 'module.py', lineno, condition_kind, condition, pass_count_kind, pass_count)
+    bp.set_log_message(message)
+    return bp
+
+def error_text(expr, frame):
+    try:
+        eval(expr, frame.f_globals, frame.f_locals)
+    except:
+        exc_type, exc_value = sys.exc_info()[:2]
+        return '<error: %s: %s>' % (exc_type.__name__, exc_value)
+
+class FormatTests(unittest.TestCase):
+    def setUp(self):
+        self.frame = get_frame(5, ['a', 'b'])
+
+    def format(self, message):
+        return ''.join(make_logpoint(message).format_log_message(self.frame))
+
+    def test_plain_text(self):
+        self.assertEqual(self.format('reached here'), 'reached here\n')
+
+    def test_placeholders(self):
+        self.assertEqual(self.format('x={x}, items={items}, len={ len(items) }'), "x=5, items=['a', 'b'], len=2\n")
+
+    def test_escaped_braces(self):
+        self.assertEqual(self.format('{{x}} is {x}}}'), '{x} is 5}\n')
+
+    def test_nested_braces(self):
+        self.assertEqual(self.format("{ {'k' : x}['k'] + 1 }"), '6\n')
+
+    def test_raising_expression(self):
+        self.assertEqual(self.format('before {x / 0} after {x}'), 'before %s after 5\n' % error_text('x / 0', self.frame))
+        self.assertEqual(self.format('{undefined}'), '%s\n' % error_text('undefined', self.frame))
+
+    def test_expression_that_does_not_compile(self):
+        text = self.format('bad {x +} still {x}')
+        self.assertTrue(text.startswith('bad <error: SyntaxError'), text)
+        self.assertTrue(text.endswith('> still 5\n'), text)
+
+    def test_unmatched_brace(self):
+        self.assertEqual(self.format('x={x} {oops'), 'x=5 {oops\n')
+
+    def test_no_message_is_a_breakpoint(self):
+        bp = make_logpoint('{x}')
+        bp.set_log_message('')
+        self.assertEqual((bp.log_message, bp.log_parts), (None, None))
+
+class HitTests(unittest.TestCase):
+    def setUp(self):
+        self.old_conn = getattr(vspd, 'conn', None)
+        self.old_detached = vspd.DETACHED
+        vspd.conn = self.conn = FakeConnection()
+        vspd.DETACHED = False
+        self.thread = vspd.Thread(THREAD_ID)
+        self.frame = get_frame(5, ['a', 'b'])
+
+    def tearDown(self):
+        vspd.BREAKPOINTS.remove(BREAKPOINT_ID)
+        vspd.OUTPUT_PUMP.send()
+        vspd.DETACHED = self.old_detached
+        vspd.conn = self.old_conn
+
+    def hit(self, bp, times = 1):
+        """runs the trace function of the thread on the line of the logpoint on another thread, and
+        returns the output that was sent for it"""
+        vspd.BREAKPOINTS.bind(bp, self.frame.f_code.co_filename)
+        def run():
+            for _ in range(times):
+                self.thread.handle_line(self.frame, None)
+        runner = threading.Thread(target = run)
+        runner.daemon = True
+        runner.start()
+        runner.join(10)
+        # a thread that stopped at a breakpoint waits to be resumed, and would still be running
+        self.assertFalse(runner.is_alive(), 'the thread was stopped by the logpoint')
+        self.assertFalse(self.thread._is_blocked)
+
+        vspd.OUTPUT_PUMP.send()
+        reader = self.conn.reader()
+        output = []
+        while not reader.at_end():
+            self.assertEqual(reader.read_bytes(4), b'OUTP')
+            self.assertEqual(reader.read_int(), THREAD_ID)
+            output.append(reader.read_string())
+        return ''.join(output)
+
+    def test_hit_sends_output(self):
+        bp = make_logpoint('x is {x}, {x / 0}', self.frame.f_lineno)
+        self.assertEqual(self.hit(bp), 'x is 5, %s\n' % error_text('x / 0', self.frame))
+        self.assertEqual(bp.hit_count, 1)
+
+    def test_each_hit_is_logged(self):
+        bp = make_logpoint('{len(items)}', self.frame.f_lineno)
+        self.assertEqual(self.hit(bp, 3), '2\n2\n2\n')
+
+    def test_condition_and_pass_count(self):
+        bp = make_logpoint('{x}', self.frame.f_lineno, 'x > 1', vspd.BREAKPOINT_PASS_COUNT_EVERY, 2)
+        self.assertEqual(self.hit(bp, 5), '5\n5\n')
+        self.assertEqual(bp.hit_count, 5)
+
+        bp = make_logpoint('{x}', self.frame.f_lineno, 'x > 10')
+        self.assertEqual(self.hit(bp, 3), '')
+
+    def test_other_lines_are_not_logged(self):
+        bp = make_logpoint('{x}', self.frame.f_lineno + 1)
+        self.assertEqual(self.hit(bp), '')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Tests the FRMV, CHLP, INVT and STAT messages of the newer protocol versions, which
+no client in this tree negotiates yet.
+
+Usage: python -m unittest discover -s Python/Tests/DebuggerProtocolTests
+"""
+
+import sys
+import unittest
+import zlib
+
+from protocol_util import FakeConnection, MessageReader, add_python_tools_path
+
+add_python_tools_path()
+import visualstudio_py_debugger as vspd
+
+THREAD_ID = 1
+
+def get_frame():
+    number = 42
+    text = 'text'
+    items = list(range(25))
+    keys = set(range(100, 125))
+    return sys._getframe()
+
+def read_children(reader):
+    children = []
+    for _ in range(reader.read_int()):
+        name = reader.read_string()
+        expression = reader.read_string()
+        children.append((name, expression, reader.read_object()))
+    return children
+
+class MessageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_conn = getattr(vspd, 'conn', None)
+        vspd.conn = self.conn = FakeConnection()
+        self.thread = vspd.Thread(THREAD_ID)
+        self.thread.reported = True
+
+    def tearDown(self):
+        vspd.conn = self.old_conn
+
+    def read_message(self, msg_type):
+        reader = self.conn.reader()
+        self.assertEqual(reader.read_bytes(4), msg_type)
+        return reader
+
+class FrameVariablesTests(MessageTestCase):
+    def test_frame_variables(self):
+        self.thread.enum_frame_variables_locally(get_frame(), 7)
+        reader = self.read_message(b'FRMV')
+        self.assertEqual(reader.read_int(), 7)
+        variables, names = reader.read_variables()
+        self.assertTrue(reader.at_end())
+        # the globals that the code of the frame refers to are included
+        self.assertEqual(sorted(names), ['items', 'keys', 'number', 'sys', 'text'])
+        self.assertEqual(variables['number'][:4], ('42', '0x2a', 'int', 0))
+        self.assertEqual(variables['text'][0], "'text'")
+        self.assertEqual(variables['items'][3], 25)
+        self.assertTrue(variables['items'][4] & vspd.PYTHON_EVALUATION_RESULT_EXPANDABLE)
+
+class ChildrenPageTests(MessageTestCase):
+    def get_page(self, expr, offset, count):
+        self.thread.enum_child_page_locally(expr, self.frame, 9, vspd.FRAME_KIND_PYTHON, offset, count)
+        reader = self.read_message(b'CHLP')
+        self.assertEqual(reader.read_int(), 9)
+        total = reader.read_int()
+        children = read_children(reader)
+        self.assertTrue(reader.at_end())
+        return total, children
+
+    def setUp(self):
+        MessageTestCase.setUp(self)
+        self.frame = get_frame()
+
+    def test_sequence_pages(self):
+        names = []
+        for offset in (0, 10, 20):
+            total, children = self.get_page('items', offset, 10)
+            self.assertEqual(total, 25)
+            names.extend(name for name, expression, obj in children if name.startswith('['))
+        self.assertEqual(names, ['[%d]' % i for i in range(25)])
+
+        total, children = self.get_page('items', 10, 1)
+        self.assertEqual(children, [('[10]', 'items[10]', ('10', '0xa', 'int', 0, 0))])
+
+    def test_unindexable_pages_continue(self):
+        values = []
+        for offset in (0, 10, 20):
+            total, children = self.get_page('keys', offset, 10)
+            self.assertEqual(total, 25)
+            values.extend(int(obj[0]) for name, expression, obj in children if obj[2] == 'int')
+        self.assertEqual(sorted(values), list(range(100, 125)))
+
+    def test_failed_evaluation(self):
+        self.assertEqual(self.get_page('undefined_name', 0, 10), (-1, []))
+
+class InventoryTests(MessageTestCase):
+    def setUp(self):
+        MessageTestCase.setUp(self)
+        self.old_bulk_inventory = vspd.BULK_INVENTORY
+        self.old_compress_size = vspd.INVENTORY_COMPRESS_SIZE
+        self.threads = [vspd.Thread(tid) for tid in (11, 12, 13)]
+        self.modules = [(filename, vspd.Module(filename)) for filename in ('a.py', u'\xe9.py')]
+
+    def tearDown(self):
+        vspd.BULK_INVENTORY = self.old_bulk_inventory
+        vspd.INVENTORY_COMPRESS_SIZE = self.old_compress_size
+        MessageTestCase.tearDown(self)
+
+    def read_inventory(self):
+        reader = self.read_message(b'INVT')
+        flags = reader.read_int()
+        payload = reader.read_bytes(reader.read_int())
+        self.assertTrue(reader.at_end())
+        if flags & vspd.INVENTORY_COMPRESSED:
+            payload = zlib.decompress(payload)
+        reader = MessageReader(payload)
+        threads = [reader.read_int() for _ in range(reader.read_int())]
+        modules = []
+        for _ in range(reader.read_int()):
+            module_id = reader.read_int()
+            modules.append((module_id, reader.read_string()))
+        self.assertTrue(reader.at_end())
+        return flags, threads, modules
+
+    def expected_modules(self):
+        return [(module.module_id, module.filename) for filename, module in self.modules]
+
+    def test_inventory(self):
+        vspd.BULK_INVENTORY = True
+        vspd.report_inventory(self.threads, self.modules)
+        self.assertEqual(self.read_inventory(), (0, [11, 12, 13], self.expected_modules()))
+        self.assertTrue(all(cur_thread.reported for cur_thread in self.threads))
+
+    def test_compressed_inventory(self):
+        vspd.BULK_INVENTORY = True
+        vspd.INVENTORY_COMPRESS_SIZE = 0
+        vspd.report_inventory(self.threads, self.modules)
+        self.assertEqual(self.read_inventory(), (vspd.INVENTORY_COMPRESSED, [11, 12, 13], self.expected_modules()))
+
+    def test_without_bulk_inventory(self):
+        vspd.BULK_INVENTORY = False
+        vspd.report_inventory(self.threads, self.modules)
+        reader = self.conn.reader()
+        for tid in (11, 12, 13):
+            self.assertEqual(reader.read_bytes(4), b'NEWT')
+            self.assertEqual(reader.read_int(), tid)
+        for module_id, filename in self.expected_modules():
+            self.assertEqual(reader.read_bytes(4), b'MODL')
+            self.assertEqual((reader.read_int(), reader.read_string()), (module_id, filename))
+        self.assertTrue(reader.at_end())
+
+class StatsTests(MessageTestCase):
+    def tearDown(self):
+        vspd.collect_stats(False)
+        MessageTestCase.tearDown(self)
+
+    def read_stats(self):
+        reader = self.read_message(b'STAT')
+        names = []
+        stats = {}
+        for _ in range(reader.read_int()):
+            name = reader.read_string()
+            stats[name] = reader.read_string()
+            names.append(name)
+        self.assertTrue(reader.at_end())
+        self.assertEqual(names, sorted(names))
+        return stats
+
+    def test_stats(self):
+        vspd.report_stats({'count' : 3, 'time' : 0.25, 'flag' : True})
+        self.assertEqual(self.read_stats(), {'count' : '3', 'time' : '0.25', 'flag' : '1'})
+
+    def test_collected_stats(self):
+        vspd.collect_stats(True)
+        self.thread.enum_frame_variables_locally(get_frame(), 7)
+        self.conn.reader()
+        vspd.report_stats(vspd.STATS.get())
+        stats = self.read_stats()
+        self.assertEqual(stats['collecting'], '1')
+        self.assertEqual(stats['messages_sent.FRMV'], '1')
+        self.assertEqual(int(stats['evaluations']), 5)
+        float(stats['seconds'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Tests the SMPL messages of the sampling profiler, and the PROF command that starts it
+through the attach server of another process.
+
+Usage: python -m unittest discover -s Python/Tests/DebuggerProtocolTests
+"""
+
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import unittest
+
+from protocol_util import FakeConnection, MessageReader, add_python_tools_path
+
+add_python_tools_path()
+from ptvsd import attach_server
+
+# runs in the process that is sampled through PROF
+TARGET_SCRIPT = '''
+import sys, time
+sys.path.insert(0, %r)
+from protocol_util import add_python_tools_path
+add_python_tools_path()
+from ptvsd import attach_server
+attach_server.enable_attach(None, ('127.0.0.1', %d))
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+def spin(end):
+    while time.time() < end:
+        pass
+spin(time.time() + 10)
+'''
+
+def spin(stop):
+    while not stop:
+        pass
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def read_samples(reader):
+    """returns (samples, dropped, {stack: count}) read from a SMPL"""
+    assert reader.read_bytes(4) == b'SMPL'
+    samples = reader.read_int()
+    dropped = reader.read_int()
+    stacks = {}
+    for _ in range(reader.read_int()):
+        stack = reader.read_string()
+        stacks[stack] = reader.read_int()
+    return samples, dropped, stacks
+
+@unittest.skipUnless(attach_server.can_sample(), 'sampling is not supported')
+class SampleToClientTests(unittest.TestCase):
+    def setUp(self):
+        self.stop = []
+        self.spinner = threading.Thread(target = spin, args = (self.stop,))
+        self.spinner.start()
+
+    def tearDown(self):
+        self.stop.append(True)
+        self.spinner.join()
+
+    def test_snapshots(self):
+        client = FakeConnection()
+        sampler = attach_server.Sampler(0.002)
+        attach_server.sample_to_client(sampler, client, 0.3, 0.1)
+        self.assertTrue(client.closed)
+
+        reader = client.reader()
+        snapshots = []
+        while not reader.at_end():
+            snapshots.append(read_samples(reader))
+        # one per period, and the last one when the duration has passed
+        self.assertTrue(3 <= len(snapshots) <= 4, len(snapshots))
+
+        spin_frame = 'spin (%s:%d)' % (spin.__code__.co_filename, spin.__code__.co_firstlineno)
+        for samples, dropped, stacks in snapshots[:-1]:
+            self.assertTrue(samples > 0)
+            self.assertEqual(dropped, 0)
+            self.assertTrue(sum(stacks.values()) <= samples)
+            spinning = [stack for stack in stacks if stack.endswith(spin_frame)]
+            self.assertEqual(len(spinning), 1)
+            self.assertTrue(stacks[spinning[0]] > samples // 2)
+            for stack in stacks:
+                self.assertFalse('visualstudio_py_' in stack or 'attach_server' in stack, stack)
+
+    def test_dropped_stacks(self):
+        client = FakeConnection()
+        sampler = attach_server.Sampler(0.002, max_stacks = 0)
+        attach_server.sample_to_client(sampler, client, 0.05, 1.0)
+        samples, dropped, stacks = read_samples(client.reader())
+        self.assertEqual(stacks, {})
+        self.assertTrue(dropped >= samples > 0)
+
+@unittest.skipUnless(attach_server.can_sample(), 'sampling is not supported')
+class ProfileCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.port = get_free_port()
+        script = TARGET_SCRIPT % (os.path.dirname(os.path.abspath(__file__)), self.port)
+        self.process = subprocess.Popen([sys.executable, '-c', script], stdout = subprocess.PIPE)
+        self.assertEqual(self.process.stdout.readline().strip(), b'ready')
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def connect(self, version):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        reader = sock.makefile('rb')
+        self.assertEqual(reader.read(7), b'PTVSDBG')
+        struct.unpack('!q', reader.read(8))
+        sock.sendall(b'PTVSDBG' + struct.pack('!q', version) + struct.pack('!q', 0))
+        self.assertEqual(reader.read(4), b'ACPT')
+        return sock, reader
+
+    def profile(self, version, interval, duration, period):
+        sock, reader = self.connect(version)
+        sock.sendall(b'PROF' + struct.pack('!qqq', interval, duration, period))
+        response = reader.read(4)
+        data = reader.read()
+        reader.close()
+        sock.close()
+        return response, data
+
+    def test_profile(self):
+        response, data = self.profile(attach_server.PTVSDBG_SAMPLING_VER, 2, 300, 100)
+        self.assertEqual(response, b'ACPT')
+        reader = MessageReader(data)
+        total = 0
+        spinning = 0
+        while not reader.at_end():
+            samples, dropped, stacks = read_samples(reader)
+            total += samples
+            spinning += sum(count for stack, count in stacks.items() if stack.split(';')[-1].startswith('spin ('))
+        self.assertTrue(total > 0)
+        self.assertTrue(spinning > total // 2)
+
+    def test_rejected_before_sampling_version(self):
+        response, data = self.profile(attach_server.PTVSDBG_SAMPLING_VER - 1, 2, 300, 100)
+        self.assertEqual((response, data), (b'RJCT', b''))
+
+    def test_rejected_without_period(self):
+        response, data = self.profile(attach_server.PTVSDBG_SAMPLING_VER, 2, 300, 0)
+        self.assertEqual((response, data), (b'RJCT', b''))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+ # ############################################################################
+ #
+ # Copyright (c) Microsoft Corporation.
+ #
+ # This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+ # copy of the license can be found in the License.html file at the root of this distribution. If
+ # you cannot locate the Apache License, Version 2.0, please send an email to
+ # vspython@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+ # by the terms of the Apache License, Version 2.0.
+ #
+ # You must not remove this notice, or any other, from this software.
+ #
+ # ###########################################################################
+
+"""
+Tests the THRD messages that report what changed in a thread's stack since it was
+last reported, by applying them to the stack decoded from the previous THRF or THRD
+and comparing the result with a full THRF of the new stack.
+
+Usage: python -m unittest discover -s Python/Tests/DebuggerProtocolTests
+"""
+
+import unittest
+
+from protocol_util import FakeConnection, MessageReader, add_python_tools_path
+
+add_python_tools_path()
+import visualstudio_py_debugger as vspd
+from visualstudio_py_util import MessageWriter
+
+THREAD_ID = 1
+
+def make_frame(name, line, variables, kind = vspd.FRAME_KIND_PYTHON, source_line = None):
+    """returns a frame as get_frame_list does, with the variables given as {name: value}"""
+    first_line = 10 * len(name)
+    variables = [(var_name, type(value), repr(value), None, type(value).__name__, 0)
+                 for var_name, value in sorted(variables.items())]
+    source_file = 'page.html' if kind == vspd.FRAME_KIND_DJANGO else None
+    return (first_line, first_line + 9, line, name, 'module.py', 0, variables, kind, source_file, source_line)
+
+def read_frame_list(reader):
+    assert reader.read_bytes(4) == b'THRF'
+    assert reader.read_int() == THREAD_ID
+    reader.read_string()
+    return [reader.read_frame() for _ in range(reader.read_int())]
+
+def apply_frame_delta(reader, frames):
+    """returns the stack that results from applying the THRD read from reader to frames"""
+    assert reader.read_bytes(4) == b'THRD'
+    assert reader.read_int() == THREAD_ID
+    popped = reader.read_int()
+    pushed = [reader.read_frame() for _ in range(reader.read_int())]
+    frames = pushed + [dict(frame, variables = dict(frame['variables'])) for frame in frames[popped:]]
+    for _ in range(reader.read_int()):
+        frame = frames[reader.read_int()]
+        frame['line'] = reader.read_int()
+        if frame['kind'] == vspd.FRAME_KIND_DJANGO:
+            frame['source_line'] = reader.read_int()
+        updated, names = reader.read_variables()
+        frame['variables'].update(updated)
+        for _ in range(reader.read_int()):
+            del frame['variables'][reader.read_string()]
+    return frames
+
+class StackDeltaTests(unittest.TestCase):
+    def setUp(self):
+        self.old_conn = getattr(vspd, 'conn', None)
+        self.old_stack_deltas = vspd.STACK_DELTAS
+        vspd.conn = self.conn = FakeConnection()
+        vspd.STACK_DELTAS = True
+        self.thread = vspd.Thread(THREAD_ID)
+        self.thread.reported = True
+        self.client_frames = None
+
+    def tearDown(self):
+        vspd.conn = self.old_conn
+        vspd.STACK_DELTAS = self.old_stack_deltas
+
+    def send(self, frames, frame_ids):
+        """sends the stack, checks that the client ends up with the same frames as from a full THRF, and
+        returns the type of the message that was sent, or None if nothing was"""
+        self.thread.send_frame_delta(frames, frame_ids)
+        reader = self.conn.reader()
+        if reader.at_end():
+            msg_type = None
+        else:
+            msg_type = reader.data[:4]
+            if msg_type == b'THRF':
+                self.client_frames = read_frame_list(reader)
+            else:
+                self.client_frames = apply_frame_delta(reader, self.client_frames)
+            self.assertTrue(reader.at_end())
+
+        full_thread = vspd.Thread(THREAD_ID)
+        full_thread.reported = True
+        msg = MessageWriter()
+        full_thread.write_frame_list(msg, frames)
+        self.assertEqual(self.client_frames, read_frame_list(MessageReader(bytes(msg.buffer))))
+        return msg_type
+
+    def test_first_report_is_full(self):
+        frames = [make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {})]
+        self.assertEqual(self.send(frames, [2, 1]), b'THRF')
+
+    def test_unchanged_stack_is_not_reported(self):
+        frames = [make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {})]
+        self.send(frames, [2, 1])
+        self.assertEqual(self.send(frames, [2, 1]), None)
+
+    def test_push(self):
+        self.send([make_frame('outer', 7, {'a' : 1})], [1])
+        frames = [make_frame('callee', 2, {'n' : 5}), make_frame('inner', 4, {}), make_frame('outer', 8, {'a' : 1})]
+        self.assertEqual(self.send(frames, [3, 2, 1]), b'THRD')
+
+    def test_pop(self):
+        self.send([make_frame('callee', 2, {'n' : 5}), make_frame('inner', 4, {}), make_frame('outer', 7, {'a' : 1})], [3, 2, 1])
+        self.assertEqual(self.send([make_frame('outer', 8, {'a' : 2})], [1]), b'THRD')
+
+    def test_pop_and_push(self):
+        self.send([make_frame('first', 2, {'n' : 5}), make_frame('middle', 4, {}), make_frame('outer', 7, {'a' : 1})], [3, 2, 1])
+        frames = [make_frame('second', 12, {'m' : 1}), make_frame('callee', 5, {}), make_frame('middle', 4, {}), make_frame('outer', 7, {'a' : 1})]
+        self.assertEqual(self.send(frames, [5, 4, 2, 1]), b'THRD')
+
+    def test_changed_and_removed_variables(self):
+        self.send([make_frame('inner', 3, {'x' : 1, 'y' : 'a', 'z' : None}), make_frame('outer', 7, {'a' : 1})], [2, 1])
+        frames = [make_frame('inner', 4, {'x' : 2, 'y' : 'a', 'w' : []}), make_frame('outer', 7, {'a' : 1})]
+        self.assertEqual(self.send(frames, [2, 1]), b'THRD')
+
+    def test_changed_variables_below_pushed_frames(self):
+        self.send([make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {'a' : 1, 'b' : 2})], [2, 1])
+        frames = [make_frame('callee', 1, {}), make_frame('inner', 3, {}), make_frame('outer', 7, {'a' : 3})]
+        self.assertEqual(self.send(frames, [3, 2, 1]), b'THRD')
+
+    def test_changed_variables_below_popped_frames(self):
+        self.send([make_frame('callee', 1, {}), make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {'a' : 1})], [3, 2, 1])
+        frames = [make_frame('inner', 4, {'x' : 2}), make_frame('outer', 7, {})]
+        self.assertEqual(self.send(frames, [2, 1]), b'THRD')
+
+    def test_django_frame_line(self):
+        self.send([make_frame('render', 3, {}, vspd.FRAME_KIND_DJANGO, 20), make_frame('outer', 7, {})], [2, 1])
+        frames = [make_frame('render', 3, {}, vspd.FRAME_KIND_DJANGO, 21), make_frame('outer', 7, {})]
+        self.assertEqual(self.send(frames, [2, 1]), b'THRD')
+
+    def test_no_retained_frame_resyncs(self):
+        self.send([make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {})], [2, 1])
+        self.assertEqual(self.send([make_frame('other', 1, {'y' : 2})], [3]), b'THRF')
+
+    def test_new_connection_resyncs(self):
+        frames = [make_frame('inner', 3, {'x' : 1}), make_frame('outer', 7, {})]
+        self.send(frames, [2, 1])
+        vspd.conn = self.conn = FakeConnection()
+        self.assertEqual(self.send(frames, [2, 1]), b'THRF')
+
+    def test_same_code_in_new_frame_is_pushed(self):
+        # a frame is identified by its id, not by its code, so a recursive call to the same function is a push
+        self.send([make_frame('recurse', 3, {'n' : 1})], [1])
+        frames = [make_frame('recurse', 3, {'n' : 0}), make_frame('recurse', 4, {'n' : 1})]
+        self.assertEqual(self.send(frames, [2, 1]), b'THRD')
+        self.assertEqual(len(self.client_frames), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1551,6 +1551,9 @@ namespace DebuggerTests {
                 TestException(debugger, Path.Combine(DebuggerTestPath, "UnhandledException6.py"), i == 0, ExceptionMode.Unhandled, null,
                     new ExceptionInfo("OSError", 12)
                 );
+                TestException(debugger, Path.Combine(DebuggerTestPath, "UnhandledException7.py"), i == 0, ExceptionMode.Unhandled, null,
+                    new ExceptionInfo("ValueError", 10)
+                );
             }
         }
 
@@ -0,0 +1,12 @@
+import copy
+
+class A(object):
+    def __deepcopy__(self, memo):
+        try: raise ValueError()     # does not break
+        except: raise
+
+def f():
+    # the handler in A re-raises, and the library code in between does not handle it either
+    copy.deepcopy(A())              # breaks
+
+f()